@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Fixed size accumulators for statistics gathered while streaming through the
+log archive.  Memory use depends only on the number of keys (players), not
+on how many games are fed in.
+
+The accumulators of separate shards of the archive can be combined with
+merge(), which gives the same result in any grouping, and serialized as
+json with dump() and load().
+"""
+
+import math
+from array import array
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+class StatTable:
+    """
+    Column oriented table of float stats.  Each key (usually a player id)
+    is interned to an integer and owns `width` consecutive rows, such as one
+    row per tf2 class.  Columns are flat arrays of doubles, so a row costs
+    8 bytes per column.
+    """
+
+    __slots__ = ("names", "width", "columns", "keys")
+
+    def __init__(self, columns, width=1):  # type: (Iterable[str], int) -> None
+        self.names = list(columns)
+        self.width = width
+        self.columns = {c: array("d") for c in self.names}
+        self.keys = {}  # type: Dict[str, int]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, key):  # type: (str) -> int
+        """
+        returns the index of a key, adding a block of zeroed rows for it if
+        it's new
+        """
+        index = self.keys.get(key)
+        if index is None:
+            index = self.keys[key] = len(self.keys)
+            zeros = array("d", bytes(8 * self.width))
+            for column in self.columns.values():
+                column.extend(zeros)
+        return index
+
+    def add(self, row, column, value):  # type: (int, str, float) -> None
+        self.columns[column][row] += value
+
+    def clear(self):  # type: () -> None
+        self.columns = {c: array("d") for c in self.names}
+        self.keys = {}
+
+    def get(self, row, column):  # type: (int, str) -> float
+        return self.columns[column][row]
+
+    def row(self, row):  # type: (int) -> Dict[str, float]
+        return {c: self.columns[c][row] for c in self.names}
+
+    def add_sample(self, row, prefix, value):
+        # type: (int, str, float) -> None
+        """
+        adds a value to a running mean and variance stored in the
+        <prefix>_count, <prefix>_mean and <prefix>_m2 columns, using
+        Welford's algorithm.
+        """
+        count = self.columns[prefix + "_count"][row] + 1
+        mean = self.columns[prefix + "_mean"][row]
+        delta = value - mean
+        mean += delta / count
+        self.columns[prefix + "_count"][row] = count
+        self.columns[prefix + "_mean"][row] = mean
+        self.columns[prefix + "_m2"][row] += delta * (value - mean)
+
+    def merge(self, other):  # type: (StatTable) -> None
+        """
+        adds the stats of another table with the same columns to this one.
+        Running variances (see add_sample) are combined, and the other
+        columns are summed.  Keys new to this table are interned in the
+        other table's order.
+        """
+        prefixes = [
+            c[:-len("_count")] for c in self.names if c.endswith("_count")
+        ]
+        prefixes = [
+            p for p in prefixes
+            if all(c in self.columns for c in welford_columns(p))
+        ]
+        welford = {c for p in prefixes for c in welford_columns(p)}
+        summed = [c for c in self.names if c not in welford]
+        for key, index in sorted(other.keys.items(), key=lambda k: k[1]):
+            mine = self.intern(key) * self.width
+            theirs = index * self.width
+            for offset in range(self.width):
+                row, other_row = mine + offset, theirs + offset
+                for c in summed:
+                    self.columns[c][row] += other.columns[c][other_row]
+                for prefix in prefixes:
+                    merged = merge_welford(
+                        [self.columns[c][row]
+                         for c in welford_columns(prefix)],
+                        [other.columns[c][other_row]
+                         for c in welford_columns(prefix)])
+                    for c, value in zip(welford_columns(prefix), merged):
+                        self.columns[c][row] = value
+
+    def dump(self):  # type: () -> Dict[str, Any]
+        return {
+            "names": self.names,
+            "width": self.width,
+            "keys": sorted(self.keys, key=self.keys.__getitem__),
+            "columns": {c: self.columns[c].tolist() for c in self.names}
+        }
+
+    @classmethod
+    def load(cls, state):  # type: (Dict[str, Any]) -> StatTable
+        table = cls(state["names"], state["width"])
+        table.keys = {key: i for i, key in enumerate(state["keys"])}
+        table.columns = {
+            c: array("d", values)
+            for c, values in state["columns"].items()
+        }
+        return table
+
+
+def welford_columns(prefix):  # type: (str) -> List[str]
+    return [prefix + "_count", prefix + "_mean", prefix + "_m2"]
+
+
+def merge_welford(a, b):
+    # type: (List[float], List[float]) -> Tuple[float, float, float]
+    """
+    combines two running variances given as [count, mean, m2] (Chan et
+    al.'s parallel algorithm)
+    """
+    count = a[0] + b[0]
+    if not count:
+        return 0.0, 0.0, 0.0
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / count
+    return count, mean, a[2] + b[2] + delta * delta * a[0] * b[0] / count
+
+
+def sample_stdev(row_stats, prefix):  # type: (Dict[str, float], str) -> float
+    """
+    returns the sample standard deviation of a running variance read from a
+    StatTable row
+    """
+    count = row_stats[prefix + "_count"]
+    if count < 2:
+        return float("nan")
+    return math.sqrt(row_stats[prefix + "_m2"] / (count - 1))
+
+
+class LogHistogram:
+    """
+    Quantile sketch with a fixed number of logarithmically sized buckets
+    between low and high.  Quantiles are accurate to the width of a bucket
+    relative to the value; values outside the range are clamped.
+    """
+
+    __slots__ = ("low", "high", "counts", "_scale")
+
+    def __init__(self, low, high, buckets=128):
+        # type: (float, float, int) -> None
+        self.low = low
+        self.high = high
+        self.counts = array("L", bytes(array("L").itemsize * buckets))
+        self._scale = buckets / math.log(high / low)
+
+    def add(self, value):  # type: (float) -> None
+        value = min(max(value, self.low), self.high)
+        bucket = int(math.log(value / self.low) * self._scale)
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+
+    def total(self):  # type: () -> int
+        return sum(self.counts)
+
+    def quantile(self, q):  # type: (float) -> float
+        """
+        returns the geometric middle of the bucket holding the q quantile
+        """
+        target = q * self.total()
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.low * math.exp((bucket + 0.5) / self._scale)
+        return float("nan")
+
+    def clear(self):  # type: () -> None
+        for bucket in range(len(self.counts)):
+            self.counts[bucket] = 0
+
+    def merge(self, other):  # type: (LogHistogram) -> None
+        """
+        adds the counts of another histogram with the same buckets
+        """
+        if (other.low, other.high, len(other.counts)) != (
+                self.low, self.high, len(self.counts)):
+            raise ValueError("histograms with different buckets")
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+
+    def dump(self):  # type: () -> Dict[str, Any]
+        return {
+            "low": self.low,
+            "high": self.high,
+            "counts": self.counts.tolist()
+        }
+
+    @classmethod
+    def load(cls, state):  # type: (Dict[str, Any]) -> LogHistogram
+        hist = cls(state["low"], state["high"], len(state["counts"]))
+        hist.counts = array("L", state["counts"])
+        return hist
+
+
+class LastValues(dict):
+    """
+    The latest value of each key, such as a player's name, where the latest
+    is the one added with the greatest position, like a log's upload date
+    and id.  Unlike a dict filled in order, the merged values of shards
+    don't depend on the order they're merged in.
+    """
+
+    __slots__ = ("positions", )
+
+    def __init__(self):  # type: () -> None
+        super().__init__()
+        self.positions = {}  # type: Dict[Any, Tuple]
+
+    def add(self, key, value, position):  # type: (Any, Any, Tuple) -> None
+        if key not in self.positions or position >= self.positions[key]:
+            self[key] = value
+            self.positions[key] = position
+
+    def clear(self):  # type: () -> None
+        super().clear()
+        self.positions.clear()
+
+    def merge(self, other):  # type: (LastValues) -> None
+        for key, value in other.items():
+            self.add(key, value, other.positions[key])
+
+    def dump(self):  # type: () -> Dict[str, Any]
+        return {"values": dict(self), "positions": dict(self.positions)}
+
+    @classmethod
+    def load(cls, state):  # type: (Dict[str, Any]) -> LastValues
+        last = cls()
+        last.update(state["values"])
+        last.positions = {
+            key: tuple(position)
+            for key, position in state["positions"].items()
+        }
+        return last
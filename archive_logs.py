@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 """
 This script downloads the most recent game logs from logs.tf and stores them
-in game_logs.json.  It avoids archiving "casual" maps, only downloading
-logs for competive maps.
+in the log archive, game_logs.dat.  It avoids archiving "casual" maps, only
+downloading logs for competive maps.  Pass --keep-raw to also keep the
+unprojected logs in game_logs_raw.dat.
+
+--base-url points the script at another logs.tf server, like the fixture
+server in fixture_server.py, and --delay, --error-delay and --timeout set
+the politeness delay between requests, the pause after an error, and the
+request timeout in seconds.
+
+New logs are checked against the duplicate index (see dedupe.py) as they
+are archived, and copies of a match already archived are flagged.
 """
 
+import argparse
+import socket
 from urllib import request
 from urllib.error import URLError
 from pathlib import Path
 from datetime import datetime, timedelta
 import time
 import json
-from typing import Set
+import sqlite3
+from typing import Dict, List, Set, Tuple
+import log_archive
+import dedupe
 
+LOGS_TF_URL = "https://logs.tf"
 SLEEP_TIME = 3
+ERROR_SLEEP_TIME = 60 * 5
+TIMEOUT = 10
 SEASON = datetime.now() - timedelta(days=60)
 
 
@@ -27,60 +44,114 @@ def is_compmap(name):
         "koth_")
 
 
-def get_game_ids():
+def list_game_ids(base_url, timeout):  # type: (str, float) -> List[int]
     """
-    lazily yields game ids of the most recent logs.tf games.
-    This function filters out games with casual maps, using
-    a competitive map whitelist.
+    returns the ids of the most recent logs.tf games, filtering out games
+    with casual maps, using a competitive map whitelist.  Raises URLError
+    or socket.timeout when logs.tf can't be reached.
     """
-    id_url = "https://logs.tf/api/v1/log?limit=9000"
-    try:
-        id_request = request.urlopen(id_url, timeout=10)
-        game_search = json.loads(id_request.read().decode("utf-8"))
-        for game_log in game_search["logs"]:
-            if is_compmap(game_log["map"]
-                          ) and game_log["date"] >= SEASON.timestamp():
-                yield game_log["id"]
-        time.sleep(SLEEP_TIME)
-    except URLError as e:
-        print(e)
-        print("error processing", id_url, "sleeping 5 mins.")
-        time.sleep(60 * 5)
+    id_url = base_url + "/api/v1/log?limit=9000"
+    id_request = request.urlopen(id_url, timeout=timeout)
+    game_search = json.loads(id_request.read().decode("utf-8"))
+    return [
+        game_log["id"] for game_log in game_search["logs"]
+        if is_compmap(game_log["map"])
+        and game_log["date"] >= SEASON.timestamp()
+    ]
+
 
+def download_log(base_url, gid, timeout):  # type: (str, int, float) -> Dict
+    log_url = "{}/json/{}".format(base_url, gid)
+    details_request = request.urlopen(log_url, timeout=timeout)
+    game_details = json.loads(details_request.read().decode("utf-8"))
+    game_details["id"] = gid
+    return game_details
 
-downloaded_games = set()  # type: Set[int]
-if not Path("game_logs.json").is_file():
-    with open("game_logs.json", "w+") as f:
-        print("created game_logs.json")
-else:
-    with open("game_logs.json", "r", encoding="utf-8") as f:
-        for line in f:
-            game = json.loads(line)
-            downloaded_games.add(game["id"])
 
-print("found", len(downloaded_games), "games in game_logs.json")
+def archived_ids():  # type: () -> Set[int]
+    """
+    returns the ids of the logs in the archive, creating it if needed
+    """
+    downloaded_games = set()  # type: Set[int]
+    if not Path(log_archive.ARCHIVE_FILE).is_file():
+        with open(log_archive.ARCHIVE_FILE, "wb"):
+            print("created", log_archive.ARCHIVE_FILE)
+    else:
+        for header in log_archive.iter_headers():
+            downloaded_games.add(header.id)
+    return downloaded_games
 
-for gid in get_game_ids():
-    if gid in downloaded_games:
-        print(gid, "already downloaded")
-        continue
 
-    print("https://logs.tf/json/" + str(gid))
-    try:
-        details_request = request.urlopen("https://logs.tf/json/" + str(gid),
-                                          timeout=10)
-        game_details = json.loads(details_request.read().decode("utf-8"))
-        del game_details["chat"]
-        game_details["id"] = gid
+def store_log(
+        game_details,  # type: Dict
+        dedupe_con,  # type: sqlite3.Connection
+        duplicate_index,  # type: dedupe.DuplicateIndex
+        keep_raw=False,  # type: bool
+):
+    # type: (...) -> Tuple[Dict, List[Tuple[int, int]]]
+    """
+    appends a downloaded log to the archive and the duplicate index, and
+    returns the projected log and the duplicates it created
+    """
+    projected = log_archive.project(game_details)
+    with open(log_archive.ARCHIVE_FILE, "ab") as games_file:
+        log_archive.append_log(games_file, projected)
 
-        with open("game_logs.json", "a", encoding="utf-8") as games_file:
-            games_file.write(json.dumps(game_details) + "\n")
+    fingerprint = dedupe.fingerprint(projected)
+    duplicates = duplicate_index.check(fingerprint)
+    dedupe.save(dedupe_con, fingerprint, duplicates)
+    dedupe_con.commit()
+    for duplicate, kept in duplicates:
+        print(duplicate, "is a duplicate of", kept)
 
-    except URLError as e:
+    if keep_raw:
+        with open(log_archive.RAW_ARCHIVE_FILE, "ab") as raw_file:
+            log_archive.append_log(raw_file, game_details)
+    return projected, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keep-raw", action="store_true")
+    parser.add_argument("--base-url", default=LOGS_TF_URL)
+    parser.add_argument("--delay", type=float, default=SLEEP_TIME)
+    parser.add_argument("--error-delay", type=float, default=ERROR_SLEEP_TIME)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    args = parser.parse_args()
+
+    downloaded_games = archived_ids()
+    print("found", len(downloaded_games), "games in", log_archive.ARCHIVE_FILE)
+
+    dedupe_con = dedupe.connect()
+    duplicate_index = dedupe.load_index(dedupe_con)
+
+    try:
+        game_ids = list_game_ids(args.base_url, args.timeout)
+    except (URLError, socket.timeout) as e:
         print(e)
-        print(
-            "error processing https://logs.tf/json/{} sleeping 5 mins.".format(
-                gid))
-        time.sleep(60 * 5)
+        print("error listing logs, sleeping", args.error_delay, "seconds.")
+        time.sleep(args.error_delay)
+        return
+    time.sleep(args.delay)
+
+    for gid in game_ids:
+        if gid in downloaded_games:
+            print(gid, "already downloaded")
+            continue
+
+        print("{}/json/{}".format(args.base_url, gid))
+        try:
+            game_details = download_log(args.base_url, gid, args.timeout)
+            store_log(game_details, dedupe_con, duplicate_index,
+                      args.keep_raw)
+        except (URLError, socket.timeout) as e:
+            print(e)
+            print("error processing log", gid, "sleeping", args.error_delay,
+                  "seconds.")
+            time.sleep(args.error_delay)
+
+        time.sleep(args.delay)
+
 
-    time.sleep(SLEEP_TIME)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Backtests trueskill environment settings against the log archive.
+
+The date ordered games are encoded once into compact integer arrays (see
+encode_games) and cached in backtest_games.npz.  Each setting in the
+parameter grid replays the encoded games in a separate process, rating
+every game in order.  Before each of the last games (the held out
+fraction) is rated, its result is predicted.  Settings are ranked by the
+log loss of those predictions, and accuracy is reported alongside.
+
+usage: backtest.py [--holdout 0.2] [--sigma 8.333 ...] [--beta 4.167 ...]
+                   [--tau 0.083 ...] [--draw 0.1 ...] [--processes N]
+"""
+
+import argparse
+import itertools
+import math
+import os
+from multiprocessing import Pool
+from typing import Any, Dict, List, NamedTuple, Tuple
+import numpy as np  # type: ignore
+import trueskill  # type: ignore
+import log_archive
+from mmr_calc import get_sorted_games
+
+GAMES_FILE = "backtest_games.npz"
+
+Trial = NamedTuple(
+    "Trial",
+    [
+        ("mu", float),
+        ("sigma", float),
+        ("beta", float),
+        ("tau", float),
+        ("draw_probability", float),
+    ],
+)
+
+TrialResult = NamedTuple(
+    "TrialResult",
+    [
+        ("trial", Trial),
+        ("log_loss", float),
+        ("accuracy", float),
+        ("games", int),
+    ],
+)
+
+# the encoded games, loaded once per worker process
+games = {}  # type: Dict[str, Any]
+
+
+def encode_games():  # type: () -> Dict[str, Any]
+    """
+    encodes the rated games as arrays.  Player ids are interned to
+    integers; "players" holds the red then blue players of every game, and
+    "starts", "red_sizes" and "blue_sizes" locate each game's players in
+    it.  "results" is 1 for a red win, 0 for a blue win, and 0.5 for a
+    draw.
+    """
+    player_ids = {}  # type: Dict[str, int]
+    players = []  # type: List[int]
+    starts, red_sizes, blue_sizes, results = [], [], [], []
+    for game in get_sorted_games():
+        red = [
+            i for i in game["players"] if game["players"][i]["team"] == "Red"
+        ]
+        blue = [
+            i for i in game["players"] if game["players"][i]["team"] == "Blue"
+        ]
+        if not red or not blue:
+            continue
+
+        starts.append(len(players))
+        red_sizes.append(len(red))
+        blue_sizes.append(len(blue))
+        for id3 in red + blue:
+            players.append(player_ids.setdefault(id3, len(player_ids)))
+
+        red_score = game["teams"]["Red"]["score"]
+        blue_score = game["teams"]["Blue"]["score"]
+        results.append(0.5 if red_score == blue_score else float(
+            red_score > blue_score))
+
+    return {
+        "players": np.array(players, dtype=np.int32),
+        "starts": np.array(starts, dtype=np.int64),
+        "red_sizes": np.array(red_sizes, dtype=np.int8),
+        "blue_sizes": np.array(blue_sizes, dtype=np.int8),
+        "results": np.array(results, dtype=np.float32),
+        "player_count": np.array(len(player_ids)),
+    }
+
+
+def load_games():  # type: () -> Dict[str, Any]
+    """
+    returns the encoded games, re-encoding them when the log archive is
+    newer than the cached encoding
+    """
+    if (not os.path.isfile(GAMES_FILE) or os.path.getmtime(GAMES_FILE) <
+            os.path.getmtime(log_archive.ARCHIVE_FILE)):
+        np.savez(GAMES_FILE, **encode_games())
+    with np.load(GAMES_FILE) as cached:
+        return {k: cached[k] for k in cached.files}
+
+
+def init_worker(encoded):  # type: (Dict[str, Any]) -> None
+    games.update(encoded)
+
+
+def run_trial(args):  # type: (Tuple[Trial, float]) -> TrialResult
+    """
+    replays every game with one set of parameters, scoring the predictions
+    made for the held out games
+    """
+    trial, holdout = args
+    env = trueskill.TrueSkill(mu=trial.mu,
+                              sigma=trial.sigma,
+                              beta=trial.beta,
+                              tau=trial.tau,
+                              draw_probability=trial.draw_probability)
+    ratings = [env.create_rating()] * int(games["player_count"])
+    players = games["players"].tolist()
+    starts = games["starts"].tolist()
+    red_sizes = games["red_sizes"].tolist()
+    blue_sizes = games["blue_sizes"].tolist()
+    results = games["results"].tolist()
+    first_test = int(len(results) * (1 - holdout))
+
+    log_loss = 0.0
+    correct = 0
+    scored = 0
+    for g, result in enumerate(results):
+        red_end = starts[g] + red_sizes[g]
+        red = players[starts[g]:red_end]
+        blue = players[red_end:red_end + blue_sizes[g]]
+        red_ratings = [ratings[i] for i in red]
+        blue_ratings = [ratings[i] for i in blue]
+
+        if g >= first_test and result != 0.5:
+            mu_diff = (sum(r.mu for r in red_ratings) -
+                       sum(r.mu for r in blue_ratings))
+            spread = math.sqrt((len(red) + len(blue)) * trial.beta**2 +
+                               sum(r.sigma**2
+                                   for r in red_ratings + blue_ratings))
+            red_win = 0.5 * (1 + math.erf(mu_diff / (spread * math.sqrt(2))))
+            red_win = min(max(red_win, 1e-12), 1 - 1e-12)
+            log_loss -= math.log(red_win if result else 1 - red_win)
+            correct += (red_win > 0.5) == (result == 1)
+            scored += 1
+
+        ranks = [0, 0] if result == 0.5 else ([0, 1] if result else [1, 0])
+        new_red, new_blue = env.rate([red_ratings, blue_ratings], ranks=ranks)
+        for i, r in zip(red, new_red):
+            ratings[i] = r
+        for i, r in zip(blue, new_blue):
+            ratings[i] = r
+
+    if not scored:
+        return TrialResult(trial, float("nan"), float("nan"), 0)
+    return TrialResult(trial, log_loss / scored, correct / scored, scored)
+
+
+def main():
+    defaults = trueskill.TrueSkill()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--mu", type=float, nargs="+", default=[defaults.mu])
+    parser.add_argument("--sigma",
+                        type=float,
+                        nargs="+",
+                        default=[defaults.sigma / 2, defaults.sigma])
+    parser.add_argument("--beta",
+                        type=float,
+                        nargs="+",
+                        default=[defaults.beta / 2, defaults.beta,
+                                 defaults.beta * 2])
+    parser.add_argument("--tau",
+                        type=float,
+                        nargs="+",
+                        default=[defaults.tau, defaults.tau * 4])
+    parser.add_argument("--draw",
+                        type=float,
+                        nargs="+",
+                        default=[0.05, defaults.draw_probability])
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+
+    encoded = load_games()
+    print(len(encoded["results"]), "games,", int(encoded["player_count"]),
+          "players")
+
+    trials = [
+        (Trial(*params), args.holdout) for params in itertools.product(
+            args.mu, args.sigma, args.beta, args.tau, args.draw)
+    ]
+    with Pool(args.processes, initializer=init_worker,
+              initargs=(encoded, )) as pool:
+        results = pool.map(run_trial, trials)
+
+    results.sort(key=lambda r: (math.isnan(r.log_loss), r.log_loss))
+    print("mu, sigma, beta, tau, draw_probability, log_loss, accuracy")
+    for r in results:
+        print("{:.3f},{:.3f},{:.3f},{:.4f},{:.3f},{:.4f},{:.3f}".format(
+            *r.trial, r.log_loss, r.accuracy))
+    print("best:", results[0].trial)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the crawlers end to end against the local fixture server (see
+fixture_server.py), with no network.  archive_logs.py downloads a
+synthetic logs.tf, and with --rgl get_rgl_matches.py crawls a directory of
+recorded rgl.gg fixtures.  Each crawler runs in a temporary directory with
+its politeness delays set by --delay and --error-delay, and the crawl time,
+logs per second and the faults the server injected are reported.
+
+usage: bench_crawl.py [--synthetic 200] [--latency SECONDS]
+                      [--error-rate P] [--timeout-rate P] [--delay SECONDS]
+                      [--error-delay SECONDS] [--timeout SECONDS]
+                      [--rgl FIXTURE_DIR]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+import log_archive
+from fixture_server import FixtureServer
+
+
+def run_crawler(server, command, workdir):
+    # type: (FixtureServer, List[str], str) -> float
+    """
+    runs a crawler against the server and returns the crawl time
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + command + ["--base-url", server.url()],
+                   cwd=workdir,
+                   stdout=subprocess.DEVNULL,
+                   check=True)
+    return time.perf_counter() - start
+
+
+def report(label, elapsed, server):  # type: (str, float, FixtureServer) -> None
+    print("{:<16} {:>8.2f}s  {} requests, {} errors, {} timeouts".format(
+        label, elapsed, server.counts["requests"], server.counts["errors"],
+        server.counts["timeouts"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--error-delay", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--rgl")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    fixtures = os.path.abspath(args.rgl) if args.rgl else None
+    server = FixtureServer(("127.0.0.1", 0),
+                           fixtures=fixtures,
+                           synthetic=args.synthetic,
+                           latency=args.latency,
+                           error_rate=args.error_rate,
+                           timeout_rate=args.timeout_rate,
+                           hang=args.timeout * 2,
+                           seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        elapsed = run_crawler(server, [
+            os.path.join(here, "archive_logs.py"), "--delay",
+            str(args.delay), "--error-delay",
+            str(args.error_delay), "--timeout",
+            str(args.timeout)
+        ], tmp)
+        archived = sum(1 for _ in log_archive.iter_headers(
+            os.path.join(tmp, log_archive.ARCHIVE_FILE)))
+        report("archive_logs", elapsed, server)
+        print("{} of {} logs archived, {:.1f} logs/s".format(
+            archived, args.synthetic, archived / elapsed))
+
+        if args.rgl:
+            server.counts = dict.fromkeys(server.counts, 0)
+            elapsed = run_crawler(server, [
+                os.path.join(here, "get_rgl_matches.py"), "--delay",
+                str(args.delay), "--error-delay",
+                str(args.error_delay), "--timeout",
+                str(args.timeout)
+            ], tmp)
+            report("get_rgl_matches", elapsed, server)
+
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
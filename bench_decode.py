@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the ways of reading the id, date, map and length of every log:
+a full json.loads of each line of game_logs.json, a full decode of each
+frame of the log archive, and the header-only fast path of the archive.
+
+If no game_logs.json is given, a synthetic one is built by repeating the
+logs in test/ with new ids.
+
+usage: bench_decode.py [game_logs.json] [--synthetic N]
+"""
+
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+from typing import Callable, List, Tuple
+import log_archive
+
+
+def timed(label, func):  # type: (str, Callable[[], int]) -> float
+    start = time.perf_counter()
+    count = func()
+    elapsed = time.perf_counter() - start
+    print("{:<32} {:>8} logs {:>8.3f}s {:>10.0f} logs/s".format(
+        label, count, elapsed, count / elapsed if elapsed else 0))
+    return elapsed
+
+
+def make_synthetic(filename, count):  # type: (str, int) -> None
+    samples = []  # type: List[dict]
+    for sample_file in sorted(glob.glob("test/*.json")):
+        with open(sample_file, encoding="utf-8") as f:
+            samples.append(json.load(f))
+
+    with open(filename, "w", encoding="utf-8") as f:
+        for i in range(count):
+            game_log = dict(samples[i % len(samples)])
+            game_log["id"] = i
+            f.write(json.dumps(game_log) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?")
+    parser.add_argument("--synthetic", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = args.source
+        if not source:
+            source = os.path.join(tmp, "game_logs.json")
+            make_synthetic(source, args.synthetic)
+
+        archive_file = os.path.join(tmp, "game_logs.dat")
+        with open(source, encoding="utf-8") as f, \
+                open(archive_file, "wb") as archive:
+            for line in f:
+                log_archive.append_log(archive,
+                                       log_archive.project(json.loads(line)))
+
+        print("json backend:", log_archive.loads.__module__)
+        print("game_logs.json {:.1f} MB, archive {:.1f} MB".format(
+            os.path.getsize(source) / 2**20,
+            os.path.getsize(archive_file) / 2**20))
+
+        def json_lines():  # type: () -> int
+            headers = []  # type: List[Tuple]
+            with open(source, encoding="utf-8") as f:
+                for line in f:
+                    g = json.loads(line)
+                    headers.append((g["id"], g["info"]["date"],
+                                    g["info"]["map"], g["length"]))
+            return len(headers)
+
+        def full_decode():  # type: () -> int
+            headers = [(g["id"], g["info"]["date"], g["info"]["map"],
+                        g["length"])
+                       for g in log_archive.iter_logs(archive_file)]
+            return len(headers)
+
+        def header_scan():  # type: () -> int
+            return len(list(log_archive.iter_headers(archive_file)))
+
+        baseline = timed("json.loads game_logs.json", json_lines)
+        timed("full decode of archive", full_decode)
+        fast = timed("header-only scan of archive", header_scan)
+        print("header-only speedup over json.loads: {:.1f}x".format(
+            baseline / fast))
+
+
+if __name__ == "__main__":
+    main()
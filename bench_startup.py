@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the startup time of every entry point: the time for a fresh
+interpreter to import the script's module, less the time to start an
+interpreter that imports nothing.  Each import is timed several times and
+the fastest run is reported.  --top N also lists the N slowest imports of
+each script, from python -X importtime.
+
+usage: bench_startup.py [script.py ...] [--runs 5] [--top N]
+"""
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+
+def entry_points():  # type: () -> List[str]
+    """
+    returns the scripts with a main function, which can be imported
+    without running them
+    """
+    scripts = []
+    for filename in sorted(glob.glob("*.py")):
+        with open(filename, encoding="utf-8") as f:
+            source = f.read()
+        if "def main(" in source and "__name__ == \"__main__\"" in source:
+            scripts.append(filename)
+    return scripts
+
+
+def startup_time(code, runs):  # type: (str, int) -> Optional[float]
+    """
+    returns the fastest time to run python -c code, or None if it fails
+    """
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        if subprocess.run([sys.executable, "-c", code],
+                          stderr=subprocess.DEVNULL).returncode:
+            return None
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def slowest_imports(module, count):
+    # type: (str, int) -> List[Tuple[int, str]]
+    """
+    returns the cumulative microseconds and names of the slowest modules
+    imported directly by a module
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    # modules are listed after the modules they import, indented by two
+    # spaces for each level of nesting
+    imports = []  # type: List[Tuple[int, str]]
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+        name = fields[2].strip()
+        if depth == 0:
+            if name == module:
+                return sorted(imports, reverse=True)[:count]
+            imports = []
+        elif depth == 1:
+            imports.append((int(fields[1]), name))
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scripts", nargs="*")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0)
+    args = parser.parse_args()
+
+    baseline = startup_time("pass", args.runs) or 0.0
+    print("interpreter startup {:.1f} ms".format(1000 * baseline))
+    for script in args.scripts or entry_points():
+        module = os.path.splitext(os.path.basename(script))[0]
+        elapsed = startup_time("import " + module, args.runs)
+        if elapsed is None:
+            print("{:<24} import failed".format(script))
+            continue
+        elapsed -= baseline
+        print("{:<24} {:>8.1f} ms".format(script, 1000 * elapsed))
+        for micros, name in slowest_imports(module, args.top):
+            print("    {:<20} {:>8.1f} ms".format(name, micros / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Compares player mmr with the rgl division players are rostered in.  For each
+division it computes the spread of mmr, and for each pair of neighbouring
+divisions with players the mmr cut point that puts the fewest players on
+the wrong side, along with the fraction of players that are still on the
+wrong side (the overlap).
+
+The results are cached in calibration_cache.json, keyed by fingerprints of
+the input files, so they are only recomputed when the data changes.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Tuple
+import numpy as np  # type: ignore
+
+SCORES_FILE = "player_scores.csv"
+LEAGUES_FILE = "player_teamid_league.csv"
+CACHE_FILE = "calibration_cache.json"
+
+# divisions from lowest to highest
+LEAGUE_NAMES = [
+    "newcomer", "open", "intermediate", "main", "advanced", "invite"
+]
+QUANTILES = np.array([0.05, 0.25, 0.5, 0.75, 0.95])
+QUANTILE_NAMES = ["q05", "q25", "median", "q75", "q95"]
+HISTOGRAM_BINS = np.arange(51)
+
+
+def fingerprint(filename):  # type: (str) -> str
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return "{}:{}".format(os.path.getsize(filename), digest.hexdigest())
+
+
+def load_rgl_scores(scores_file=SCORES_FILE, leagues_file=LEAGUES_FILE):
+    # type: (str, str) -> Tuple[Any, Any]
+    """
+    returns the mmr and division number of every player that has both a
+    rating and an rgl division.  Players listed in more than one division
+    are counted in the last one listed.
+    """
+    scores = np.loadtxt(scores_file,
+                        delimiter=",",
+                        dtype=[("id", "u8"), ("mmr", "f8")],
+                        ndmin=1)
+    leagues = np.loadtxt(leagues_file,
+                         delimiter=",",
+                         dtype=[("id", "u8"), ("team", "i8"),
+                                ("league", "U32")],
+                         ndmin=1)
+
+    league_codes = np.full(len(leagues), -1)
+    for code, name in enumerate(LEAGUE_NAMES):
+        league_codes[leagues["league"] == name] = code
+
+    # keeping the last division listed for each player
+    league_ids, last = np.unique(leagues["id"][::-1], return_index=True)
+    league_codes = league_codes[::-1][last]
+
+    order = np.argsort(scores["id"])
+    score_ids = scores["id"][order]
+    positions = np.searchsorted(score_ids, league_ids)
+    positions[positions == len(score_ids)] = 0
+    rated = (score_ids[positions] == league_ids) & (league_codes >= 0)
+
+    return scores["mmr"][order][positions[rated]], league_codes[rated]
+
+
+def best_cut(lower, upper):  # type: (Any, Any) -> Tuple[float, float]
+    """
+    finds the mmr that best separates two sorted arrays of scores, returning
+    the cut point and the fraction of players on the wrong side of it.
+    """
+    candidates = np.concatenate([lower, upper])
+    wrong_lower = len(lower) - np.searchsorted(lower, candidates, "left")
+    wrong_upper = np.searchsorted(upper, candidates, "left")
+    errors = wrong_lower + wrong_upper
+    best = int(np.argmin(errors))
+    return float(candidates[best]), float(errors[best] / len(candidates))
+
+
+def calibrate(mmr, codes):  # type: (Any, Any) -> Dict[str, List]
+    counts = np.bincount(codes, minlength=len(LEAGUE_NAMES))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_mmr = mmr[np.lexsort((mmr, codes))]
+
+    # interpolated quantiles of every division at once
+    positions = starts[:, None] + np.maximum(counts[:, None] - 1,
+                                             0) * QUANTILES[None, :]
+    low = np.floor(positions).astype(int)
+    high = np.minimum(np.ceil(positions).astype(int), len(sorted_mmr) - 1)
+    low = np.minimum(low, len(sorted_mmr) - 1)
+    fraction = positions - np.floor(positions)
+    quantiles = (sorted_mmr[low] * (1 - fraction) +
+                 sorted_mmr[high] * fraction) if len(sorted_mmr) else None
+    sums = np.bincount(codes, weights=mmr, minlength=len(LEAGUE_NAMES))
+
+    divisions = []  # type: List[Dict]
+    groups = []
+    for code, name in enumerate(LEAGUE_NAMES):
+        group = sorted_mmr[starts[code]:starts[code] + counts[code]]
+        groups.append(group)
+        if not len(group):
+            continue
+        division = {
+            "name": name,
+            "count": int(counts[code]),
+            "min": float(group[0]),
+            "max": float(group[-1]),
+            "mean": float(sums[code] / counts[code]),
+        }  # type: Dict[str, Any]
+        for qname, value in zip(QUANTILE_NAMES, quantiles[code]):
+            division[qname] = float(value)
+        divisions.append(division)
+
+    # divisions without players are skipped, so that their neighbours are
+    # still compared
+    cuts = []  # type: List[Dict]
+    present = [code for code in range(len(LEAGUE_NAMES)) if counts[code]]
+    for lower, upper in zip(present, present[1:]):
+        cut, overlap = best_cut(groups[lower], groups[upper])
+        cuts.append({
+            "lower": LEAGUE_NAMES[lower],
+            "upper": LEAGUE_NAMES[upper],
+            "cut": cut,
+            "overlap": overlap,
+        })
+
+    histogram, _ = np.histogram(mmr, bins=HISTOGRAM_BINS)
+    return {
+        "divisions": divisions,
+        "cuts": cuts,
+        "histogram": [int(c) for c in histogram],
+    }
+
+
+def get_calibration(scores_file=SCORES_FILE,
+                    leagues_file=LEAGUES_FILE,
+                    cache_file=CACHE_FILE):
+    # type: (str, str, str) -> Dict[str, List]
+    """
+    returns the calibration for the input files, from the cache when the
+    files haven't changed since it was computed.
+    """
+    key = [fingerprint(scores_file), fingerprint(leagues_file)]
+    if os.path.isfile(cache_file):
+        with open(cache_file, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["calibration"]
+
+    result = calibrate(*load_rgl_scores(scores_file, leagues_file))
+    with open(cache_file, "w", encoding="utf-8") as f:
+        json.dump({"key": key, "calibration": result}, f)
+    return result
+
+
+def main():
+    result = get_calibration()
+    print("league, count, min, q05, median, q95, max, avg")
+    for d in result["divisions"]:
+        print("{},{},{:.1f},{:.1f},{:.1f},{:.1f},{:.1f},{:.1f}".format(
+            d["name"], d["count"], d["min"], d["q05"], d["median"],
+            d["q95"], d["max"], d["mean"]))
+
+    print("lower, upper, cut, overlap")
+    for c in result["cuts"]:
+        print("{},{},{:.1f},{:.1%}".format(c["lower"], c["upper"], c["cut"],
+                                           c["overlap"]))
+
+
+if __name__ == "__main__":
+    main()
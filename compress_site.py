@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Writes a gzip and a brotli compressed copy next to each text file of the
+site in html/, e.g. html/index.html.gz and html/index.html.br, so the web
+server can send them as they are (nginx's gzip_static and brotli_static)
+instead of compressing every response.  The brotli copies need the brotli
+module, and are left out without it.
+
+Files are only compressed again when their contents changed.  The sha1 of
+each file is kept in html/manifest.json, which is also the manifest of
+content hashes for cache-busting urls.  The copies of files that were
+removed are removed too.
+
+usage: compress_site.py [--jobs N] [--rebuild]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+SITE_DIR = "html"
+MANIFEST_FILE = os.path.join(SITE_DIR, "manifest.json")
+COMPRESSED_SUFFIXES = (".gz", ".br")
+COMPRESSIBLE = {".html", ".json", ".css", ".js", ".svg", ".txt"}
+
+
+def site_files():  # type: () -> List[str]
+    """
+    returns the compressible files of the site, relative to SITE_DIR
+    """
+    files = []  # type: List[str]
+    for root, _, names in os.walk(SITE_DIR):
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), SITE_DIR)
+            if (os.path.splitext(name)[1] in COMPRESSIBLE
+                    and path != os.path.relpath(MANIFEST_FILE, SITE_DIR)):
+                files.append(path.replace(os.sep, "/"))
+    return sorted(files)
+
+
+def write_file(path, data):  # type: (str, bytes) -> None
+    # written to a temporary file first so the server never sends half of it
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def compress_file(task):
+    # type: (Tuple[str, Optional[str]]) -> Tuple[str, str, bool]
+    """
+    compresses a file of the site unless its sha1 is the given one and its
+    compressed copies exist, and returns the file, its sha1 and whether it
+    was compressed
+    """
+    name, old_hash = task
+    path = os.path.join(SITE_DIR, name)
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    suffixes = COMPRESSED_SUFFIXES if brotli else (".gz", )
+    if digest == old_hash and all(
+            os.path.isfile(path + s) for s in suffixes):
+        return name, digest, False
+
+    # mtime=0 so that the same contents always compress to the same bytes
+    write_file(path + ".gz", gzip.compress(data, 9, mtime=0))
+    if brotli:
+        write_file(path + ".br", brotli.compress(data))
+    elif os.path.isfile(path + ".br"):
+        # an old copy would be sent in place of the new contents
+        os.remove(path + ".br")
+    return name, digest, True
+
+
+def read_manifest():  # type: () -> Dict[str, str]
+    if not os.path.isfile(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def update(files=None, jobs=None, rebuild=False):
+    # type: (Optional[Iterable[str]], Optional[int], bool) -> int
+    """
+    compresses the files of the site that changed, or only the given files,
+    in jobs processes, and returns the number of files compressed.  Files
+    are given by their path, like "html/index.html".
+    """
+    manifest = read_manifest()
+    # the hashes the files are compared with
+    known = {} if rebuild else dict(manifest)
+    if files is None:
+        names = site_files()
+        for removed in set(manifest) - set(names):
+            for suffix in COMPRESSED_SUFFIXES:
+                path = os.path.join(SITE_DIR, removed) + suffix
+                if os.path.isfile(path):
+                    os.remove(path)
+            del manifest[removed]
+    else:
+        names = [
+            os.path.relpath(f, SITE_DIR).replace(os.sep, "/") for f in files
+        ]
+
+    tasks = [(name, known.get(name)) for name in names]
+    if jobs == 1:
+        results = list(map(compress_file, tasks))
+    else:
+        with Pool(jobs) as pool:
+            results = pool.map(compress_file, tasks, chunksize=64)
+
+    compressed = 0
+    for name, digest, changed in results:
+        manifest[name] = digest
+        compressed += changed
+    with open(MANIFEST_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
+    return compressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="compress every file again")
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("brotli isn't installed, only writing gzip copies")
+    compressed = update(jobs=args.jobs, rebuild=args.rebuild)
+    print("compressed", compressed, "changed files")
+
+
+if __name__ == "__main__":
+    main()
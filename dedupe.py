@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Finds logs.tf logs of the same match.  The same match is often uploaded
+more than once, by the server and by a player, or as split halves and a
+combined log, and counting each copy would rate the match twice.
+
+Every log is fingerprinted by its map, the time span it covers, and a
+MinHash signature of its roster.  Logs that share a map and an exact
+roster and score, or whose signatures collide in a locality sensitive
+hashing band, are compared, and they are duplicates if their time spans
+overlap and their rosters mostly match.  The shorter log of a duplicate
+pair is flagged in the DuplicateLogs table of stats.db, and the rating and
+stats scripts skip flagged logs.
+
+Running this script rebuilds the index from the whole log archive.
+"""
+
+import hashlib
+import os
+import random
+import sqlite3
+from array import array
+from typing import Dict, Iterator, List, NamedTuple, Set, Tuple
+from steam_ids import id3_to_id64
+import log_archive
+import sql_commands
+
+SIGNATURE_SIZE = 32
+BANDS = 8
+ROWS = SIGNATURE_SIZE // BANDS
+MERSENNE_PRIME = (1 << 61) - 1
+DAY = 24 * 60 * 60
+
+# the estimated roster jaccard similarity and the fraction of the shorter
+# log's time span that must overlap for logs to be duplicates
+MIN_SIMILARITY = 0.6
+MIN_OVERLAP = 0.5
+
+_rng = random.Random(1729)
+HASH_PARAMS = [(_rng.randrange(1, MERSENNE_PRIME),
+                _rng.randrange(0, MERSENNE_PRIME))
+               for _ in range(SIGNATURE_SIZE)]
+
+create_fingerprints = """
+create table if not exists LogFingerprints
+(
+log_id int primary key,
+map text,
+start int,
+end int,
+roster_digest int,
+red_score int,
+blue_score int,
+signature blob
+);
+"""
+
+create_duplicates = """
+create table if not exists DuplicateLogs
+(
+log_id int primary key,
+duplicate_of int
+);
+"""
+
+Fingerprint = NamedTuple(
+    "Fingerprint",
+    [
+        ("log_id", int),
+        ("map", str),
+        ("start", int),
+        ("end", int),
+        ("roster_digest", int),
+        ("red_score", int),
+        ("blue_score", int),
+        ("signature", Tuple[int, ...]),
+    ],
+)
+
+
+def minhash(roster):  # type: (Set[int]) -> Tuple[int, ...]
+    return tuple(
+        min((a * pid + b) % MERSENNE_PRIME for pid in roster) & 0xffffffff
+        for a, b in HASH_PARAMS)
+
+
+def roster_digest(roster):  # type: (Set[int]) -> int
+    """
+    returns a 63 bit digest of a roster of steamid64s.  It's stored, so
+    unlike hash() it must be the same in every python version.
+    """
+    digest = hashlib.sha1(",".join(map(str, sorted(roster))).encode("ascii"))
+    return int.from_bytes(digest.digest()[:8], "big") & 0x7fffffffffffffff
+
+
+def fingerprint(game_log):  # type: (Dict) -> Fingerprint
+    roster = {id3_to_id64(id3) for id3 in game_log["players"]}
+    end = game_log["info"]["date"]
+    return Fingerprint(
+        game_log["id"],
+        game_log["info"]["map"],
+        end - game_log["length"],
+        end,
+        roster_digest(roster),
+        game_log["teams"]["Red"]["score"],
+        game_log["teams"]["Blue"]["score"],
+        minhash(roster) if roster else (0, ) * SIGNATURE_SIZE,
+    )
+
+
+def similarity(a, b):  # type: (Fingerprint, Fingerprint) -> float
+    """
+    estimates the jaccard similarity of two logs' rosters
+    """
+    return sum(x == y
+               for x, y in zip(a.signature, b.signature)) / SIGNATURE_SIZE
+
+
+def overlap(a, b):  # type: (Fingerprint, Fingerprint) -> float
+    """
+    the fraction of the shorter log's time span that the logs share
+    """
+    shared = min(a.end, b.end) - max(a.start, b.start)
+    shortest = min(a.end - a.start, b.end - b.start)
+    if shortest <= 0:
+        return 1.0 if shared >= 0 else 0.0
+    return max(shared, 0) / shortest
+
+
+class DuplicateIndex:
+    """
+    In memory index of log fingerprints.  Logs are bucketed by the day
+    they end on, so checking a log only looks at the buckets of its own
+    and neighbouring days.
+    """
+
+    def __init__(self):  # type: () -> None
+        self.logs = {}  # type: Dict[int, Fingerprint]
+        self.exact = {}  # type: Dict[Tuple, List[int]]
+        self.bands = {}  # type: Dict[Tuple, List[int]]
+
+    def _keys(self, fp, day):  # type: (Fingerprint, int) -> Iterator[Tuple]
+        yield ("exact", fp.map, fp.roster_digest, fp.red_score,
+               fp.blue_score, day)
+        for band in range(BANDS):
+            yield (fp.map, band, fp.signature[band * ROWS:(band + 1) * ROWS],
+                   day)
+
+    def add(self, fp):  # type: (Fingerprint) -> None
+        self.logs[fp.log_id] = fp
+        keys = self._keys(fp, fp.end // DAY)
+        self.exact.setdefault(next(keys), []).append(fp.log_id)
+        for key in keys:
+            self.bands.setdefault(key, []).append(fp.log_id)
+
+    def candidates(self, fp):  # type: (Fingerprint) -> Set[int]
+        exact = set()  # type: Set[int]
+        similar = set()  # type: Set[int]
+        for day in range(fp.end // DAY - 1, fp.end // DAY + 2):
+            keys = self._keys(fp, day)
+            exact.update(self.exact.get(next(keys), []))
+            for key in keys:
+                similar.update(self.bands.get(key, []))
+
+        duplicates = {
+            i
+            for i in exact if overlap(fp, self.logs[i]) > 0
+        }
+        duplicates.update(i for i in similar
+                          if similarity(fp, self.logs[i]) >= MIN_SIMILARITY
+                          and overlap(fp, self.logs[i]) >= MIN_OVERLAP)
+        duplicates.discard(fp.log_id)
+        return duplicates
+
+    def check(self, fp):  # type: (Fingerprint) -> List[Tuple[int, int]]
+        """
+        adds a log to the index and returns the (duplicate log id, kept log
+        id) pairs it creates.  The longer log of a pair is kept, and the
+        log already in the index is kept when they are the same length.
+        """
+        found = []  # type: List[Tuple[int, int]]
+        for other_id in sorted(self.candidates(fp)):
+            other = self.logs[other_id]
+            if fp.end - fp.start > other.end - other.start:
+                found.append((other_id, fp.log_id))
+            else:
+                found.append((fp.log_id, other_id))
+        self.add(fp)
+        return found
+
+
+def migrate_roster_hashes(con):  # type: (sqlite3.Connection) -> bool
+    """
+    fingerprints the archived logs again if LogFingerprints holds the
+    roster hashes from before roster_digest, which were python's hash() of
+    the roster and changed between python versions.  The duplicates found
+    are kept.  Returns whether there was anything to migrate.
+    """
+    columns = [
+        r[1] for r in con.execute("pragma table_info(LogFingerprints);")
+    ]
+    if "roster_hash" not in columns:
+        return False
+    con.execute("drop table LogFingerprints;")
+    con.execute(create_fingerprints)
+    if os.path.isfile(log_archive.ARCHIVE_FILE):
+        with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+            for header in log_archive.iter_headers():
+                fp = fingerprint(log_archive.read_log(archive, header.offset))
+                save(con, fp, [])
+    con.commit()
+    return True
+
+
+def connect():  # type: () -> sqlite3.Connection
+    con = sql_commands.connect()
+    migrate_roster_hashes(con)
+    con.execute(create_fingerprints)
+    con.execute(create_duplicates)
+    return con
+
+
+def load_index(con):  # type: (sqlite3.Connection) -> DuplicateIndex
+    index = DuplicateIndex()
+    for row in con.execute("select * from LogFingerprints;"):
+        index.add(Fingerprint(*row[:7], tuple(array("I", row[7]))))
+    return index
+
+
+def save(con, fp, duplicates):
+    # type: (sqlite3.Connection, Fingerprint, List[Tuple[int, int]]) -> None
+    con.execute(
+        "insert or replace into LogFingerprints values (?,?,?,?,?,?,?,?);",
+        fp[:7] + (array("I", fp.signature).tobytes(), ))
+    con.executemany("insert or replace into DuplicateLogs values (?, ?);",
+                    duplicates)
+
+
+def read_duplicates():  # type: () -> Set[int]
+    """
+    returns the ids of the logs flagged as duplicates
+    """
+    con = connect()
+    duplicates = {r[0] for r in con.execute("select log_id from DuplicateLogs;")}
+    con.close()
+    return duplicates
+
+
+def main():
+    con = connect()
+    con.execute("delete from LogFingerprints;")
+    con.execute("delete from DuplicateLogs;")
+    index = DuplicateIndex()
+    logs = 0
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for header in sorted(log_archive.iter_headers(),
+                             key=lambda h: h.date):
+            fp = fingerprint(log_archive.read_log(archive, header.offset))
+            save(con, fp, index.check(fp))
+            logs += 1
+    con.commit()
+    duplicates = con.execute("select count(*) from DuplicateLogs;").fetchone()
+    print(logs, "logs indexed,", duplicates[0], "duplicates found")
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
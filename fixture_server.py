@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for logs.tf and rgl.gg, so the crawlers can be tested and
+benchmarked without the network (see bench_crawl.py).
+
+Responses are replayed from a fixture directory holding one file per
+recorded path.  With --record the server forwards requests it has no
+fixture for to the real site and saves the responses, so a crawl through
+the server records the fixtures for later runs.  With --synthetic N the
+server instead plays a logs.tf with N recent logs, made from the sample
+logs in test/.
+
+Faults can be injected into every response: --latency adds a delay,
+--error-rate answers that fraction of requests with a 429 or 5xx error,
+and --timeout-rate holds that fraction of requests for --hang seconds,
+past the crawlers' timeouts.
+
+usage: fixture_server.py [--port 8000] [--fixtures DIR] [--record URL]
+                         [--synthetic N] [--latency SECONDS]
+                         [--error-rate P] [--timeout-rate P]
+                         [--hang SECONDS] [--seed SEED]
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+ERROR_STATUSES = [429, 500, 502, 503]
+# the sample logs synthetic logs are made from
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test")
+LOG_LIST_RE = re.compile(r"^/api/v1/log\b")
+LOG_RE = re.compile(r"^/json/([0-9]+)$")
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """
+    Serves fixtures with injected faults.  counts holds the number of
+    requests, replies, errors, timeouts and missing fixtures.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 fixtures=None,
+                 record=None,
+                 synthetic=0,
+                 latency=0.0,
+                 error_rate=0.0,
+                 timeout_rate=0.0,
+                 hang=30.0,
+                 seed=None):
+        # type: (Tuple[str, int], Optional[str], Optional[str], int, float, float, float, float, Optional[int]) -> None
+        super().__init__(address, FixtureHandler)
+        self.fixtures = fixtures
+        self.record = record
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(
+            ["requests", "replies", "errors", "timeouts", "missing"], 0)
+        self.samples = []  # type: List[Dict]
+        self.synthetic = synthetic
+        self.now = int(time.time())
+        if synthetic:
+            for sample_file in sorted(glob.glob(
+                    os.path.join(SAMPLE_DIR, "*.json"))):
+                with open(sample_file, encoding="utf-8") as f:
+                    self.samples.append(json.load(f))
+
+    def url(self):  # type: () -> str
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def count(self, key):  # type: (str) -> None
+        with self.lock:
+            self.counts[key] += 1
+
+    def fault(self):  # type: () -> Optional[str]
+        with self.lock:
+            roll = self.rng.random()
+            if roll < self.timeout_rate:
+                return "timeouts"
+            if roll < self.timeout_rate + self.error_rate:
+                return "errors"
+        return None
+
+    def synthetic_log(self, log_id):  # type: (int) -> Dict
+        sample = self.samples[log_id % len(self.samples)]
+        game_log = dict(sample)
+        game_log["info"] = dict(sample["info"],
+                                date=self.now - log_id * 4000)
+        return game_log
+
+    def synthetic_response(self, path):  # type: (str) -> Optional[bytes]
+        if LOG_LIST_RE.match(path):
+            logs = []
+            for i in range(1, self.synthetic + 1):
+                sample = self.samples[i % len(self.samples)]
+                logs.append({
+                    "id": i,
+                    "title": "synthetic log",
+                    "map": sample["info"]["map"],
+                    "date": self.now - i,
+                    "views": 0,
+                    "players": len(sample["players"]),
+                })
+            return json.dumps({
+                "success": True,
+                "results": len(logs),
+                "total": len(logs),
+                "logs": logs,
+            }).encode("utf-8")
+
+        log_match = LOG_RE.match(path)
+        if log_match and 0 < int(log_match.group(1)) <= self.synthetic:
+            return json.dumps(self.synthetic_log(int(
+                log_match.group(1)))).encode("utf-8")
+        return None
+
+    def fixture_file(self, path):  # type: (str) -> Optional[str]
+        if not self.fixtures:
+            return None
+        return os.path.join(self.fixtures, quote(path, safe=""))
+
+    def lookup(self, path, headers):
+        # type: (str, Dict[str, str]) -> Tuple[int, Optional[bytes]]
+        """
+        returns the status and body of the response to a path
+        """
+        if self.synthetic:
+            body = self.synthetic_response(path)
+            if body is not None:
+                return 200, body
+
+        filename = self.fixture_file(path)
+        if filename and os.path.isfile(filename):
+            with open(filename, "rb") as f:
+                return 200, f.read()
+
+        if not self.record:
+            return 404, None
+
+        try:
+            upstream = urlopen(Request(self.record + path, headers=headers),
+                               timeout=30)
+            body = upstream.read()
+        except HTTPError as e:
+            return e.code, None
+
+        if filename:
+            os.makedirs(self.fixtures, exist_ok=True)
+            with open(filename, "wb") as f:
+                f.write(body)
+        return 200, body
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    server = None  # type: FixtureServer
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.latency)
+
+        fault = server.fault()
+        if fault:
+            server.count(fault)
+        if fault == "timeouts":
+            time.sleep(server.hang)
+        elif fault == "errors":
+            status = server.rng.choice(ERROR_STATUSES)
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        user_agent = self.headers.get("User-Agent", "")
+        status, body = server.lookup(self.path, {"User-Agent": user_agent})
+        if body is None:
+            if status == 404:
+                server.count("missing")
+            self.send_error(status)
+            return
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            server.count("replies")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting
+            pass
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fixtures")
+    parser.add_argument("--record")
+    parser.add_argument("--synthetic", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=30.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = FixtureServer(("127.0.0.1", args.port), args.fixtures,
+                           args.record, args.synthetic, args.latency,
+                           args.error_rate, args.timeout_rate, args.hang,
+                           args.seed)
+    print("serving on", server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(server.counts)
+
+
+if __name__ == "__main__":
+    main()
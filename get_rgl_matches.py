@@ -2,23 +2,44 @@
 """
 Parses the RGL site to get match data including league, season, team,
 and player data.
+
+usage: get_rgl_matches.py [--base-url URL] [--delay SECONDS]
+                          [--error-delay SECONDS] [--timeout SECONDS]
+                          [--retries N]
+
+--base-url points the scraper at another rgl.gg server, like the fixture
+server in fixture_server.py, and --delay sets the pause between requests.
+A page that can't be read is tried again --retries times, --error-delay
+seconds apart, and then skipped.  The crawl stops if the region list
+can't be read.
 """
 
-from urllib.request import Request, urlopen
-from typing import Dict, Set, NamedTuple, Optional, List, Tuple
+from typing import (TYPE_CHECKING, Dict, Set, NamedTuple, Optional, List,
+                    Tuple)
+import argparse
+import csv
+import http.client
 import logging
 import time
 import re
 from datetime import datetime
-import bs4  # type: ignore
+from urllib.request import Request, urlopen
+import load_rgl
 
-logging.basicConfig(
-    format="%(asctime)s %(message)s",
-    filename="rgl_match_scraper.log",
-    level=logging.DEBUG,
-)
+if TYPE_CHECKING:
+    # bs4 is only imported when scraping, which the readers don't do
+    import bs4  # type: ignore
 
+RGL_URL = "https://rgl.gg"
 REQUEST_DELAY = 5
+ERROR_DELAY = 60
+TIMEOUT = 30
+RETRIES = 2
+HEADERS = {
+    "User-Agent":
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36" +
+    " (KHTML, like Gecko)"
+}
 TEAM_RE = re.compile(r"Team\.aspx.*t=([0-9]+)")
 PLAYER_RE = re.compile(r"PlayerProfile\.aspx.*p=([0-9]+)")
 LEAGUE_TABLE_RE = re.compile(r"/Public/LeagueTable\.aspx")
@@ -26,8 +47,8 @@ LEAGUE_ID_RE = re.compile(r"LeagueTable\.aspx.*g=([0-9]+)")
 MATCH_RE = re.compile(r"Match\.aspx\?.*m=([0-9]+)")
 RGL_DATE = re.compile("[0-9]{1,2}/[0-9]{1,2}/[0-9]{1,4}")
 
-Bs4Results = Optional[bs4.element.ResultSet]
-Bs4Tag = Optional[bs4.element.Tag]
+Bs4Results = Optional["bs4.element.ResultSet"]
+Bs4Tag = Optional["bs4.element.Tag"]
 
 seasons: Dict[int, str] = {}
 team_names:  Dict[int, str]= {}
@@ -75,94 +96,70 @@ RglMatch = NamedTuple(
 
 
 def read_player_entries():  # type: () -> List[RglPlayerEntry]
-    player_entries = []
-    with open("player_teams.csv", encoding="utf-8") as f:
-        for line in f:
-            pid, joined, left, tid, rid, season, league = line.split(",")
-
-            joined_timestamp = float(joined)
-            join_date = (None if not joined_timestamp else
-                         datetime.fromtimestamp(joined_timestamp))
-
-            left_timestamp = float(left)
-            left_date = (None if not left_timestamp else
-                         datetime.fromtimestamp(left_timestamp))
-
-            player_entries.append(
-                RglPlayerEntry(
-                    int(pid),
-                    join_date,
-                    left_date,
-                    int(tid),
-                    int(rid),
-                    int(season),
-                    int(league),
-                ))
+    con = load_rgl.connect()
+    player_entries = [
+        RglPlayerEntry(
+            pid,
+            None if not joined else datetime.fromtimestamp(joined),
+            None if not left else datetime.fromtimestamp(left),
+            tid,
+            rid,
+            season,
+            league,
+        ) for pid, joined, left, tid, rid, season, league in con.execute(
+            "select player_id, joined, left, team_id, region_id, " +
+            "season_id, league_id from RglPlayerTeams;")
+    ]
+    con.close()
     return player_entries
 
 
-def read_matches():  # type: () -> List[RglMatch]
-    csv_matches = []  # type: List[RglMatch]
-    with open("matches.csv", encoding="utf-8") as f:
-        for line in f:
-            if not line:
-                continue
-
-            # format(m.id, m.team1, m.team1_score, m.team2, m.team2_score, m.date, mapname)
-            fields = line.split(",")
-
-            team1_score = None  # type: Optional[float]
-            if not fields[2].strip() == "None":
-                team1_score = float(fields[2])
-
-            team2_score = None  # type: Optional[float]
-            if not fields[4].strip() == "None":
-                team2_score = float(fields[4])
-
-            match_date = None
-            if not fields[5].strip() == "None":
-                match_date = datetime.fromtimestamp(float(fields[5]))
-            maps = {m.strip() for m in fields[6].split(" ")}
-            csv_match_season_id = int(fields[7])
-
-            csv_matches.append(
-                RglMatch(
-                    int(fields[0]),  # match id
-                    match_date,
-                    maps,
-                    int(fields[1]),  # team 1
-                    team1_score,
-                    int(fields[3]),  # team 2
-                    team2_score,
-                    csv_match_season_id,
-                ))
-    return csv_matches
-
-
-def read_teams():  # type: () -> Dict
-    rgl_teams = {}
-    with open("rgl_teams.csv", encoding="utf-8") as f:
-        for line in f:
-            if not line:
-                continue
-            tid, name = line.split(",")
-            rgl_teams[int(tid)] = name
+def read_matches(season_id=None):
+    # type: (Optional[int]) -> List[RglMatch]
+    """
+    reads the rgl matches, optionally only those of one season
+    """
+    query = ("select rgl_id, match_time, maps, team1, team1_score, team2, " +
+             "team2_score, season_id from RglMatches")
+    params = ()  # type: Tuple
+    if season_id is not None:
+        query += " where season_id = ?"
+        params = (season_id, )
+
+    con = load_rgl.connect()
+    rgl_matches = [
+        RglMatch(
+            rgl_id,
+            None if match_time is None else datetime.fromtimestamp(match_time),
+            {m for m in maps.split(" ") if m},
+            team1,
+            team1_score,
+            team2,
+            team2_score,
+            season,
+        ) for rgl_id, match_time, maps, team1, team1_score, team2,
+        team2_score, season in con.execute(query, params)
+    ]
+    con.close()
+    return rgl_matches
+
+
+def read_teams():  # type: () -> Dict[int, str]
+    con = load_rgl.connect()
+    rgl_teams = dict(con.execute("select team_id, name from RglTeams;"))
+    con.close()
     return rgl_teams
 
 
 def read_seasons():  # type: () -> Dict[int, str]
     """
-    Reads the seasons contained in rgl_seasons.csv and returns
-    them as a dictionary mapping the ids to the names.
+    Reads the rgl seasons and returns them as a dictionary mapping the ids
+    to the names.
     """
-    csv_seasons = {}
-    with open("rgl_seasons.csv", encoding="utf-8") as f:
-        for line in f:
-            if not line:
-                continue
-            season_id, season_name = line.split(",")
-            csv_seasons[int(season_id)] = season_name
-    return csv_seasons
+    con = load_rgl.connect()
+    rgl_seasons = dict(con.execute("select season_id, name from RglSeasons;"))
+    con.close()
+    return rgl_seasons
 
 
 def row_to_player(tr):  # type: (bs4.element.Tag) -> Optional[RglPlayer]
@@ -273,16 +270,57 @@ def row_to_match(
     )
 
 
+def fetch_page(url, timeout, retries, error_delay):
+    # type: (str, float, int, float) -> Optional[str]
+    """
+    returns the html of an rgl page, or None if it still couldn't be read
+    after retries more tries.  HTTP errors, timeouts and truncated
+    responses are logged and tried again.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(error_delay)
+        try:
+            response = urlopen(Request(url, headers=HEADERS),
+                               timeout=timeout)
+            return response.read().decode("utf-8")
+        except (OSError, http.client.HTTPException, UnicodeDecodeError) as e:
+            logging.info("error reading {} (try {} of {}): {!r}".format(
+                url, attempt + 1, retries + 1, e))
+    return None
+
+
 def main():
-    h = {
-        "User-Agent":
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36" +
-        " (KHTML, like Gecko)"
-    }
-    r = Request("https://rgl.gg/Public/Regions.aspx", headers=h)
-    response = urlopen(r).read().decode("utf-8")
+    import bs4  # type: ignore
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default=RGL_URL)
+    parser.add_argument("--delay", type=float, default=REQUEST_DELAY)
+    parser.add_argument("--error-delay", type=float, default=ERROR_DELAY)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--retries", type=int, default=RETRIES)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        filename="rgl_match_scraper.log",
+        level=logging.DEBUG,
+    )
+
+    def fetch(url):  # type: (str) -> Optional[str]
+        return fetch_page(url, args.timeout, args.retries, args.error_delay)
+
+    response = fetch(args.base_url + "/Public/Regions.aspx")
+    if response is None:
+        print("error reading the rgl regions, the last crawl is kept")
+        return
     doc = bs4.BeautifulSoup(response, "html.parser")
 
+    # the team pages list every player and match of the team, so the files
+    # they are written to are started over on each crawl
+    for filename in (load_rgl.PLAYER_TEAMS_FILE, load_rgl.MATCHES_FILE):
+        open(filename, "w", encoding="utf-8").close()
+
     for l in doc.find_all("a", href=LEAGUE_TABLE_RE):
         season_id_match = re.search("s=([0-9]+)", l.get("href"))
         if season_id_match:
@@ -291,10 +329,13 @@ def main():
             seasons[season_id] = season_name
 
     for s in seasons:
-        time.sleep(REQUEST_DELAY)
-        league_table = "https://rgl.gg/Public/LeagueTable.aspx?s=" + str(s)
-        r = Request(league_table, headers=h)
-        league_table_string = urlopen(r).read().decode("utf-8")
+        time.sleep(args.delay)
+        league_table = "{}/Public/LeagueTable.aspx?s={}".format(
+            args.base_url, s)
+        league_table_string = fetch(league_table)
+        if league_table_string is None:
+            logging.info("skipping season {}".format(s))
+            continue
         league_table_doc = bs4.BeautifulSoup(league_table_string,
                                              "html.parser")
         team_links = league_table_doc.find_all("a", href=TEAM_RE)
@@ -317,22 +358,23 @@ def main():
                 team_regions[tid] = int(region_id_match.group(1))
 
     logging.info("{} team names found".format(len(team_names)))
-    with open("rgl_teams.csv", "w", encoding="utf-8") as f:
-        for t, n in team_names.items():
-            f.write("{},{}\n".format(t, n.replace(",", " ")))
+    with open(load_rgl.TEAMS_FILE, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(team_names.items())
 
     logging.info("{} regions found".format(len(team_regions)))
 
     logging.info("{} seasons found".format(len(seasons)))
-    with open("rgl_seasons.csv", "w", encoding="utf-8") as f:
-        for sid, name in seasons.items():
-            f.write("{},{}\n".format(sid, name.replace(",", " ")))
+    with open(load_rgl.SEASONS_FILE, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(seasons.items())
 
     for tid, rid in team_regions.items():
-        time.sleep(REQUEST_DELAY)
-        team_url = "https://rgl.gg/Public/Team.aspx?t={}&r={}".format(tid, rid)
-        r = Request(team_url, headers=h)
-        team_string = urlopen(r).read().decode("utf-8")
+        time.sleep(args.delay)
+        team_url = "{}/Public/Team.aspx?t={}&r={}".format(
+            args.base_url, tid, rid)
+        team_string = fetch(team_url)
+        if team_string is None:
+            logging.info("skipping team {}".format(tid))
+            continue
         team_doc = bs4.BeautifulSoup(team_string, "html.parser")
 
         logging.info(team_url)
@@ -353,7 +395,7 @@ def main():
         players = [row_to_player(i) for i in player_rows]
         valid_players = [p for p in players if p]  # type: List[RglPlayer]
         usernames.update({(p.id, p.name) for p in valid_players})
-        with open("player_teams.csv", "a", encoding="utf-8") as f:
+        with open(load_rgl.PLAYER_TEAMS_FILE, "a", encoding="utf-8") as f:
             for p in valid_players:
                 player_join_date = 0 if not p.joined else p.joined.timestamp()
                 player_leave_date = 0 if not p.left else p.left.timestamp()
@@ -373,7 +415,7 @@ def main():
         matches = [row_to_match(tr, team_seasons[tid]) for tr in match_rows]
         valid_matches = [m for m in matches if m]  # type: List[RglMatch]
 
-        with open("matches.csv", "a", encoding="utf-8") as f:
+        with open(load_rgl.MATCHES_FILE, "a", encoding="utf-8") as f:
             for m in valid_matches:
                 map_cell = " ".join(m.maps)
                 date_cell = "None"
@@ -401,13 +443,15 @@ def main():
                     match_season,
                 ))
 
-    with open("rgl_leagues.csv", "w", encoding="utf-8") as f:
-        for l, n in league_names.items():
-            f.write("{},{}\n".format(l, n.replace(",", " ")))
+    with open(load_rgl.LEAGUES_FILE, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(league_names.items())
+
+    with open(load_rgl.USERS_FILE, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerows(usernames)
 
-    with open("rgl_users.csv", "w", encoding="utf-8") as f:
-        for id64, username in usernames:
-            f.write("{},{}\n".format(id64, username.replace(",", " ")))
+    con = load_rgl.connect()
+    load_rgl.load_all(con)
+    con.close()
 
 
 if __name__ == "__main__":
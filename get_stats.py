@@ -1,24 +1,38 @@
 #!/usr/bin/env python3
 """
 This script generates user profile html pages from data in
-the game_logs.json file.
+the log archive.
+
+The profile stats are partial aggregates that can be merged, so the
+archive can be split into shards that are added up separately, either in
+--jobs processes or with --shard on other machines, which write the
+partial state of their shard as json to be combined with --merge.
+
+usage: get_stats.py [--jobs N]
+       get_stats.py --shard I/N [--partial FILE]
+       get_stats.py --merge FILE [FILE ...]
 """
 
+import argparse
 import json
-import copy
 import datetime
 import itertools
-from typing import Dict, Tuple, Optional, Any, Union, List, NamedTuple
+from multiprocessing import Pool
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from collections import namedtuple
-from steam.steamid import SteamID  # type: ignore
-import jinja2
+from steam_ids import id3_to_id64
 import link_match_logs
 import get_rgl_matches
 from parse_logs import get_midfight_survival
-
-player_mmr = {}  # type: Dict[int, float]
-stats = {}  # type: Dict[str, Dict[str, Any]]
-player_names = {}  # type: Dict[str, str]
+import dedupe
+import log_archive
+import similarity
+from accumulators import (LastValues, StatTable, LogHistogram, sample_stdev,
+                          welford_columns)
+from leaderboard import Leaderboard, OVERALL
+
+# the name of each player in their newest log
+player_names = LastValues()
 teammate_counts = {}  # type: Dict[str, Dict[str, int]]
 classnames = [
     "soldier",
@@ -31,10 +45,8 @@ classnames = [
     "demoman",
     "heavyweapons",
 ]
+class_numbers = {c: i for i, c in enumerate(classnames)}
 base_stats = [
-    "wins",
-    "losses",
-    "draws",
     "kills",
     "assists",
     "deaths",
@@ -44,21 +56,46 @@ base_stats = [
     "heal",
 ]
 
-StatVal = Union[int, float, List]
-
-base_player = {cname: {k: 0
-                       for k in base_stats}
-               for cname in classnames}  # type: Dict[str, Dict[str, StatVal]]
-for cnm in classnames:
-    base_player[cnm]["game_dpm"] = []
-base_player["medic"]["drops"] = 0
-base_player["medic"]["ubers"] = 0
-base_player["medic"]["mid_escapes"] = 0
-base_player["medic"]["mid_deaths"] = 0
-base_player["sniper"]["headshots_hit"] = 0
-base_player["sniper"]["sniper_kills"] = 0
-base_player["sniper"]["deaths_to_sniper"] = 0
-base_player["spy"]["backstabs"] = 0
+# stats of a single class, with one row per player and class
+class_stats_table = StatTable(base_stats + welford_columns("game_dpm"),
+                              len(classnames))
+
+# stats that logs.tf only gives for a player's whole game, and the class
+# they belong to.  Players are interned into both tables together, so a
+# player has the same index in each.
+player_stat_classes = {
+    "drops": "medic",
+    "ubers": "medic",
+    "mid_escapes": "medic",
+    "mid_deaths": "medic",
+    "headshots_hit": "sniper",
+    "sniper_kills": "sniper",
+    "deaths_to_sniper": "sniper",
+    "backstabs": "spy",
+}
+player_stats_table = StatTable(player_stat_classes)
+
+# the distribution of damage per minute in single games of each class
+class_game_dpm = {c: LogHistogram(1, 5000) for c in classnames}
+
+
+def intern_player(id3):  # type: (str) -> int
+    player_stats_table.intern(id3)
+    return class_stats_table.intern(id3)
+
+
+def get_player_stats(id3):  # type: (str) -> Dict[str, Dict[str, float]]
+    """
+    returns a player's stats for each class as a dictionary
+    """
+    index = player_stats_table.keys[id3]
+    player = {
+        c: class_stats_table.row(index * len(classnames) + i)
+        for i, c in enumerate(classnames)
+    }
+    for stat, class_name in player_stat_classes.items():
+        player[class_name][stat] = player_stats_table.get(index, stat)
+    return player
 
 MatchLogCombo = NamedTuple(
     "MatchLogCombo",
@@ -72,24 +109,10 @@ MatchLogCombo = NamedTuple(
 )
 
 player_matches = {}  # type: Dict[str, List[MatchLogCombo]]
-logs_tf_to_rgl = {
-    logstf: rglmatch
-    for rglmatch, logstf in link_match_logs.read_rgl_match_logs()
-}  # type: Dict[int, int]
 
-# matches rgl match id to the rgl season id
-rgl_match_seasons = {}  # type: Dict[int, int]
-for m in get_rgl_matches.read_matches():
-    if m.season:
-        rgl_match_seasons[m.id] = m.season
-
-rgl_seasons = {}  # type: Dict[int,str]
-with open("rgl_seasons.csv", encoding="utf-8") as f:
-    for line in f:
-        if not line:
-            continue
-        sid, sname = line.split(",")
-        rgl_seasons[int(sid)] = sname.strip()
+# the most played class of each player who played one enough, and the
+# players most like them on it
+similar_players = {}  # type: Dict[str, Tuple[str, List[similarity.Similar]]]
 
 
 def count_teammates(gamelog):
@@ -111,133 +134,311 @@ def count_teammates(gamelog):
             teammate_counts[user2_id3][user1_id3] = games_together
 
 
-with open("player_scores.csv", encoding="utf-8") as f:
-    for line in f:
-        if not line:
-            continue
-        id_field, mmr_field = line.split(",")
-        player_mmr[int(id_field)] = float(mmr_field)
-
-newest_log = None  # pylint: disable=C0103
-oldest_log = None  # pylint: disable=C0103
-games_played = 0  # pylint: disable=C0103
-
-with open("game_logs.json") as game_logs:
-    for line in game_logs:
-        games_played += 1
-        g = json.loads(line)
-        upload_date = datetime.datetime.fromtimestamp(g["info"]["date"])
-        if newest_log:
-            newest_log = max(newest_log, upload_date)
-        else:
-            newest_log = upload_date
+logs_tf_to_rgl = {}  # type: Dict[int, int]
+# matches rgl match id to the rgl season id
+rgl_match_seasons = {}  # type: Dict[int, int]
+rgl_seasons = {}  # type: Dict[int, str]
+
+games_played = 0
+newest_log = None  # type: Optional[datetime.datetime]
+oldest_log = None  # type: Optional[datetime.datetime]
+
+class_stat = namedtuple(
+    "class_stat",
+    "name kpm depm kapd dpm dtpm ds hrs game_dpm game_dpm_sd class_dpm_p50 "
+    "class_dpm_p90")
+
+
+def load_rgl_info():
+    logs_tf_to_rgl.clear()
+    logs_tf_to_rgl.update({
+        logstf: rglmatch
+        for rglmatch, logstf in link_match_logs.read_rgl_match_logs()
+    })
+
+    rgl_match_seasons.clear()
+    for m in get_rgl_matches.read_matches():
+        if m.season:
+            rgl_match_seasons[m.id] = m.season
+
+    rgl_seasons.clear()
+    rgl_seasons.update(get_rgl_matches.read_seasons())
+
+
+def open_leaderboards():
+    # type: () -> Tuple[Dict[str, Leaderboard], Dict[str, int]]
+    leaderboards = {
+        name: Leaderboard(name)
+        for name in [OVERALL] + [f.name for f in link_match_logs.RATED_FORMATS]
+    }
+    board_sizes = {name: len(b) for name, b in leaderboards.items()}
+    return leaderboards, board_sizes
+
+
+def add_game(g):
+    """
+    adds a game log to the profile stats
+    """
+    global games_played, newest_log, oldest_log
+    games_played += 1
+    uploaded = datetime.datetime.fromtimestamp(g["info"]["date"])
+    if newest_log is None or uploaded > newest_log:
+        newest_log = uploaded
+    if oldest_log is None or uploaded < oldest_log:
+        oldest_log = uploaded
+
+
+    for id3, name in g["names"].items():
+        # getting usernames
+        player_names.add(id3, name, (g["info"]["date"], g["id"]))
+
+        # updating rgl match info
+        if g["id"] in logs_tf_to_rgl:
+            if id3 not in player_matches:
+                player_matches[id3] = []
+            rgl_match_id = logs_tf_to_rgl[g["id"]]
+            rgl_season_id = rgl_match_seasons[rgl_match_id]
+
+            player_team = g["players"][id3]["team"]
+            enemy_team = "Red" if player_team == "Blue" else "Blue"
+            match_win = (g["teams"][player_team]["score"] >
+                         g["teams"][enemy_team]["score"])
+
+            player_matches[id3].append(
+                MatchLogCombo(
+                    g["id"],
+                    rgl_match_id,
+                    g["info"]["map"],
+                    rgl_seasons[rgl_season_id],
+                    match_win,
+                ))
+
+    count_teammates(g)
+    game_time = g["info"]["total_length"]
+
+    for id3, d in g["players"].items():
+        player_index = intern_player(id3)
+
+        for c in d["class_stats"]:
+            if c["type"] == "medic":
+                player_stats_table.add(player_index, "drops", d["drops"])
+                if "medigun" in d["ubertypes"]:
+                    player_stats_table.add(player_index, "ubers",
+                                           d["ubertypes"]["medigun"])
+
+                mid_escapes, mid_deaths = get_midfight_survival(id3, g)
+                player_stats_table.add(player_index, "mid_escapes",
+                                       mid_escapes)
+                player_stats_table.add(player_index, "mid_deaths",
+                                       mid_deaths)
+            elif c["type"] == "sniper":
+                player_stats_table.add(player_index, "headshots_hit",
+                                       d["headshots_hit"])
+
+                # these stats are used for the sniper vs sniper k/d ratio
+                sniper_kills = g["classkills"].get(id3,
+                                                   {}).get("sniper", 0)
+                deaths_to_sniper = g["classdeaths"].get(id3, {}).get(
+                    "sniper", 0)
+                player_stats_table.add(player_index, "sniper_kills",
+                                       sniper_kills)
+                player_stats_table.add(player_index, "deaths_to_sniper",
+                                       deaths_to_sniper)
+            elif c["type"] == "spy":
+                player_stats_table.add(player_index, "backstabs",
+                                       d["backstabs"])
+            elif c["type"] not in classnames:
+                continue
+
+            row = player_index * len(classnames) + class_numbers[c["type"]]
+            class_stats_table.add(row, "kills", c["kills"])
+            class_stats_table.add(row, "assists", c["assists"])
+            class_stats_table.add(row, "deaths", c["deaths"])
+            class_stats_table.add(row, "dmg", c["dmg"])
+            class_stats_table.add(row, "total_time", c["total_time"])
+            if c["total_time"]:
+                game_dpm = 60 * c["dmg"] / c["total_time"]
+                class_stats_table.add_sample(row, "game_dpm", game_dpm)
+                class_game_dpm[c["type"]].add(game_dpm)
+
+            estimated_heal = d["heal"] * c["total_time"] / game_time
+            class_stats_table.add(row, "heal", estimated_heal)
+
+            estimated_dt = d["dt"] * c["total_time"] / game_time
+            class_stats_table.add(row, "dt", estimated_dt)
+
+
+def clear_stats():  # type: () -> None
+    global games_played, newest_log, oldest_log
+    games_played = 0
+    newest_log = oldest_log = None
+    player_names.clear()
+    teammate_counts.clear()
+    player_matches.clear()
+    class_stats_table.clear()
+    player_stats_table.clear()
+    for hist in class_game_dpm.values():
+        hist.clear()
+
+
+def partial_state():  # type: () -> Dict[str, Any]
+    """
+    returns the profile stats added so far as a json serializable partial
+    state, to be combined with the states of other shards by merge_state
+    """
+    return {
+        "games_played": games_played,
+        "newest_log": newest_log and newest_log.timestamp(),
+        "oldest_log": oldest_log and oldest_log.timestamp(),
+        "player_names": player_names.dump(),
+        "teammate_counts": {k: dict(v) for k, v in teammate_counts.items()},
+        "player_matches": {k: list(v) for k, v in player_matches.items()},
+        "class_stats": class_stats_table.dump(),
+        "player_stats": player_stats_table.dump(),
+        "class_game_dpm": {c: h.dump() for c, h in class_game_dpm.items()},
+    }
+
+
+def merge_state(state):  # type: (Dict[str, Any]) -> None
+    """
+    adds a partial state from partial_state to the profile stats
+    """
+    global games_played, newest_log, oldest_log
+    games_played += state["games_played"]
+    if state["newest_log"] is not None:
+        newest = datetime.datetime.fromtimestamp(state["newest_log"])
+        oldest = datetime.datetime.fromtimestamp(state["oldest_log"])
+        newest_log = newest if newest_log is None else max(newest_log, newest)
+        oldest_log = oldest if oldest_log is None else min(oldest_log, oldest)
+
+    player_names.merge(LastValues.load(state["player_names"]))
+    for id3, counts in state["teammate_counts"].items():
+        player_counts = teammate_counts.setdefault(id3, {})
+        for teammate, games in counts.items():
+            player_counts[teammate] = player_counts.get(teammate, 0) + games
+    for id3, combos in state["player_matches"].items():
+        player_matches.setdefault(id3, []).extend(
+            MatchLogCombo(*c) for c in combos)
+
+    # both tables intern the other shard's players in the same order, so
+    # players keep the same index in each
+    class_stats_table.merge(StatTable.load(state["class_stats"]))
+    player_stats_table.merge(StatTable.load(state["player_stats"]))
+    for c, hist in state["class_game_dpm"].items():
+        class_game_dpm[c].merge(LogHistogram.load(hist))
+
+
+def shard_offsets(shards):  # type: (int) -> List[List[int]]
+    """
+    splits the logs of the archive into shards of consecutive logs, given
+    by their offsets
+    """
+    offsets = [h.offset for h in log_archive.iter_headers()]
+    return [
+        offsets[i * len(offsets) // shards:(i + 1) * len(offsets) // shards]
+        for i in range(shards)
+    ]
+
+
+def shard_state(offsets):  # type: (List[int]) -> str
+    """
+    adds up the profile stats of the archived logs at the given offsets,
+    leaving out duplicates, in place of the current ones, and returns their
+    partial state as json
+    """
+    clear_stats()
+    load_rgl_info()
+    duplicates = dedupe.read_duplicates()
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for offset in offsets:
+            g = log_archive.read_log(archive, offset)
+            if g["id"] not in duplicates:
+                add_game(g)
+    return json.dumps(partial_state())
+
+
+def add_archive():  # type: () -> None
+    """
+    adds the archived logs that aren't flagged as duplicates to the
+    profile stats
+    """
+    load_rgl_info()
+    duplicates = dedupe.read_duplicates()
+    for g in log_archive.iter_logs():
+        if g["id"] not in duplicates:
+            add_game(g)
+
+
+def find_similar_players():  # type: () -> None
+    """
+    indexes the stats of the players on each class and saves the indexes
+    (see similarity.py), and finds the players most like each player on
+    their most played class
+    """
+    # the steamid64s, names and features of the players of each class
+    rows = {c: ([], [], []) for c in classnames}  # type: Dict[str, Tuple]
+    main_class = {}  # type: Dict[str, str]
+    for id3 in player_stats_table.keys:
+        player = get_player_stats(id3)
+        most_played = 0.0
+        for c in classnames:
+            features = similarity.class_features(c, player[c])
+            if features is None:
+                continue
+            ids, names, class_features = rows[c]
+            ids.append(id3_to_id64(id3))
+            names.append(player_names.get(id3, str(id3_to_id64(id3))))
+            class_features.append(features)
+            if player[c]["total_time"] > most_played:
+                most_played = player[c]["total_time"]
+                main_class[id3] = c
+
+    indexes = {}  # type: Dict[str, similarity.ClassIndex]
+    for c, (ids, names, class_features) in rows.items():
+        indexes[c] = similarity.ClassIndex(c, ids, names, class_features)
+        indexes[c].save()
+    similar_players.clear()
+    for id3, c in main_class.items():
+        similar_players[id3] = (c, indexes[c].similar(id3_to_id64(id3)))
+
+
+def write_usernames():
+    search_dict = {n: str(id3_to_id64(i))
+                   for i, n in player_names.items()}  # type: Dict[str, str]
+
+    with open("html/usernames.json", "w", encoding="utf-8") as usernames_json:
+        usernames_json.write(json.dumps(search_dict))
+
+
+def profile_template():
+    import jinja2
+
+    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"),
+                                   autoescape=True)
+    return jinja_env.get_template("profile.html")
+
+
+def render_profile(id3, template, leaderboards, board_sizes):
+    """
+    writes the html profile of a player and returns its filename
+    """
+
+    s = get_player_stats(id3)
+    id64 = id3_to_id64(id3)
+    mmr = leaderboards[OVERALL].get_mmr(id64)
+    if mmr is None:
+        mmr = float("nan")
+    ranks = []
+    for name, board in leaderboards.items():
+        board_rank = board.rank(id64)
+        if board_rank:
+            ranks.append((name, ) + board_rank)
 
-        if oldest_log:
-            oldest_log = min(oldest_log, upload_date)
-        else:
-            oldest_log = upload_date
-
-        if g["teams"]["Red"]["score"] == g["teams"]["Blue"]["score"]:
-            match_draw = True
-        elif g["teams"]["Red"]["score"] > g["teams"]["Blue"]["score"]:
-            match_winner = "Red"
-        elif g["teams"]["Red"]["score"] < g["teams"]["Blue"]["score"]:
-            match_winner = "Blue"
-
-        for id3, name in g["names"].items():
-            # getting usernames
-            player_names[id3] = name
-
-            # updating rgl match info
-            if g["id"] in logs_tf_to_rgl:
-                if id3 not in player_matches:
-                    player_matches[id3] = []
-                rgl_match_id = logs_tf_to_rgl[g["id"]]
-                rgl_season_id = rgl_match_seasons[rgl_match_id]
-
-                player_team = g["players"][id3]["team"]
-                enemy_team = "Red" if player_team == "Blue" else "Blue"
-                match_win = (g["teams"][player_team]["score"] >
-                             g["teams"][enemy_team]["score"])
-
-                player_matches[id3].append(
-                    MatchLogCombo(
-                        g["id"],
-                        rgl_match_id,
-                        g["info"]["map"],
-                        rgl_seasons[rgl_season_id],
-                        match_win,
-                    ))
-
-        count_teammates(g)
-        game_time = g["info"]["total_length"]
-
-        for id3, d in g["players"].items():
-            if id3 not in stats:
-                stats[id3] = copy.deepcopy(base_player)
-
-            for c in d["class_stats"]:
-                if c["type"] == "medic":
-                    stats[id3]["medic"]["drops"] += d["drops"]
-                    if "medigun" in d["ubertypes"]:
-                        stats[id3]["medic"]["ubers"] += d["ubertypes"][
-                            "medigun"]
-
-                    mfs = get_midfight_survival(g, id3)
-                    if mfs:
-                        mid_escapes, mid_deaths = mfs
-                        stats[id3]["medic"]["mid_escapes"] += mid_escapes
-                        stats[id3]["medic"]["mid_deaths"] += mid_deaths
-                elif c["type"] == "sniper":
-                    stats[id3]["sniper"]["headshots_hit"] += d["headshots_hit"]
-
-                    # these stats are used for killing sniper vs sniper k/d ratio
-                    sniper_kills = g["classkills"].get(id3,
-                                                       {}).get("sniper", 0)
-                    deaths_to_sniper = g["classdeaths"].get(id3, {}).get(
-                        "sniper", 0)
-                    stats[id3]["sniper"]["sniper_kills"] += sniper_kills
-                    stats[id3]["sniper"][
-                        "deaths_to_sniper"] += deaths_to_sniper
-                elif c["type"] == "spy":
-                    stats[id3]["spy"]["backstabs"] += d["backstabs"]
-                elif c["type"] not in classnames:
-                    continue
-
-                stats[id3][c["type"]]["kills"] += c["kills"]
-                stats[id3][c["type"]]["assists"] += c["assists"]
-                stats[id3][c["type"]]["deaths"] += c["deaths"]
-                stats[id3][c["type"]]["dmg"] += c["dmg"]
-                stats[id3][c["type"]]["total_time"] += c["total_time"]
-                if c["total_time"]:
-                    stats[id3][c["type"]]["game_dpm"].append(c["dmg"] /
-                                                             c["total_time"])
-
-                estimated_heal = d["heal"] * c["total_time"] / game_time
-                stats[id3][c["type"]]["heal"] += estimated_heal
-
-                estimated_dt = d["dt"] * c["total_time"] / game_time
-                stats[id3][c["type"]]["dt"] += estimated_dt
-
-search_dict = {n: str(SteamID(i).as_64)
-               for i, n in player_names.items()}  # type: Dict[str, str]
-
-with open("html/usernames.json", "w", encoding="utf-8") as usernames_json:
-    usernames_json.write(json.dumps(search_dict))
-
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"),
-                               autoescape=True)
-profile_template = jinja_env.get_template("profile.html")
-class_stat = namedtuple("class_stat", "name kpm depm kapd dpm dtpm ds hrs")
-
-for id3, s in stats.items():
-    mmr = player_mmr.get(SteamID(id3).as_64, float("nan"))
     sorted_teammates = sorted([(teammate_counts[id3][a], a)
                                for a in teammate_counts[id3]],
                               reverse=True)
-    top_teammates = (sorted_teammates
-                     if len(sorted_teammates) < 10 else sorted_teammates[:10])
-    teammate_names = [(player_names[tid3], SteamID(tid3).as_64)
+    top_teammates = sorted_teammates[:10]
+    teammate_names = [(player_names[tid3], id3_to_id64(tid3))
                       for _, tid3 in top_teammates]
 
     total_kills = sum([a["kills"] for _, a in s.items()])
@@ -269,8 +470,13 @@ for id3, s in stats.items():
         dtpm = class_stats["dt"] / M
         ds = dpm - dtpm
         hrs = M / 60
+        game_dpm = class_stats["game_dpm_mean"]
+        game_dpm_sd = sample_stdev(class_stats, "game_dpm")
+        class_dpm = class_game_dpm[classname]
         player_class_stats.append(
-            class_stat(classname, kpm, depm, kapd, dpm, dtpm, ds, hrs))
+            class_stat(classname, kpm, depm, kapd, dpm, dtpm, ds, hrs,
+                       game_dpm, game_dpm_sd, class_dpm.quantile(0.5),
+                       class_dpm.quantile(0.9)))
 
     advanced_stats = []
     if "medic" in s and s["medic"]["total_time"] > 2 * 60:
@@ -284,7 +490,8 @@ for id3, s in stats.items():
         advanced_stats.append(("ubers / drops", drops_to_ubers))
 
         if s["medic"]["mid_escapes"] or s["medic"]["mid_deaths"]:
-            midfights = s["medic"]["mid_escapes"] + s["medic"]["mid_deaths"]
+            midfights = (s["medic"]["mid_escapes"] +
+                         s["medic"]["mid_deaths"])
             survival_pct = 100 * s["medic"]["mid_escapes"] / midfights
             advanced_stats.append(("Midfight Survival %", survival_pct))
 
@@ -296,26 +503,79 @@ for id3, s in stats.items():
         if s["sniper"]["deaths_to_sniper"] == 0:
             svs = float("nan")
         else:
-            svs = s["sniper"]["sniper_kills"] / s["sniper"]["deaths_to_sniper"]
+            svs = (s["sniper"]["sniper_kills"] /
+                   s["sniper"]["deaths_to_sniper"])
         advanced_stats.append(("SvS", svs))
 
     if "spy" in s and s["spy"]["total_time"] > 2 * 60:
         M = s["spy"]["total_time"] / 60
         advanced_stats.append(("backstabs / M", s["spy"]["backstabs"] / M))
 
-    profile_filename = "html/players/{}.html".format(SteamID(id3).as_64)
+    profile_filename = "html/players/{}.html".format(id3_to_id64(id3))
     with open(profile_filename, "w", encoding="utf-8") as html_profile:
         player_rgl_matches = player_matches.get(id3, [])
         html_profile.write(
-            profile_template.render(username=player_names[id3],
-                                    mmr=mmr,
-                                    classstats=player_class_stats,
-                                    advanced_stats=advanced_stats,
-                                    teammates=teammate_names,
-                                    games=games_played,
-                                    players=len(player_mmr),
-                                    rgl_matches=sorted(player_rgl_matches,
-                                                       reverse=True),
-                                    oldest=oldest_log,
-                                    newest=newest_log,
-                                    lifetime_stats=lifetime_stats))
+            template.render(username=player_names[id3],
+                            mmr=mmr,
+                            ranks=ranks,
+                            board_sizes=board_sizes,
+                            classstats=player_class_stats,
+                            advanced_stats=advanced_stats,
+                            teammates=teammate_names,
+                            games=games_played,
+                            players=board_sizes[OVERALL],
+                            rgl_matches=sorted(player_rgl_matches,
+                                               reverse=True),
+                            similar=similar_players.get(id3),
+                            oldest=oldest_log,
+                            newest=newest_log,
+                            lifetime_stats=lifetime_stats))
+    return profile_filename
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="add up this many shards of the archive in "
+                        "parallel")
+    parser.add_argument("--shard",
+                        help="only add up shard I of N, given as I/N, and "
+                        "write its partial state to --partial")
+    parser.add_argument("--partial", default="profile_stats.json")
+    parser.add_argument("--merge",
+                        nargs="+",
+                        metavar="PARTIAL",
+                        help="render the profiles from the partial states "
+                        "of all the shards instead of the archive")
+    args = parser.parse_args()
+
+    if args.shard:
+        shard, shards = (int(n) for n in args.shard.split("/"))
+        with open(args.partial, "w", encoding="utf-8") as f:
+            f.write(shard_state(shard_offsets(shards)[shard]))
+        return
+
+    if args.merge:
+        for filename in args.merge:
+            with open(filename, encoding="utf-8") as f:
+                merge_state(json.load(f))
+    elif args.jobs > 1:
+        with Pool(args.jobs) as pool:
+            for state in pool.imap(shard_state, shard_offsets(args.jobs)):
+                merge_state(json.loads(state))
+    else:
+        add_archive()
+
+    leaderboards, board_sizes = open_leaderboards()
+    write_usernames()
+    find_similar_players()
+
+    template = profile_template()
+    for id3 in player_stats_table.keys:
+        render_profile(id3, template, leaderboards, board_sizes)
+
+
+if __name__ == "__main__":
+    main()
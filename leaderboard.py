@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Leaderboards of player mmr, written by mmr_calc.py for all games and for
+each game format.  A leaderboard file holds the ratings sorted by mmr and
+by player id, so a player's mmr, rank and percentile are found with binary
+searches of the memory mapped file instead of sorting the ratings.
+
+Running this script renders the paginated leaderboard pages into
+html/leaderboard/.
+"""
+
+import mmap
+import os
+import struct
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List, Optional, Tuple
+import sql_commands
+import link_match_logs
+
+OVERALL = "overall"
+PAGE_SIZE = 100
+HEADER = struct.Struct("<Q")
+
+
+def leaderboard_file(name):  # type: (str) -> str
+    return "leaderboard_{}.bin".format(name)
+
+
+def write_leaderboard(name, ratings):  # type: (str, Dict[int, float]) -> None
+    """
+    writes the leaderboard file for a mapping of steamid64s to mmr.  The
+    file is a player count followed by four arrays: mmr in ascending
+    order, the ids in that order, the ids in ascending order, and the mmr in
+    that order.
+    """
+    by_mmr = sorted(ratings.items(), key=lambda r: (r[1], r[0]))
+    by_id = sorted(ratings.items())
+    count = len(ratings)
+    with open(leaderboard_file(name), "wb") as f:
+        f.write(HEADER.pack(count))
+        f.write(struct.pack("<{}d".format(count), *(r[1] for r in by_mmr)))
+        f.write(struct.pack("<{}Q".format(count), *(r[0] for r in by_mmr)))
+        f.write(struct.pack("<{}Q".format(count), *(r[0] for r in by_id)))
+        f.write(struct.pack("<{}d".format(count), *(r[1] for r in by_id)))
+
+
+class Leaderboard:
+    """
+    Read only view of a leaderboard file.  Ranks start at 1 for the highest
+    mmr.  Players with equal mmr share the best rank.
+    """
+
+    def __init__(self, name=OVERALL):  # type: (str) -> None
+        self.name = name
+        self.count = 0
+        self._map = None  # type: Optional[mmap.mmap]
+        filename = leaderboard_file(name)
+        if not os.path.isfile(filename) or not os.path.getsize(filename):
+            self.mmr = self.ids = self.sorted_ids = self.id_mmr = []
+            return
+
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (self.count, ) = HEADER.unpack_from(self._map, 0)
+        view = memoryview(self._map)[HEADER.size:]
+        size = 8 * self.count
+        self.mmr = view[:size].cast("d")
+        self.ids = view[size:2 * size].cast("Q")
+        self.sorted_ids = view[2 * size:3 * size].cast("Q")
+        self.id_mmr = view[3 * size:].cast("d")
+
+    def __len__(self):
+        return self.count
+
+    def get_mmr(self, player_id):  # type: (int) -> Optional[float]
+        i = bisect_left(self.sorted_ids, player_id)
+        if i < self.count and self.sorted_ids[i] == player_id:
+            return self.id_mmr[i]
+        return None
+
+    def rank_of_mmr(self, mmr):  # type: (float) -> int
+        return self.count - bisect_right(self.mmr, mmr) + 1
+
+    def percentile_of_mmr(self, mmr):  # type: (float) -> float
+        """
+        returns the percentage of players with a lower mmr
+        """
+        if not self.count:
+            return float("nan")
+        return 100 * bisect_left(self.mmr, mmr) / self.count
+
+    def rank(self, player_id):  # type: (int) -> Optional[Tuple[int, float]]
+        """
+        returns the rank and percentile of a player, or None if they aren't
+        on the leaderboard
+        """
+        mmr = self.get_mmr(player_id)
+        if mmr is None:
+            return None
+        return self.rank_of_mmr(mmr), self.percentile_of_mmr(mmr)
+
+    def page(self, number):  # type: (int) -> List[Tuple[int, int, float]]
+        """
+        returns the (rank, steamid64, mmr) entries on a page, counting pages
+        from 0
+        """
+        start = number * PAGE_SIZE
+        stop = min(start + PAGE_SIZE, self.count)
+        entries = []
+        for position in range(start, stop):
+            i = self.count - 1 - position
+            entries.append((self.rank_of_mmr(self.mmr[i]), self.ids[i],
+                            self.mmr[i]))
+        return entries
+
+    def pages(self):  # type: () -> int
+        return (self.count + PAGE_SIZE - 1) // PAGE_SIZE
+
+    def items(self):  # type: () -> Iterator[Tuple[int, float]]
+        return zip(self.sorted_ids, self.id_mmr)
+
+    def close(self):  # type: () -> None
+        if self._map:
+            for view in (self.mmr, self.ids, self.sorted_ids, self.id_mmr):
+                view.release()
+            self._map.close()
+
+
+def main():
+    import jinja2
+
+    con = sql_commands.connect()
+    cur = con.cursor()
+    cur.execute(sql_commands.create_users)
+    names = dict(cur.execute("select player_id, name from Users;"))
+    con.close()
+
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+    template = jinja_env.get_template("leaderboard.html")
+
+    boards = [OVERALL] + [f.name for f in link_match_logs.RATED_FORMATS]
+    for name in boards:
+        board = Leaderboard(name)
+        os.makedirs("html/leaderboard/" + name, exist_ok=True)
+        for number in range(board.pages()):
+            entries = [(rank, id64, names.get(id64, str(id64)), mmr)
+                       for rank, id64, mmr in board.page(number)]
+            page_file = "html/leaderboard/{}/{}.html".format(name, number)
+            with open(page_file, "w", encoding="utf-8") as f:
+                f.write(
+                    template.render(board=name,
+                                    boards=boards,
+                                    page=number,
+                                    pages=board.pages(),
+                                    entries=entries))
+        print(name, len(board), "players", board.pages(), "pages")
+        board.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
-
+"""
+Links logs.tf logs to the rgl matches they were played for, storing the
+links in the RglMatchLogs table of stats.db.  The logs and rgl matches
+that have already been considered are recorded, so each run only does
+work for new data.  Logs are compared with the rosters the teams had when
+the log was uploaded (see roster_index.py).
+"""
+
+import argparse
 from enum import Enum
-from typing import Dict, Set, List, Tuple
+from typing import Dict, FrozenSet, Set, List, Tuple
 from datetime import datetime, date, timedelta
 import get_rgl_matches
 from get_rgl_matches import RglMatch
-from mmr_calc import get_sorted_games
-from steam.steamid import SteamID  # type: ignore
+import log_archive
+import sql_commands
+from roster_index import RosterIndex
+from steam_ids import id3_to_id64
 
 DAY = timedelta(days=1)
+# the logs read between commits, so the other stages writing stats.db
+# aren't locked out for the whole scan
+COMMIT_LOGS = 1000
 
 
 class Tf2Format(Enum):
@@ -16,6 +29,12 @@ class Tf2Format(Enum):
     sixes = 2
     prolander = 3
     highlander = 4
+    # logs whose format can't be told, like logs without a length
+    other = 0
+
+
+# the formats with their own ratings and leaderboards
+RATED_FORMATS = [f for f in Tf2Format if f is not Tf2Format.other]
 
 
 def read_region_formats():  # type: () -> Dict[int, Tf2Format]
@@ -28,18 +47,21 @@ def read_region_formats():  # type: () -> Dict[int, Tf2Format]
 
 
 def read_rgl_match_logs():  # type: () -> List[Tuple[int, int]]
-    values = []
-    with open("rgl_match_logs.csv", encoding="utf-8") as rml:
-        for line in rml:
-            if not line:
-                continue
-            rgl_id, log_id = line.split(",")
-            values.append((int(rgl_id), int(log_id)))
+    """
+    returns the (rgl match id, logs.tf id) pairs found by this script
+    """
+    con = sql_commands.connect()
+    cur = con.cursor()
+    cur.execute(sql_commands.create_rgl_match_logs)
+    values = cur.execute("select rgl_id, log_id from RglMatchLogs;").fetchall()
+    con.close()
     return values
 
 
 def get_format(gamelog):  # type: (Dict) -> Tf2Format
     game_seconds = gamelog["length"]
+    if game_seconds <= 0:
+        return Tf2Format.other
     gamer_seconds = 0
     for _, player in gamelog["players"].items():
         for c in player["class_stats"]:
@@ -60,8 +82,7 @@ matches = {}  # type: Dict[int, RglMatch]
 format_matches = {i: set()
                   for i in Tf2Format}  # type: Dict[Tf2Format, Set[int]]
 match_dates = {}  # type: Dict[date, Set[int]]
-possible_logs = {}  # type: Dict[int, Set[int]]
-roster = {}  # type: Dict[int, Set[int]]
+rosters = RosterIndex([])
 map_matches = {}  # type: Dict[str, Set[int]]
 id64s = {}  # type: Dict[str, int]
 team_format = {}  # type: Dict[int, Tf2Format]
@@ -69,13 +90,13 @@ team_format = {}  # type: Dict[int, Tf2Format]
 
 def get_id64(id3):  # type: (str) -> int
     if id3 not in id64s:
-        id64s[id3] = SteamID(id3).as_64
+        id64s[id3] = id3_to_id64(id3)
     return id64s[id3]
 
 
 def team_match(
         red, blu, team1,
-        team2):  # type: (Set[int], Set[int], Set[int], Set[int]) -> bool
+        team2):  # type: (Set[int], Set[int], FrozenSet[int], FrozenSet[int]) -> bool
     red_ringers = len(red - team1)
     red_ringers2 = len(red - team2)
     blu_ringers = len(blu - team1)
@@ -94,14 +115,17 @@ def get_similar_maps(map_name):
     return matchids
 
 
-if __name__ == "__main__":
+def load_rgl_matches():  # type: () -> None
+    """
+    indexes the rgl matches by date, format, and map, and the team
+    rosters by time
+    """
+    global rosters
     region_format = read_region_formats()
-    for p in get_rgl_matches.read_player_entries():
-        if p.team_id in roster:
-            roster[p.team_id].add(p.id)
-        else:
-            roster[p.team_id] = {p.id}
+    player_entries = get_rgl_matches.read_player_entries()
+    for p in player_entries:
         team_format[p.team_id] = region_format[p.region_id]
+    rosters = RosterIndex(player_entries)
 
     for rgl_match in get_rgl_matches.read_matches():
         matches[rgl_match.id] = rgl_match
@@ -118,60 +142,142 @@ if __name__ == "__main__":
                 match_dates[md + DAY] = {rgl_match.id}
 
         if rgl_match.team1 in team_format:
-            match_format = team_format[rgl_match.team1]
+            format_matches[team_format[rgl_match.team1]].add(rgl_match.id)
         elif rgl_match.team2 in team_format:
-            match_format = team_format[rgl_match.team2]
+            format_matches[team_format[rgl_match.team2]].add(rgl_match.id)
 
-        format_matches[match_format].add(rgl_match.id)
         for rgl_map in rgl_match.maps:
             if rgl_map in map_matches:
                 map_matches[rgl_map].add(rgl_match.id)
             else:
                 map_matches[rgl_map] = {rgl_match.id}
 
-    for logstf in get_sorted_games():
-        if logstf["length"] < 120:  # skip game if it's too short
-            continue
-
-        log_match_date = datetime.fromtimestamp(logstf["info"]["date"]).date()
-        log_match_format = get_format(logstf)
-
-        matchdate_set = match_dates.get(log_match_date,
-                                        set())  # type: Set[int]
-        map_set = get_similar_maps(logstf["info"]["map"])
-
-        format_set = format_matches[log_match_format]  # type: Set[int]
-        rgl_possible_match_ids = format_set & matchdate_set & map_set
-
-        rgl_possible_matches = [matches[i] for i in rgl_possible_match_ids
-                                ]  # type: List[RglMatch]
-
-        red_roster = {
-            get_id64(i)
-            for i in logstf["players"] if logstf["players"][i]["team"] == "Red"
-        }
-        blue_roster = {
-            get_id64(i)
-            for i in logstf["players"]
-            if logstf["players"][i]["team"] == "Blue"
-        }
-
-        valid_rosters = [
-            i for i in rgl_possible_matches
-            if i.team1 in roster and i.team2 in roster
-        ]
-        valid_games = [
-            pm for pm in valid_rosters if team_match(
-                red_roster, blue_roster, roster[pm.team1], roster[pm.team2])
-        ]
-
-        for vg in valid_games:
-            if vg.id in valid_games:
-                possible_logs[vg.id].add(logstf["id"])
+
+def link_log(logstf, candidate_ids):  # type: (Dict, Set[int]) -> List[int]
+    """
+    returns the ids of the rgl matches, out of the candidates, that the
+    logs.tf log could be a game of.
+    """
+    log_match_date = datetime.fromtimestamp(logstf["info"]["date"]).date()
+    log_match_format = get_format(logstf)
+
+    matchdate_set = match_dates.get(log_match_date, set())  # type: Set[int]
+    map_set = get_similar_maps(logstf["info"]["map"])
+
+    format_set = format_matches[log_match_format]  # type: Set[int]
+    rgl_possible_match_ids = (format_set & matchdate_set & map_set
+                              & candidate_ids)
+
+    rgl_possible_matches = [matches[i] for i in rgl_possible_match_ids
+                            ]  # type: List[RglMatch]
+
+    red_roster = {
+        get_id64(i)
+        for i in logstf["players"] if logstf["players"][i]["team"] == "Red"
+    }
+    blue_roster = {
+        get_id64(i)
+        for i in logstf["players"] if logstf["players"][i]["team"] == "Blue"
+    }
+
+    log_time = logstf["info"]["date"]
+    linked = []  # type: List[int]
+    for pm in rgl_possible_matches:
+        team1 = rosters.roster_at(pm.team1, log_time)
+        team2 = rosters.roster_at(pm.team2, log_time)
+        if team1 and team2 and team_match(red_roster, blue_roster, team1,
+                                          team2):
+            linked.append(pm.id)
+    return linked
+
+
+def link(rebuild=False):  # type: (bool) -> Tuple[int, int, int]
+    """
+    links the logs and rgl matches added since the last run, or all of
+    them if rebuild, and returns the number of new logs, new rgl matches
+    and new links
+    """
+    con = sql_commands.connect()
+    cur = con.cursor()
+    cur.execute(sql_commands.create_rgl_match_logs)
+    cur.execute(sql_commands.create_linked_logs)
+    cur.execute(sql_commands.create_linked_rgl_matches)
+    if rebuild:
+        cur.execute("delete from RglMatchLogs;")
+        cur.execute("delete from LinkedLogs;")
+        cur.execute("delete from LinkedRglMatches;")
+
+    linked_logs = {r[0] for r in cur.execute("select log_id from LinkedLogs;")}
+    linked_matches = {
+        r[0]
+        for r in cur.execute("select rgl_id from LinkedRglMatches;")
+    }
+
+    load_rgl_matches()
+    all_matches = set(matches)
+    new_matches = all_matches - linked_matches
+
+    # old logs only need to be checked against new matches, so only the
+    # old logs from around the dates of new matches are read.
+    new_match_dates = {
+        d
+        for d, match_ids in match_dates.items() if match_ids & new_matches
+    }
+
+    new_logs = []  # type: List[int]
+    links = 0
+    read = 0
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for header in log_archive.iter_headers():
+            read += 1
+            if read % COMMIT_LOGS == 0:
+                # the new logs read so far were compared with every match
+                cur.executemany("insert or ignore into LinkedLogs values (?);",
+                                [(i, ) for i in new_logs])
+                con.commit()
+            if header.id in linked_logs:
+                candidate_ids = new_matches
+                log_date = datetime.fromtimestamp(header.date).date()
+                if log_date not in new_match_dates:
+                    continue
             else:
-                possible_logs[vg.id] = {logstf["id"]}
+                candidate_ids = all_matches
+                new_logs.append(header.id)
 
-    with open("rgl_match_logs.csv", "a", encoding="utf-8") as f:
-        for rgl_id, log_ids in possible_logs.items():
-            for log_id in log_ids:
-                f.write("{},{}\n".format(rgl_id, log_id))
+            if header.length < 120:  # skip game if it's too short
+                continue
+
+            logstf = log_archive.read_log(archive, header.offset)
+            for rgl_id in link_log(logstf, candidate_ids):
+                cur.execute(sql_commands.insert_rgl_match_log, {
+                    "rgl_id": rgl_id,
+                    "log_id": header.id
+                })
+                # links that were already found aren't inserted again
+                links += cur.rowcount
+
+    cur.executemany("insert or ignore into LinkedLogs values (?);",
+                    [(i, ) for i in new_logs])
+    cur.executemany("insert or ignore into LinkedRglMatches values (?);",
+                    [(i, ) for i in new_matches])
+    con.commit()
+    con.close()
+    return len(new_logs), len(new_matches), links
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="links logs.tf logs to the rgl matches they were " +
+        "played for.  Only logs and matches added since the last run are " +
+        "considered unless --rebuild is given.")
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="forget the previous links and relink everything")
+    args = parser.parse_args()
+
+    print("{} new logs and {} new rgl matches linked, {} links found".format(
+        *link(args.rebuild)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Loads the csv files written by get_rgl_matches.py into indexed tables in
+stats.db, replacing rows that were already loaded.  The other scripts read
+the rgl data from these tables instead of parsing the csv files.
+"""
+
+import csv
+import sqlite3
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+import sql_commands
+
+MATCHES_FILE = "matches.csv"
+PLAYER_TEAMS_FILE = "player_teams.csv"
+TEAMS_FILE = "rgl_teams.csv"
+SEASONS_FILE = "rgl_seasons.csv"
+LEAGUES_FILE = "rgl_leagues.csv"
+USERS_FILE = "rgl_users.csv"
+
+
+def read_rows(filename):  # type: (str) -> Iterator[List[str]]
+    if not Path(filename).is_file():
+        return
+    with open(filename, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if row:
+                yield row
+
+
+def read_names(filename):  # type: (str) -> Iterator[Tuple[int, str]]
+    """
+    reads an "id,name" csv file.  Names in files written before the csv
+    files were quoted can contain unquoted commas, so everything after the
+    id is part of the name.
+    """
+    for row in read_rows(filename):
+        yield int(row[0]), ",".join(row[1:]).strip()
+
+
+def optional_float(field):  # type: (str) -> Optional[float]
+    return None if field.strip() == "None" else float(field)
+
+
+def migrate_player_teams(con):  # type: (sqlite3.Connection) -> bool
+    """
+    drops an RglPlayerTeams table from when it was keyed on only the player
+    and the team, which kept one stint of each player on a team.  Its rows
+    are loaded again from PLAYER_TEAMS_FILE.  Returns whether it was
+    dropped.
+    """
+    key = [
+        r[1] for r in con.execute("pragma table_info(RglPlayerTeams);")
+        if r[5]
+    ]
+    if not key or "joined" in key:
+        return False
+    con.execute("drop table RglPlayerTeams;")
+    return True
+
+
+def load_all(con):  # type: (sqlite3.Connection) -> None
+    cur = con.cursor()
+    migrate_player_teams(con)
+    cur.executescript(sql_commands.create_rgl_tables)
+
+    cur.executemany(sql_commands.insert_rgl_season, read_names(SEASONS_FILE))
+    cur.executemany(sql_commands.insert_rgl_league, read_names(LEAGUES_FILE))
+    cur.executemany(sql_commands.insert_rgl_team, read_names(TEAMS_FILE))
+    cur.executemany(sql_commands.insert_rgl_user, read_names(USERS_FILE))
+
+    cur.executemany(sql_commands.insert_rgl_player_team, ({
+        "player_id": int(pid),
+        "joined": float(joined),
+        "left": float(left),
+        "team_id": int(tid),
+        "region_id": int(rid),
+        "season_id": int(season),
+        "league_id": int(league),
+    } for pid, joined, left, tid, rid, season, league in read_rows(
+        PLAYER_TEAMS_FILE)))
+
+    cur.executemany(sql_commands.insert_rgl_match, ({
+        "rgl_id": int(fields[0]),
+        "team1": int(fields[1]),
+        "team1_score": optional_float(fields[2]),
+        "team2": int(fields[3]),
+        "team2_score": optional_float(fields[4]),
+        "match_time": optional_float(fields[5]),
+        "maps": fields[6].strip(),
+        "season_id": int(fields[7]),
+    } for fields in read_rows(MATCHES_FILE)))
+    con.commit()
+
+
+def connect():  # type: () -> sqlite3.Connection
+    """
+    opens stats.db, making sure the rgl tables exist
+    """
+    con = sql_commands.connect()
+    con.executescript(sql_commands.create_rgl_tables)
+    return con
+
+
+def main():
+    con = connect()
+    load_all(con)
+    for table in [
+            "RglSeasons", "RglLeagues", "RglTeams", "RglUsers",
+            "RglPlayerTeams", "RglMatches"
+    ]:
+        count = con.execute("select count(*) from " + table).fetchone()[0]
+        print(table, count, "rows")
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
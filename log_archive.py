@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Reads and writes the logs.tf archive.  Each log is projected down to the
+fields this project uses and stored as an independently zlib compressed
+frame, so any log can still be read on its own given its offset.
+
+A frame is a 4 byte little endian length followed by the compressed json
+of one log.  Run this script to convert an old newline delimited
+game_logs.json into the framed archive.
+
+Projected logs always start with their id, length and info fields, so
+passes that only need those (see iter_headers) decompress and parse just
+the start of each frame.  Logs are decoded with orjson when it is
+installed.
+
+usage: log_archive.py [--keep-raw] [game_logs.json]
+"""
+
+import argparse
+import json
+import re
+import struct
+import zlib
+from typing import Any, BinaryIO, Dict, Iterator, NamedTuple, Optional, Tuple
+
+try:
+    import orjson  # type: ignore
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+ARCHIVE_FILE = "game_logs.dat"
+RAW_ARCHIVE_FILE = "game_logs_raw.dat"
+LEGACY_ARCHIVE_FILE = "game_logs.json"
+
+FRAME_HEADER = struct.Struct("<I")
+
+# the number of bytes of a frame read and decompressed by iter_headers.  The
+# id, length and info fields are well within the first 256 bytes.
+HEADER_READ_SIZE = 512
+HEADER_DECOMPRESS_SIZE = 256
+HEADER_RE = re.compile(
+    rb'^\{"id": ([0-9]+), "length": ([0-9]+), "info": (\{[^{}]*\})')
+
+LogHeader = NamedTuple(
+    "LogHeader",
+    [
+        ("offset", int),
+        ("id", int),
+        ("date", int),
+        ("map", str),
+        ("length", int),
+    ],
+)
+
+# The parts of a logs.tf log that are kept in the archive.  True keeps the
+# whole value, a dict keeps only its keys, and the "*" key applies a
+# projection to every value of a dict keyed by ids, like "players".  Lists
+# are projected element by element.
+EVENT_FIELDS = {
+    k: True
+    for k in ["type", "time", "team", "steamid", "killer", "medigun", "point"]
+}
+CLASS_STAT_FIELDS = {
+    k: True
+    for k in ["type", "kills", "assists", "deaths", "dmg", "total_time"]
+}
+PLAYER_FIELDS = {
+    k: True
+    for k in [
+        "team", "kills", "deaths", "assists", "dmg", "dt", "heal", "drops",
+        "ubers", "ubertypes", "medicstats", "headshots_hit", "backstabs"
+    ]
+}  # type: Dict[str, Any]
+PLAYER_FIELDS["class_stats"] = CLASS_STAT_FIELDS
+
+PROJECTION = {
+    "id": True,
+    "length": True,
+    "info": {
+        "date": True,
+        "map": True,
+        "total_length": True
+    },
+    "teams": {
+        "*": {
+            "score": True
+        }
+    },
+    "players": {
+        "*": PLAYER_FIELDS
+    },
+    "names": True,
+    "classkills": True,
+    "classdeaths": True,
+    "classkillassists": True,
+    "healspread": True,
+    "rounds": {
+        "events": EVENT_FIELDS
+    },
+}  # type: Dict[str, Any]
+
+
+def project(value, spec=None):  # type: (Any, Any) -> Any
+    """
+    returns a copy of a logs.tf log containing only the fields in the
+    projection spec
+    """
+    if spec is None:
+        spec = PROJECTION
+    if spec is True:
+        return value
+    if isinstance(value, list):
+        return [project(v, spec) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "*" in spec:
+        return {k: project(v, spec["*"]) for k, v in value.items()}
+    return {k: project(value[k], s) for k, s in spec.items() if k in value}
+
+
+def encode_log(game_log):  # type: (Dict) -> bytes
+    data = zlib.compress(json.dumps(game_log).encode("utf-8"))
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def append_log(archive, game_log):  # type: (BinaryIO, Dict) -> int
+    """
+    writes a log as a new frame at the end of an archive opened in append
+    mode and returns the offset of the frame.
+    """
+    archive.seek(0, 2)
+    offset = archive.tell()
+    archive.write(encode_log(game_log))
+    return offset
+
+
+def read_frame(archive):  # type: (BinaryIO) -> bytes
+    """
+    reads the frame at the current position of the archive.  Returns an
+    empty byte string at the end of the file.
+    """
+    header = archive.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return b""
+    (length, ) = FRAME_HEADER.unpack(header)
+    return zlib.decompress(archive.read(length))
+
+
+def read_log(archive, offset):  # type: (BinaryIO, int) -> Dict
+    archive.seek(offset)
+    return loads(read_frame(archive))
+
+
+def iter_frames(filename=ARCHIVE_FILE):  # type: (str) -> Iterator[Tuple[int, bytes]]
+    """
+    lazily yields the offset and decompressed json of every log in the
+    archive
+    """
+    with open(filename, "rb") as archive:
+        while True:
+            offset = archive.tell()
+            frame = read_frame(archive)
+            if not frame:
+                break
+            yield offset, frame
+
+
+def iter_logs(filename=ARCHIVE_FILE):  # type: (str) -> Iterator[Dict]
+    for _, frame in iter_frames(filename):
+        yield loads(frame)
+
+
+def parse_header(offset, head):  # type: (int, bytes) -> Optional[LogHeader]
+    """
+    parses the header fields from the start of a projected log's json.
+    Returns None if the fields aren't at the start of the text.
+    """
+    header_match = HEADER_RE.match(head)
+    if not header_match:
+        return None
+    info = loads(header_match.group(3))
+    return LogHeader(offset, int(header_match.group(1)), info["date"],
+                     info["map"], int(header_match.group(2)))
+
+
+def iter_headers(filename=ARCHIVE_FILE):
+    # type: (str) -> Iterator[LogHeader]
+    """
+    lazily yields the id, upload date, map and length of every log in the
+    archive without decoding the rest of the log.  Only the start of each
+    frame is read and decompressed unless the log wasn't stored in the
+    projected field order.
+    """
+    with open(filename, "rb") as archive:
+        while True:
+            offset = archive.tell()
+            frame_header = archive.read(FRAME_HEADER.size)
+            if len(frame_header) < FRAME_HEADER.size:
+                break
+            (length, ) = FRAME_HEADER.unpack(frame_header)
+
+            data = archive.read(min(length, HEADER_READ_SIZE))
+            head = zlib.decompressobj().decompress(data,
+                                                   HEADER_DECOMPRESS_SIZE)
+            header = parse_header(offset, head)
+            if not header:
+                archive.seek(offset)
+                game_log = loads(read_frame(archive))
+                # old logs without a length have a length of 0, which
+                # get_format gives the other format
+                header = LogHeader(offset, game_log["id"],
+                                   game_log["info"]["date"],
+                                   game_log["info"]["map"],
+                                   game_log.get("length", 0))
+            archive.seek(offset + FRAME_HEADER.size + length)
+            yield header
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="converts game_logs.json into the framed log archive")
+    parser.add_argument("source", nargs="?", default=LEGACY_ARCHIVE_FILE)
+    parser.add_argument("--keep-raw",
+                        action="store_true",
+                        help="also store the unprojected logs in " +
+                        RAW_ARCHIVE_FILE)
+    args = parser.parse_args()
+
+    converted = 0
+    with open(args.source, encoding="utf-8") as source, \
+            open(ARCHIVE_FILE, "wb") as archive:
+        raw_archive = open(RAW_ARCHIVE_FILE, "wb") if args.keep_raw else None
+        for line in source:
+            if not line.strip():
+                continue
+            game_log = json.loads(line)
+            append_log(archive, project(game_log))
+            if raw_archive:
+                append_log(raw_archive, game_log)
+            converted += 1
+        if raw_archive:
+            raw_archive.close()
+
+    print("converted", converted, "logs into", ARCHIVE_FILE)
+
+
+if __name__ == "__main__":
+    main()
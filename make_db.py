@@ -1,68 +1,397 @@
 #!/usr/bin/env python3
 
-import json
+import argparse
+import os
 import sqlite3
 import datetime
-from typing import Dict
-from steam.steamid import SteamID  # type: ignore
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+from steam_ids import id3_to_id64
+from accumulators import LastValues
 import parse_logs
 import sql_commands
 import link_match_logs
+import log_archive
+import dedupe
+import partitions
 
-names: Dict[str, str] = {}
+# the logs read by each task of a recompute
+RECOMPUTE_BATCH = 200
 
 
+def migrate_player_stats(con: sqlite3.Connection) -> bool:
+    """
+    Moves the class matchup columns of a PlayerStats table from before
+    ClassMatchups existed into ClassMatchups, keeping only non-zero
+    matchups, and rebuilds PlayerStats without them.  Returns whether
+    there was anything to migrate.
+    """
+    columns = [r[1] for r in con.execute("pragma table_info(PlayerStats);")]
+    if "soldier_kills" not in columns:
+        return False
 
-def main():
-    con = sqlite3.connect(sql_commands.db_file)
-    con.row_factory = sqlite3.Row
+    con.execute(sql_commands.create_class_matchups)
+    for cn in sql_commands.matchup_classes:
+        con.execute(
+            "insert or ignore into ClassMatchups " +
+            "select log_id, player_id, tf2_class, ?, " +
+            "{0}_kills, {0}_assists, {0}_deaths from PlayerStats ".format(cn) +
+            "where {0}_kills or {0}_assists or {0}_deaths;".format(cn),
+            (sql_commands.class_ids[cn], ))
+
+    con.execute("alter table PlayerStats rename to OldPlayerStats;")
+    con.execute(sql_commands.create_player_stats)
+    new_columns = [
+        r[1] for r in con.execute("pragma table_info(PlayerStats);")
+    ]
+    # the old insert statement wrote headshots_hit into the backstabs
+    # column and backstabs into the headshots_hit column
+    swapped = {"backstabs": "headshots_hit", "headshots_hit": "backstabs"}
+    # columns added since, like match_time, are filled in by later
+    # migrations
+    con.execute("insert into PlayerStats select {} from OldPlayerStats;".format(
+        ", ".join(swapped.get(c, c) if c in columns else "null"
+                  for c in new_columns)))
+    con.execute("drop table OldPlayerStats;")
+    con.commit()
+    con.execute("vacuum;")
+    return True
+
+
+def migrate_partitions(con: sqlite3.Connection) -> bool:
+    """
+    Moves the per log tables of a stats.db from before the monthly
+    partitions into the partitions, and drops them and their views from
+    stats.db.  Rows of logs without a MatchLogs row are dropped.  Returns
+    whether there was anything to migrate.
+    """
+    tables = {
+        name for name, in con.execute(
+            "select name from sqlite_master where type = 'table';")
+    }
+    if "MatchLogs" not in tables:
+        return False
+
+    # match_time starts with the local "YYYY:MM" the log was uploaded in
+    months = [
+        m for m, in con.execute(
+            "select distinct substr(match_time, 1, 7) from MatchLogs;")
+    ]
+    os.makedirs(partitions.PARTITION_DIR, exist_ok=True)
+    for month in months:
+        filename = partitions.partition_file(month.replace(":", "-"))
+        part = sqlite3.connect(filename)
+        partitions.create_tables(part)
+        part.close()
+        con.execute("attach database ? as part;", (filename, ))
+        con.execute(
+            "insert or ignore into part.MatchLogs select * from " +
+            "main.MatchLogs where substr(match_time, 1, 7) = ?;", (month, ))
+        for table in ("PlayerStats", "ClassMatchups"):
+            if table in tables:
+                # the partition's columns can be newer than stats.db's
+                columns = ", ".join(r[1] for r in con.execute(
+                    "pragma main.table_info({});".format(table)))
+                con.execute(
+                    "insert or ignore into part.{0} ({1}) select {1} from "
+                    "main.{0} where log_id in (select log_id from "
+                    "part.MatchLogs);".format(table, columns))
+        con.commit()
+        con.execute("detach database part;")
+
+    con.execute("drop view if exists PlayerStatsWide;")
+    con.execute("drop view if exists ClassMatchupTotals;")
+    for table in partitions.TABLES:
+        con.execute("drop table if exists {};".format(table))
+    con.commit()
+    con.execute("vacuum;")
+    return True
+
+
+def text_match_time(text: str) -> int:
+    """
+    returns the unix time of a match_time written as text, which had the
+    minutes replaced by the month, so the minutes are left out
+    """
+    match_hour = datetime.datetime.strptime(text[:13], "%Y:%m:%d %H")
+    return int(match_hour.timestamp())
+
+
+def migrate_match_times() -> int:
+    """
+    Converts the text match times of partitions from before match_time was
+    a unix time, and copies match_time into their PlayerStats.  The times
+    are taken from the log archive, or from the text for logs that aren't
+    archived.  Returns the number of partitions migrated.
+    """
+    upload_dates: Optional[Dict[int, int]] = None
+    migrated = 0
+    for month in partitions.partition_months():
+        part = sqlite3.connect(partitions.partition_file(month))
+        time_type = {
+            r[1]: r[2]
+            for r in part.execute("pragma table_info(MatchLogs);")
+        }["match_time"].lower()
+        player_columns = [
+            r[1] for r in part.execute("pragma table_info(PlayerStats);")
+        ]
+        text_times = part.execute(
+            "select log_id, match_time from MatchLogs " +
+            "where typeof(match_time) = 'text';").fetchall()
+        if time_type == "int" and "match_time" in player_columns and (
+                not text_times):
+            part.close()
+            continue
+
+        if time_type != "int":
+            part.execute("drop index if exists MatchLogsTime;")
+            part.execute("alter table MatchLogs rename to OldMatchLogs;")
+            part.execute(sql_commands.create_match_table)
+            part.execute("insert into MatchLogs select * from OldMatchLogs;")
+            part.execute("drop table OldMatchLogs;")
+        if "match_time" not in player_columns:
+            part.execute("alter table PlayerStats add column match_time int;")
+
+        if text_times and upload_dates is None:
+            upload_dates = {}
+            if os.path.isfile(log_archive.ARCHIVE_FILE):
+                upload_dates = {
+                    h.id: h.date
+                    for h in log_archive.iter_headers()
+                }
+        part.executemany(
+            "update MatchLogs set match_time = ? where log_id = ?;",
+            [(upload_dates.get(log_id) or text_match_time(text), log_id)
+             for log_id, text in text_times])
+        part.execute(
+            "update PlayerStats set match_time = (select m.match_time " +
+            "from MatchLogs m where m.log_id = PlayerStats.log_id) " +
+            "where match_time is null;")
+        partitions.create_tables(part)
+        part.commit()
+        part.execute("vacuum;")
+        part.close()
+        migrated += 1
+    return migrated
+
+
+def insert_class_stats(cur: sqlite3.Cursor, entry: Dict) -> None:
+    cur.execute(sql_commands.insert_player_stats, entry)
+    cur.executemany(sql_commands.insert_class_matchup,
+                    sql_commands.class_matchup_rows(entry))
+
+
+def insert_game(cur: sqlite3.Cursor, g: Dict) -> None:
+    """
+    inserts a game's match data and class stats, tagged with the versions
+    of the derived stats, unless the game is already in the database
+    """
+    log_id = g["id"]
+    match_data = { 
+                   "log_id": g["id"], 
+                   "map": g["info"]["map"], 
+                   "match_time": g["info"]["date"],
+                   "format": link_match_logs.get_format(g).name,
+                   "red_score": g["teams"]["Red"]["score"],
+                   "blue_score": g["teams"]["Blue"]["score"] 
+                 }
+
+    cur.execute(sql_commands.insert_match, match_data)
+    if not cur.rowcount:
+        return
+
+    class_stats = parse_logs.get_user_class_stats(g)
+    for id3 in class_stats:
+        for cn in class_stats[id3]:
+            if cn not in sql_commands.class_ids:
+                # sometimes there are "undefined" classes
+                continue
+            class_stats[id3][cn]["log_id"] = log_id
+            class_stats[id3][cn]["match_time"] = g["info"]["date"]
+            class_stats[id3][cn]["tf2_class"] = sql_commands.class_ids[cn]
+            insert_class_stats(cur, class_stats[id3][cn])
+    cur.executemany(sql_commands.insert_derived_version,
+                    [(log_id, name, stat.version)
+                     for name, stat in parse_logs.derived_stats.items()])
+
+
+def insert_names(cur: sqlite3.Cursor, g: Dict) -> None:
+    for id3, name in g["names"].items():
+        cur.execute(sql_commands.insert_user, {"player_id": id3_to_id64(id3),
+                                               "name": name})
+
+
+def stale_logs() -> Dict[int, Tuple[str, List[str]]]:
+    """
+    returns the month and the stale derived stats of each log whose
+    derived stats were made by an older version than parse_logs'
+    """
+    stale: Dict[int, Tuple[str, List[str]]] = {}
+    for month in partitions.partition_months():
+        part = sqlite3.connect(partitions.partition_file(month))
+        part.execute(sql_commands.create_derived_versions)
+        for name, stat in parse_logs.derived_stats.items():
+            for log_id, in part.execute(sql_commands.get_stale_logs,
+                                        (name, stat.version)):
+                stale.setdefault(log_id, (month, []))[1].append(name)
+        part.close()
+    return stale
+
+
+def compute_derived_stats(
+        task: List[Tuple[int, List[str]]]) -> List[Tuple[int, List]]:
+    """
+    computes derived stats of archived logs, given by their offsets, and
+    returns the stat, player and values of each player of each log
+    """
+    results = []
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for offset, names in task:
+            g = log_archive.read_log(archive, offset)
+            results.append((g["id"], [
+                (name, id3_to_id64(id3),
+                 parse_logs.derived_stats[name].compute(id3, g))
+                for name in names for id3 in g["players"]
+            ]))
+    return results
+
+
+def recompute(con: sqlite3.Connection, jobs: int) -> int:
+    """
+    recomputes the stale derived stats in place, reading the logs in
+    parallel, and returns the number of logs updated.  con is the
+    connection to stats.db.  Sealed partitions are unsealed while they're
+    updated and sealed again after, so backups need to copy them again.
+    """
+    stale = stale_logs()
+    offsets = [(h.offset, stale[h.id][1])
+               for h in log_archive.iter_headers() if h.id in stale]
+    if not offsets:
+        return 0
+    resealed = partitions.sealed_months(con) & {
+        month for month, _ in stale.values()
+    }
+    for month in resealed:
+        partitions.unseal(con, month)
+    tasks = [
+        offsets[i:i + RECOMPUTE_BATCH]
+        for i in range(0, len(offsets), RECOMPUTE_BATCH)
+    ]
+    updates = {
+        name: "update PlayerStats set {} where log_id = ? and player_id = ?;"
+        .format(", ".join(c + " = ?" for c in stat.columns))
+        for name, stat in parse_logs.derived_stats.items()
+    }
+    parts: Dict[str, sqlite3.Connection] = {}
+    updated = 0
+    with Pool(jobs) as pool:
+        for results in pool.imap_unordered(compute_derived_stats, tasks):
+            for log_id, values in results:
+                month = stale[log_id][0]
+                if month not in parts:
+                    parts[month] = sqlite3.connect(
+                        partitions.partition_file(month))
+                cur = parts[month].cursor()
+                for name, player_id, stat_values in values:
+                    cur.execute(updates[name],
+                                tuple(stat_values) + (log_id, player_id))
+                cur.executemany(sql_commands.insert_derived_version, [
+                    (log_id, name, parse_logs.derived_stats[name].version)
+                    for name in stale[log_id][1]
+                ])
+                updated += 1
+    for month in resealed:
+        partitions.seal(con, month, parts.pop(month, None))
+    con.commit()
+    for part in parts.values():
+        part.commit()
+        part.close()
+    return updated
+
+
+def create_tables(con: sqlite3.Connection) -> None:
+    if migrate_player_stats(con):
+        print("moved class matchups out of PlayerStats")
+    if migrate_partitions(con):
+        print("moved the per log tables into", partitions.PARTITION_DIR)
+    migrated = migrate_match_times()
+    if migrated:
+        print("converted match_time to unix times in", migrated, "partitions")
     cur = con.cursor()
-    cur.execute(sql_commands.create_player_stats)
-    cur.execute(sql_commands.create_match_table)
     cur.execute(sql_commands.create_weapon_stats)
     cur.execute(sql_commands.create_users)
-    
-    with open("game_logs.json", encoding="utf-8") as f:
-        line: str
-        for line in f:
-            g = json.loads(line)
-
-            id3: str
-            for id3 in g["names"]:
-                names[id3] = g["names"][id3]
-    
-            log_id = g["id"]
-            class_stats = parse_logs.get_user_class_stats(g)
-    
-            match_date = datetime.datetime.fromtimestamp(g["info"]["date"])
-    
-            match_data = { 
-                           "log_id": g["id"], 
-                           "map": g["info"]["map"], 
-                           "match_time": match_date.strftime("%Y:%m:%d %H:%m:%S"),
-                           "format": link_match_logs.get_format(g).name,
-                           "red_score": g["teams"]["Red"]["score"],
-                           "blue_score": g["teams"]["Blue"]["score"] 
-                         }
-    
-            cur.execute(sql_commands.insert_match, match_data)
-    
-            for id3 in class_stats:
-                for cn in class_stats[id3]:
-                    if cn not in sql_commands.class_ids:
-                        # sometimes there are "undefined" classes
-                        continue
-                    class_stats[id3][cn]["log_id"] = log_id
-                    class_stats[id3][cn]["tf2_class"] = sql_commands.class_ids[cn]
-                    cur.execute(sql_commands.insert_player_stats, class_stats[id3][cn])
-
-    for id3, name in names.items():
-        cur.execute(sql_commands.insert_user, {"player_id": SteamID(id3).as_64,
-                                               "name": name})
 
-    
+
+def insert_archive(con: sqlite3.Connection,
+                   writer: partitions.PartitionWriter) -> None:
+    """
+    inserts the archived logs that aren't duplicates into the partitions
+    that aren't sealed, and the names of their players into stats.db.  The
+    rows of logs flagged as duplicates since they were inserted are
+    deleted, and their sealed partitions unsealed so that the logs that
+    replace them are inserted.  writer.seal() seals them again.
+    """
+    headers = list(log_archive.iter_headers())
+    duplicates = dedupe.read_duplicates()
+    flagged = partitions.find_logs(
+        (h.id, h.date) for h in headers if h.id in duplicates)
+    for month, log_ids in flagged.items():
+        if month in writer.sealed:
+            partitions.unseal(con, month)
+            writer.sealed.discard(month)
+        part = sqlite3.connect(partitions.partition_file(month))
+        partitions.delete_logs(part, log_ids)
+        part.commit()
+        part.close()
+        print("deleted", len(log_ids), "duplicate logs from",
+              partitions.partition_file(month))
+
+    # the name of each player in the newest of the logs read, which doesn't
+    # depend on the order the logs are read in
+    names = LastValues()
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for header in headers:
+            if header.id in duplicates:
+                continue
+            part = writer.partition(header.date)
+            if part is None:
+                continue
+            g = log_archive.read_log(archive, header.offset)
+            insert_game(part.cursor(), g)
+            for id3, name in g["names"].items():
+                names.add(id3_to_id64(id3), name, (header.date, header.id))
+
+    con.executemany(sql_commands.insert_user,
+                    [{"player_id": player_id, "name": name}
+                     for player_id, name in names.items()])
+    writer.close()
     con.commit()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recompute",
+                        action="store_true",
+                        help="only recompute stale derived stats")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    con = sql_commands.connect()
+    create_tables(con)
+    if args.recompute:
+        print("recomputed the derived stats of", recompute(con, args.jobs),
+              "logs")
+        con.close()
+        return
+
+    writer = partitions.PartitionWriter(con)
+    insert_archive(con, writer)
+    updated = recompute(con, args.jobs)
+    if updated:
+        print("recomputed the derived stats of", updated, "logs")
+    for month in writer.seal():
+        print("sealed", partitions.partition_file(month))
     con.close()
 
+
 if __name__ == "__main__":
     main()
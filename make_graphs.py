@@ -1,57 +1,50 @@
+#!/usr/bin/env python3
+"""
+Plots the mmr of rgl players and of each rgl division, with the division
+cut points suggested by calibration.py.
+"""
+
 from matplotlib import pyplot as plt
+import calibration
+
+
+def main():
+    result = calibration.get_calibration()
+    calibration.main()
+
+    fig, axs = plt.subplots()
+    axs.bar(calibration.HISTOGRAM_BINS[:-1],
+            result["histogram"],
+            width=1,
+            align="edge")
+    for c in result["cuts"]:
+        axs.axvline(x=c["cut"])
+    axs.set_ylabel("count")
+    axs.set_xlabel("TrueSkill MMR")
+    axs.set_title("RGL.GG Player MMR")
+    fig.savefig("score_hist.png")
+
+    # the boxes are drawn from the cached quantiles, the whiskers span the
+    # 5th to 95th percentiles
+    boxes = [{
+        "label": d["name"],
+        "med": d["median"],
+        "q1": d["q25"],
+        "q3": d["q75"],
+        "whislo": d["q05"],
+        "whishi": d["q95"],
+        "fliers": [],
+    } for d in result["divisions"]]
+
+    fig, axs = plt.subplots()
+    axs.bxp(boxes, vert=False)
+    for c in result["cuts"]:
+        axs.axvline(x=c["cut"], linestyle=":")
+    axs.set_xlabel("TrueSkill MMR")
+    axs.set_title("RGL.GG Division MMR")
+    fig.tight_layout()
+    fig.savefig("score_boxplot.png")
+
 
-league_names = [
-    "invite", "advanced", "main", "intermediate", "open", "newcomer"
-][::-1]
-player_leagues = {}
-with open("player_teamid_league.csv", encoding="utf-8") as f:
-    for line in f:
-        steamid64, _, league = line.strip().split(",")
-        player_leagues[int(steamid64)] = league
-
-scores = []
-steam_ids = []
-player_scores = {}
-with open("player_scores.csv", encoding="utf-8") as f:
-    for line in f:
-        stid, score = line.strip().split(",")
-        steam_ids.append(stid)
-        scores.append(float(score))
-
-        # print(">", stid)
-        if int(stid) in player_leagues:
-            if float(score) > 35:
-                print(stid, score)
-            player_scores[int(stid)] = float(score)
-
-print("league, max, min, avg")
-boxplot_data = []
-for l in league_names:
-    scores = [
-        player_scores[i] for i in player_scores if player_leagues[i] == l
-    ]
-    boxplot_data.append(scores)
-    print("{},{:.1f},{:.1f},{:.1f}".format(l, max(scores), min(scores),
-                                           sum(scores) / len(scores)))
-
-print(len(player_scores), "rgl players found")
-
-fig, axs = plt.subplots()
-axs.hist(scores, bins=list(range(50)))
-axs.axvline(x=18.5)
-axs.axvline(x=21.7)
-axs.axvline(x=23.7)
-axs.axvline(x=25.8)
-axs.axvline(x=28.8)
-axs.set_ylabel("count")
-axs.set_xlabel("TrueSkill MMR")
-axs.set_title("RGL.GG Player MMR")
-fig.savefig("score_hist.png")
-
-fig, axs = plt.subplots()
-axs.boxplot(boxplot_data, vert=False)
-axs.set_yticklabels(league_names)
-axs.set_xlabel("TrueSkill MMR")
-axs.set_title("RGL.GG Division MMR")
-fig.tight_layout()
-fig.savefig("score_boxplot.png")
+if __name__ == "__main__":
+    main()
@@ -1,122 +1,320 @@
 #!/usr/bin/env python3
+"""
+Generates the league report, which ranks the leagues of each rgl season by
+their median player mmr and the teams of each league by the summed mmr of
+their top 6 players.  Only players who were on a team for at least one of
+its matches count towards it (see roster_index.py).
 
-from typing import Set, Dict, List, Any
+html/leagues.html is an index of the seasons, each of which has a page in
+html/leagues/.  The rosters of each league's teams are loaded by the season
+page when asked for, from html/leagues/<season>/<league>.json.  The pages
+of a season are only written again when its data or the templates
+changed, which is tracked with a hash of each season in
+league_report_state.json.  Seasons that are over are ranked by the mmr
+their players had when they ended, from the rating history, so rating
+games played since doesn't write them again.
+"""
+
+from typing import Dict, Iterable, List, Any, Optional, Set, Tuple
+import hashlib
+import itertools
+import json
 import math
+import os
+import shutil
+import sqlite3
+import time
 import jinja2
-from get_rgl_matches import read_player_entries
-
-# p.id, player_join_date, player_leave_date, tid, rid, team_seasons[tid], league_id))
-
-seasons = {}  # type: Dict[int, str]
-with open("rgl_seasons.csv", encoding="utf-8") as f:
-    for line in f:
-        season_id, season_name = line.split(",")
-        seasons[int(season_id)] = season_name.strip()
-
-teams = {}  # type: Dict[int, str]
-with open("rgl_teams.csv", encoding="utf-8") as f:
-    for line in f:
-        i, n = line.split(",")
-        teams[int(i)] = n.strip()
-
-league_names = {}  # type: Dict[int, str]
-with open("rgl_leagues.csv", encoding="utf-8") as f:
-    for line in f:
-        if not line:
-            continue
-        lid, lname = line.split(",")
-        league_names[int(lid)] = lname.strip()
+import get_rgl_matches
+import load_rgl
+from get_rgl_matches import RglMatch
+from leaderboard import Leaderboard, OVERALL
+from rating_history import RatingHistory
+from roster_index import RosterIndex
+
+LEAGUE_DIR = "html/leagues"
+STATE_FILE = "league_report_state.json"
+SEASON_TEMPLATES = ["templates/base.html", "templates/league_season.html"]
+DAY = 24 * 60 * 60
+
+create_player_scores = """
+create temp table PlayerScores
+(
+season_id int,
+player_id int,
+mmr real,
+primary key (season_id, player_id)
+);
+"""
+
+create_active_player_teams = """
+create temp table ActivePlayerTeams
+(
+player_id int,
+team_id int,
+season_id int,
+league_id int,
+primary key (player_id, team_id)
+);
+"""
+
+team_scores_query = """
+select t.season_id, t.league_id, t.team_id,
+       coalesce(n.name, 'UNKNOWN'), coalesce(top6.score, 0)
+from (select distinct season_id, league_id, team_id from RglPlayerTeams) t
+left join RglTeams n on n.team_id = t.team_id
+left join
+(
+    select team_id, sum(mmr) as score
+    from
+    (
+        select p.team_id, s.mmr,
+               row_number() over (partition by p.team_id
+                                  order by s.mmr desc) as team_rank
+        from ActivePlayerTeams p
+        join PlayerScores s
+        on s.season_id = p.season_id and s.player_id = p.player_id
+    )
+    where team_rank <= 6
+    group by team_id
+) top6 on top6.team_id = t.team_id
+order by t.season_id desc, t.league_id, top6.score desc;
+"""
+
+league_scores_query = """
+select p.season_id, p.league_id, s.mmr
+from ActivePlayerTeams p
+join PlayerScores s
+on s.season_id = p.season_id and s.player_id = p.player_id
+order by p.season_id, p.league_id, s.mmr desc;
+"""
+
+roster_query = """
+select p.team_id, p.player_id, coalesce(u.name, cast(p.player_id as text)),
+       s.mmr
+from ActivePlayerTeams p
+left join PlayerScores s
+on s.season_id = p.season_id and s.player_id = p.player_id
+left join RglUsers u on u.player_id = p.player_id
+order by p.team_id, s.mmr desc;
+"""
+
 
-usernames = {}  # type: Dict[int, str]
-with open("rgl_users.csv", encoding="utf-8") as f:
-    for line in f:
-        if not line:
+def active_player_teams(rgl_matches):
+    # type: (List[RglMatch]) -> List[Tuple[int, int, int, int]]
+    """
+    returns the (player, team, season, league) entries of players who were
+    on the team on the date of at least one of its matches.  All the
+    players of teams without dated matches are kept.
+    """
+    player_entries = get_rgl_matches.read_player_entries()
+    rosters = RosterIndex(player_entries)
+    active = {}  # type: Dict[int, Set[int]]
+    for m in rgl_matches:
+        if m.date:
+            for team in (m.team1, m.team2):
+                active.setdefault(team, set()).update(
+                    rosters.roster_at(team, m.date.timestamp()))
+
+    return [(p.id, p.team_id, p.season_id, p.league_id)
+            for p in player_entries
+            if p.team_id not in active or p.id in active[p.team_id]]
+
+
+def season_ends(rgl_matches):  # type: (List[RglMatch]) -> Dict[int, float]
+    """
+    returns the end of the day of the last dated match of each season
+    """
+    ends = {}  # type: Dict[int, float]
+    for m in rgl_matches:
+        if m.date and m.season is not None:
+            ends[m.season] = max(ends.get(m.season, 0),
+                                 m.date.timestamp() + DAY)
+    return ends
+
+
+def player_scores(entries, scores, ends, history, now):
+    # type: (Iterable[Tuple[int, int, int, int]], Dict[int, float], Dict[int, float], Optional[RatingHistory], float) -> List[Tuple[int, int, float]]
+    """
+    returns the (season, player, mmr) scores of the players of each season.
+    Seasons that ended before now use the mmr players had at their end, so
+    their pages don't change when players are rated again, and the others
+    use the current scores.
+    """
+    season_scores = []  # type: List[Tuple[int, int, float]]
+    for player_id, season_id in sorted({(e[0], e[2]) for e in entries}):
+        end = ends.get(season_id)
+        if history is None or end is None or end > now:
+            if player_id in scores:
+                season_scores.append(
+                    (season_id, player_id, scores[player_id]))
             continue
-        uid, name = line.split(",")
-        usernames[int(uid)] = name.strip()
+        rating = history.rating_at(player_id, end)
+        if rating:
+            season_scores.append((season_id, player_id, rating.mu))
+    return season_scores
+
+
+def season_hash(season):  # type: (Dict[str, Any]) -> str
+    """
+    returns a hash of everything a season's pages are made from
+    """
+    digest = hashlib.sha1(json.dumps(season, sort_keys=True).encode("utf-8"))
+    for template in SEASON_TEMPLATES:
+        with open(template, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
 
-user_mmr = {}  # type: Dict[int, float]
-with open("player_scores.csv", encoding="utf-8") as f:
-    for line in f:
-        if not line:
+def write_season(season, template):
+    # type: (Dict[str, Any], jinja2.Template) -> None
+    os.makedirs(os.path.join(LEAGUE_DIR, str(season["id"])), exist_ok=True)
+    for league in season["leagues"]:
+        rosters = [{
+            "id": team["id"],
+            # steamid64s are too big for javascript numbers
+            "players": [[str(pid), name, mmr]
+                        for pid, name, mmr in team["players"]]
+        } for team in league["teams"]]
+        payload = os.path.join(LEAGUE_DIR, str(season["id"]),
+                               "{}.json".format(league["id"]))
+        with open(payload, "w", encoding="utf-8") as f:
+            json.dump({"teams": rosters}, f)
+    page = os.path.join(LEAGUE_DIR, "{}.html".format(season["id"]))
+    with open(page, "w", encoding="utf-8") as f:
+        f.write(template.render(season=season))
+
+
+def write_pages(season_profiles):  # type: (List[Dict[str, Any]]) -> int
+    """
+    writes the season index and the pages of the seasons that changed, and
+    removes the pages of seasons that are gone.  Returns the number of
+    seasons written.
+    """
+    state = {}  # type: Dict[str, str]
+    if os.path.isfile(STATE_FILE):
+        with open(STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"), autoescape=True)
+    season_template = jinja_env.get_template("league_season.html")
+
+    os.makedirs(LEAGUE_DIR, exist_ok=True)
+    written = 0
+    new_state = {}  # type: Dict[str, str]
+    for season in season_profiles:
+        key = str(season["id"])
+        new_state[key] = season_hash(season)
+        page = os.path.join(LEAGUE_DIR, key + ".html")
+        if state.get(key) == new_state[key] and os.path.isfile(page):
             continue
-        id64, score = line.split(",")
-        user_mmr[int(id64)] = float(score)
-
-season_teams = {}  # type: Dict[int, Set]
-season_leagues = {}  # type: Dict[int, Set]
-team_leagues = {}  # type: Dict[int, int]
-team_players = {}  # type: Dict[int, Set[int]]
-league_teams = {}  # type: Dict[int, Set[int]]
-
-player_entries = read_player_entries()
-for p in player_entries:
-    if p.season_id not in season_teams:
-        season_teams[p.season_id] = set()
-    if p.team_id not in team_players:
-        team_players[p.team_id] = set()
-    if p.season_id not in season_leagues:
-        season_leagues[p.season_id] = set()
-    if p.league_id not in league_teams:
-        league_teams[p.league_id] = set()
-
-    season_teams[p.season_id].add(p.team_id)
-    team_leagues[p.team_id] = p.league_id
-    team_players[p.team_id].add(p.id)
-    season_leagues[p.season_id].add(p.league_id)
-    league_teams[p.league_id].add(p.team_id)
-
-
-def get_player(pid):
-    mmr = float("nan") if pid not in user_mmr else user_mmr[pid]
-    name = "Unnamed" if pid not in usernames else usernames[pid]
-    return (mmr, pid, name)
-
-
-season_profiles = []  # type: List[Dict]
-for s, team_set in season_teams.items():
-    season = {}  # type: Dict[str, Any]
-    season["id"] = s
-    season["name"] = seasons[s]
-    season["leagues"] = []
-    season_profiles.append(season)
-    for season_league in season_leagues[s]:
-        league = {}  # type: Dict[str, Any]
-        league["id"] = season_league
-        league["name"] = league_names[season_league]
-        league_scores = []  # type: List[float]
-        league["teams"] = []
-        season["leagues"].append(league)
-
-        for tid in league_teams[season_league]:
-            team = {}  # type: Dict[str, Any]
-            team["id"] = tid
-            team["name"] = "UNKNOWN" if tid not in teams else teams[tid]
-            players = [get_player(i) for i in team_players[tid]]
-            team["players"] = [i for i in players if not math.isnan(i[0])]
-            league_scores += [i[0] for i in team["players"]]
-            team["players"].sort(reverse=True)
-            top6_players = (team["players"] if len(team["players"]) < 6 else
-                            team["players"][:6])
-            team["top6"] = sum([i[0] for i in top6_players])
-            league["teams"].append(team)
-            league["teams"].sort(reverse=True, key=lambda x: x["top6"])
-
-        league_scores.sort(reverse=True)
-
-        league["median"] = float("nan")
-        valid_scores = [a for a in league_scores if not math.isnan(a)]
+        write_season(season, season_template)
+        written += 1
+
+    for key in set(state) - set(new_state):
+        if os.path.isfile(os.path.join(LEAGUE_DIR, key + ".html")):
+            os.remove(os.path.join(LEAGUE_DIR, key + ".html"))
+        shutil.rmtree(os.path.join(LEAGUE_DIR, key), ignore_errors=True)
+
+    seasons = [{
+        "id": season["id"],
+        "name": season["name"],
+        "leagues": len(season["leagues"]),
+        "teams": sum(len(l["teams"]) for l in season["leagues"])
+    } for season in season_profiles]
+    with open("html/leagues.html", "w", encoding="utf-8") as f:
+        f.write(jinja_env.get_template("leagues.html").render(seasons=seasons))
+
+    with open(STATE_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(new_state, f, indent=1)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+    return written
+
+
+def get_season_profiles(con, scores, history=None, now=None):
+    # type: (sqlite3.Connection, Iterable[Tuple[int, float]], Optional[RatingHistory], Optional[float]) -> List[Dict]
+    """
+    returns the leagues and teams of each season, newest first, ranked by
+    the given current (steamid64, mmr) scores, or for seasons that ended
+    before now by the mmr in the rating history at their end.  con is a
+    connection to stats.db.
+    """
+    if now is None:
+        now = time.time()
+    rgl_matches = get_rgl_matches.read_matches()
+    entries = active_player_teams(rgl_matches)
+    cur = con.cursor()
+    cur.execute(create_player_scores)
+    cur.executemany(
+        "insert or replace into PlayerScores values (?, ?, ?);",
+        player_scores(entries, dict(scores), season_ends(rgl_matches),
+                      history, now))
+    cur.execute(create_active_player_teams)
+    cur.executemany("insert or ignore into ActivePlayerTeams values (?,?,?,?);",
+                    entries)
+
+    seasons = dict(cur.execute("select season_id, name from RglSeasons;"))
+    league_names = dict(
+        cur.execute("select league_id, name from RglLeagues;"))
+
+    league_medians = {}  # type: Dict[Tuple[int, int], float]
+    for key, rows in itertools.groupby(cur.execute(league_scores_query),
+                                       key=lambda r: (r[0], r[1])):
+        valid_scores = [r[2] for r in rows]
         if len(valid_scores) > 2:
-            middle_entry = len(valid_scores) / 2
-            league["median"] = valid_scores[int(middle_entry)]
-    season["leagues"].sort(reverse=True, key=lambda x: x["median"])
+            league_medians[key] = valid_scores[len(valid_scores) // 2]
+
+    rosters = {
+        tid: [(r[1], r[2], None if r[3] is None else round(r[3], 2))
+              for r in rows]
+        for tid, rows in itertools.groupby(cur.execute(roster_query),
+                                           key=lambda r: r[0])
+    }  # type: Dict[int, List[Tuple[int, str, float]]]
+
+    season_profiles = []  # type: List[Dict]
+    for s, season_rows in itertools.groupby(cur.execute(team_scores_query),
+                                            key=lambda r: r[0]):
+        season = {}  # type: Dict[str, Any]
+        season["id"] = s
+        season["name"] = seasons.get(s, "UNKNOWN")
+        season["leagues"] = []
+        season_profiles.append(season)
+
+        for l, league_rows in itertools.groupby(season_rows,
+                                                key=lambda r: r[1]):
+            league = {}  # type: Dict[str, Any]
+            league["id"] = l
+            league["name"] = league_names.get(l, "UNKNOWN")
+            league["median"] = league_medians.get((s, l), float("nan"))
+            league["teams"] = [{
+                "id": tid,
+                "name": name,
+                "top6": top6,
+                "players": rosters.get(tid, [])
+            } for _, _, tid, name, top6 in league_rows]
+            season["leagues"].append(league)
+        # leagues without enough rated players have a nan median, which
+        # doesn't compare, so they go last
+        season["leagues"].sort(
+            reverse=True,
+            key=lambda x: (not math.isnan(x["median"]), x["median"]))
+    cur.execute("drop table PlayerScores;")
+    cur.execute("drop table ActivePlayerTeams;")
+    return season_profiles
+
+
+def main():
+    overall = Leaderboard(OVERALL)
+    con = load_rgl.connect()
+    with RatingHistory() as history:
+        season_profiles = get_season_profiles(con, overall.items(), history)
+    overall.close()
+    con.close()
 
-print(len(season_profiles), "seasons found")
+    print(len(season_profiles), "seasons found")
+    print(write_pages(season_profiles), "seasons changed")
 
-season_profiles.sort(reverse=True, key=lambda x: x["id"])
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"),
-                               autoescape=True)
-league_template = jinja_env.get_template("leagues.html")
 
-with open("html/leagues.html", "w", encoding="utf-8") as f:
-    f.write(league_template.render(seasons=season_profiles))
+if __name__ == "__main__":
+    main()
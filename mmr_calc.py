@@ -1,90 +1,141 @@
 #!/usr/bin/env python3
 """
-This script calculates the mmr of players in the game_logs.json file using
-the trueskill ranking algorithm.  It stores the results in player_scores.csv.
+This script calculates the mmr of players in the log archive using
+the trueskill ranking algorithm.  It stores the results in player_scores.csv
+and every intermediate rating in the rating history (see rating_history.py).
+Players are also rated separately for each game format, and the overall and
+per format ratings are written as leaderboards (see leaderboard.py).
+Logs flagged as duplicates of another log (see dedupe.py) are skipped.
 """
 
-import json
 from typing import Dict, Iterator, List, Tuple, Any
 import trueskill  # type: ignore
-from steam.steamid import SteamID  # type: ignore
+from steam_ids import id3_to_id64
+import rating_history
+import log_archive
+import leaderboard
+import link_match_logs
+import dedupe
 
-player_ratings = {}  # type: Dict[int, Any]
+player_ratings = {}  # type: Dict[str, Any]
+format_ratings = {f: {}
+                  for f in link_match_logs.RATED_FORMATS
+                  }  # type: Dict[link_match_logs.Tf2Format, Dict[str, Any]]
+id64s = {}  # type: Dict[str, int]
 
 
 def get_sorted_games():  # type: () -> Iterator[Dict]
     """
     This function yields game logs one at a time, sorted by their upload
-    time
+    time, leaving out duplicate logs
     """
 
+    duplicates = dedupe.read_duplicates()
     log_index = []  # type: List[Tuple[int, int]]
-    with open("game_logs.json", encoding="utf-8") as game_log:
-        start = 0  # pylint: disable=C0103
-        while True:
-            gdata = game_log.readline()
-
-            # if the end of file has been reached, an empty string is returned
-            if gdata == "":
-                break
-
-            game_data = json.loads(gdata)
-            log_index.append((game_data["info"]["date"], start))
-            start = game_log.tell()
-
-        log_index.sort()
-        for _, location in log_index:
-            game_log.seek(location)
-            yield json.loads(game_log.readline())
-
-
-def main():
-    for game in get_sorted_games():
-        # creating ratings for new players
-        for player_id in game["players"]:
-            if player_id not in player_ratings:
-                player_ratings[player_id] = trueskill.Rating()
-
-        red_ids = [
-            i for i in game["players"] if game["players"][i]["team"] == "Red"
-        ]
-        blue_ids = [
-            i for i in game["players"] if game["players"][i]["team"] == "Blue"
-        ]
-
-        red_ratings = [player_ratings[i] for i in red_ids]
-        blue_ratings = [player_ratings[i] for i in blue_ids]
-
-        if not red_ratings or not blue_ratings:
-            # ignoring games without an opposing team
+    for header in log_archive.iter_headers():
+        if header.id in duplicates:
             continue
+        log_index.append((header.date, header.offset))
 
-        if game["teams"]["Red"]["score"] > game["teams"]["Blue"]["score"]:
-            # Red Victory
-            ranks = [0, 1]
-        elif game["teams"]["Red"]["score"] < game["teams"]["Blue"]["score"]:
-            # Blue victory
-            ranks = [1, 0]
-        else:
-            # tie
-            ranks = [0, 0]
+    log_index.sort()
+    with open(log_archive.ARCHIVE_FILE, "rb") as game_log:
+        for _, location in log_index:
+            yield log_archive.read_log(game_log, location)
 
-        # the "ranks" parameter specifies which place each team came in.
-        # The first number, in this case refers to red, and the second to
-        # blue. 0 is "first" 1 is "second"
-        new_ratings = trueskill.rate([red_ratings, blue_ratings], ranks=ranks)
 
-        [new_red_ratings, new_blue_ratings] = new_ratings
+def rate_game(game):  # type: (Dict) -> List[str]
+    """
+    updates the overall and format ratings of the players of a game, and
+    returns the ids of the players rated.  Games without an opposing team
+    aren't rated, and games of an unknown format only change the overall
+    ratings.
+    """
+    # creating ratings for new players
+    for player_id in game["players"]:
+        if player_id not in player_ratings:
+            player_ratings[player_id] = trueskill.Rating()
+            id64s[player_id] = id3_to_id64(player_id)
+
+    red_ids = [
+        i for i in game["players"] if game["players"][i]["team"] == "Red"
+    ]
+    blue_ids = [
+        i for i in game["players"] if game["players"][i]["team"] == "Blue"
+    ]
+
+    red_ratings = [player_ratings[i] for i in red_ids]
+    blue_ratings = [player_ratings[i] for i in blue_ids]
+
+    if not red_ratings or not blue_ratings:
+        # ignoring games without an opposing team
+        return []
+
+    game_format = format_ratings.get(link_match_logs.get_format(game))
+
+    if game["teams"]["Red"]["score"] > game["teams"]["Blue"]["score"]:
+        # Red Victory
+        ranks = [0, 1]
+    elif game["teams"]["Red"]["score"] < game["teams"]["Blue"]["score"]:
+        # Blue victory
+        ranks = [1, 0]
+    else:
+        # tie
+        ranks = [0, 0]
+
+    # the "ranks" parameter specifies which place each team came in.
+    # The first number, in this case refers to red, and the second to
+    # blue. 0 is "first" 1 is "second"
+    new_ratings = trueskill.rate([red_ratings, blue_ratings], ranks=ranks)
+
+    [new_red_ratings, new_blue_ratings] = new_ratings
+
+    for pid, rank in zip(red_ids, new_red_ratings):
+        player_ratings[pid] = rank
+
+    for pid, rank in zip(blue_ids, new_blue_ratings):
+        player_ratings[pid] = rank
+
+    if game_format is not None:
+        for player_id in red_ids + blue_ids:
+            if player_id not in game_format:
+                game_format[player_id] = trueskill.Rating()
+        new_format_ratings = trueskill.rate(
+            [[game_format[i] for i in red_ids],
+             [game_format[i] for i in blue_ids]],
+            ranks=ranks)
+        for pid, rank in zip(red_ids + blue_ids,
+                             new_format_ratings[0] + new_format_ratings[1]):
+            game_format[pid] = rank
+
+    return red_ids + blue_ids
+
+
+def write_ratings():  # type: () -> None
+    """
+    writes player_scores.csv and the leaderboards
+    """
+    with open("player_scores.csv", "w", encoding="utf-8") as f:
+        for pid, rating in player_ratings.items():
+            f.write("{},{}\n".format(id64s[pid], rating.mu))
 
-        for pid, rank in zip(red_ids, new_red_ratings):
-            player_ratings[pid] = rank
+    leaderboard.write_leaderboard(
+        leaderboard.OVERALL,
+        {id64s[pid]: r.mu
+         for pid, r in player_ratings.items()})
+    for game_format, ratings in format_ratings.items():
+        leaderboard.write_leaderboard(
+            game_format.name, {id64s[pid]: r.mu
+                               for pid, r in ratings.items()})
 
-        for pid, rank in zip(blue_ids, new_blue_ratings):
-            player_ratings[pid] = rank
 
-    with open("player_scores.csv", "w", encoding="utf-8") as f:
-        for pid, rating in player_ratings.items():
-            f.write("{},{}\n".format(SteamID(pid).as_64, rating.mu))
+def main():
+    history = rating_history.HistoryWriter()
+    for game in get_sorted_games():
+        for pid in rate_game(game):
+            history.append(id64s[pid], game["id"], game["info"]["date"],
+                           player_ratings[pid])
+    history.close()
+    write_ratings()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-from typing import Dict, Union, Tuple, Optional
-from steam.steamid import SteamID  # type: ignore
+from typing import Callable, Dict, List, NamedTuple, Union, Tuple, Optional
+import steam_ids
 import link_match_logs
 
 id3_to_id64: Dict[str, int] = {}
@@ -123,29 +123,64 @@ def get_team(id3: str, game_log: Dict) -> str:
     
 
 
+DerivedStat = NamedTuple(
+    "DerivedStat",
+    [
+        ("version", int),
+        ("columns", List[str]),
+        ("compute", Callable[[str, Dict], Tuple]),
+    ],
+)
+
+# the stats of a player that are computed by a heuristic rather than
+# copied from logs.tf, the PlayerStats columns each one fills, and the
+# version of its definition.  Bump the version when a definition changes,
+# and make_db.py recomputes those columns in the logs made with an older
+# version.  Logs without a version for a stat were made by version 1.
+derived_stats = {
+    "team":
+    DerivedStat(1, ["team"], lambda id3, g: (get_team(id3, g), )),
+    "midfights":
+    DerivedStat(1, ["mids_survived", "mid_deaths"], get_midfight_survival),
+    "med_drops":
+    DerivedStat(1, ["med_drops"], lambda id3, g: (get_meds_dropped(id3, g), )),
+    "heals_received":
+    DerivedStat(1, ["heals_received"],
+                lambda id3, g: (get_heals_received(id3, g), )),
+}  # type: Dict[str, DerivedStat]
+
+
+def get_derived_stats(id3: str, game_log: Dict) -> Dict:
+    """
+    returns the derived stats of a player in a game log by column
+    """
+    derived: Dict = {}
+    for stat in derived_stats.values():
+        derived.update(zip(stat.columns, stat.compute(id3, game_log)))
+    return derived
+
+
 def get_user_class_stats(game_log: Dict) -> Dict[str, Dict]:
     user_classes: Dict[str, Dict] = {}
     game_format = link_match_logs.get_format(game_log)
     for id3, player in game_log["players"].items():
         if id3 not in id3_to_id64:
-            id3_to_id64[id3] = SteamID(id3).as_64
+            id3_to_id64[id3] = steam_ids.id3_to_id64(id3)
 
         player_time = sum([c["total_time"] for c in player["class_stats"]])
+        derived = get_derived_stats(id3, game_log)
 
         for class_stat in player["class_stats"]:
             class_name = class_stat["type"]
             user_entry: Dict[str, Union[int, str]] = {}
 
             # user_entry["log_id"] = game_log["id"]
-            user_entry["team"] = get_team(id3, game_log) 
+            user_entry.update(derived)
             user_entry["player_id"] = id3_to_id64[id3]
             user_entry["tf2_class"] = class_name
             user_entry["format"] = game_format.name
 
             user_entry["drops"] = player["drops"]
-            mfs = get_midfight_survival(id3, game_log)
-            user_entry["mids_survived"] = mfs[0]
-            user_entry["mid_deaths"] = mfs[1]
 
             user_entry["headshots_hit"] = player["headshots_hit"]
             user_entry["backstabs"] = player["backstabs"]
@@ -156,10 +191,9 @@ def get_user_class_stats(game_log: Dict) -> Dict[str, Dict]:
             user_entry["deaths"] = class_stat["deaths"]
             user_entry["dmg"] = class_stat["dmg"]
             user_entry["total_time"] = class_stat["total_time"]
-            user_entry["playtime_pct"] = int(class_stat["total_time"] /
-                                             game_log["length"] * 100)
-            user_entry["med_drops"] = get_meds_dropped(id3, game_log)
-            user_entry["heals_received"] = get_heals_received(id3, game_log)
+            user_entry["playtime_pct"] = int(
+                class_stat["total_time"] / game_log["length"] *
+                100) if game_log["length"] else 0
             for m in med_stats:
                 user_entry[m] = player.get("medicstats", {}).get(m, 0)
 
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+The per log tables of stats.db, MatchLogs, PlayerStats and ClassMatchups,
+are split into one database per month of upload in stats_partitions/.  The
+other tables stay in stats.db.
+
+make_db.py writes each log into the partition of its month.  A month is
+sealed SEAL_DAYS after it ends, which leaves time for late logs to be
+archived and for their duplicates to be flagged.  Sealed partitions are
+vacuumed once and only written again by schema migrations and by
+recomputing stale derived stats, which unseal them first and seal them
+again after: make_db.py skips their logs, backups only need to copy them
+again when they were resealed, and queries open them as immutable files.
+
+connect() opens stats.db with the partitions of a time window attached,
+and with temporary views named after the partitioned tables that union
+them, so queries don't need to know about the partitions.  sqlite can only
+attach MAX_ATTACHED databases, so longer windows are read in batches of
+months with connect_batches(), combining the results of each batch.
+"""
+
+import datetime
+import glob
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import sql_commands
+
+PARTITION_DIR = "stats_partitions"
+SEAL_DAYS = 7
+# sqlite's default limit on the number of attached databases
+MAX_ATTACHED = 10
+TABLES = ["MatchLogs", "PlayerStats", "ClassMatchups"]
+
+
+def month_of(timestamp):  # type: (float) -> str
+    """
+    returns the local year and month of a unix time as "YYYY-MM", the
+    month match_time is in
+    """
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m")
+
+
+def month_end(month):  # type: (str) -> float
+    year, number = (int(n) for n in month.split("-"))
+    if number == 12:
+        year, number = year + 1, 1
+    else:
+        number += 1
+    return datetime.datetime(year, number, 1).timestamp()
+
+
+def partition_file(month):  # type: (str) -> str
+    return os.path.join(PARTITION_DIR, month + ".db")
+
+
+def schema_name(month):  # type: (str) -> str
+    return "p_" + month.replace("-", "_")
+
+
+def partition_months(start=None, end=None):
+    # type: (Optional[float], Optional[float]) -> List[str]
+    """
+    returns the months with a partition that overlap the unix times
+    [start, end), or all of them
+    """
+    months = sorted(
+        os.path.splitext(os.path.basename(f))[0]
+        for f in glob.glob(os.path.join(PARTITION_DIR, "????-??.db")))
+    if start is not None:
+        months = [m for m in months if m >= month_of(start)]
+    if end is not None:
+        months = [m for m in months if m <= month_of(end)]
+    return months
+
+
+def create_tables(con, temp=False):
+    # type: (sqlite3.Connection, bool) -> None
+    for create in (sql_commands.create_match_table,
+                   sql_commands.create_player_stats,
+                   sql_commands.create_class_matchups):
+        if temp:
+            create = create.replace("create table", "create temp table", 1)
+        con.execute(create)
+    con.execute(sql_commands.create_match_time_index)
+    con.execute(sql_commands.create_player_time_index)
+    if not temp:
+        con.execute(sql_commands.create_derived_versions)
+
+
+def sealed_months(con):  # type: (sqlite3.Connection) -> Set[str]
+    con.execute(sql_commands.create_partitions)
+    return {month for month, in con.execute("select month from Partitions;")}
+
+
+def find_logs(logs):
+    # type: (Iterable[Tuple[int, float]]) -> Dict[str, List[int]]
+    """
+    returns the logs, given by their id and unix time, that are in the
+    partitions of their months, by month
+    """
+    by_month = {}  # type: Dict[str, List[int]]
+    for log_id, timestamp in logs:
+        by_month.setdefault(month_of(timestamp), []).append(log_id)
+    found = {}  # type: Dict[str, List[int]]
+    for month, log_ids in sorted(by_month.items()):
+        if not os.path.isfile(partition_file(month)):
+            continue
+        part = sqlite3.connect("file:{}?mode=ro".format(partition_file(month)),
+                               uri=True)
+        present = [
+            log_id for log_id in log_ids if part.execute(
+                "select 1 from MatchLogs where log_id = ?;", (log_id, ))
+            .fetchone()
+        ]
+        part.close()
+        if present:
+            found[month] = present
+    return found
+
+
+def delete_logs(part, log_ids):
+    # type: (sqlite3.Connection, Iterable[int]) -> None
+    """
+    deletes the rows of logs from a partition, like logs that were flagged
+    as duplicates after they were inserted
+    """
+    rows = [(log_id, ) for log_id in log_ids]
+    for table in TABLES + ["DerivedVersions"]:
+        part.executemany("delete from {} where log_id = ?;".format(table),
+                         rows)
+
+
+def seal(con, month, part=None):
+    # type: (sqlite3.Connection, str, Optional[sqlite3.Connection]) -> None
+    """
+    vacuums the partition of a month, closing its connection if given, and
+    records it as sealed in stats.db
+    """
+    if part is None:
+        part = sqlite3.connect(partition_file(month))
+    part.commit()
+    (logs, ) = part.execute("select count(*) from MatchLogs;").fetchone()
+    part.execute("vacuum;")
+    part.close()
+    con.execute("insert or replace into Partitions values (?, ?);",
+                (month, logs))
+
+
+def unseal(con, month):  # type: (sqlite3.Connection, str) -> None
+    """
+    records the partition of a month as not sealed, so that it's attached
+    writable and can be changed.  It should be sealed again after.
+    """
+    con.execute("delete from Partitions where month = ?;", (month, ))
+    con.commit()
+
+
+class PartitionWriter:
+    """
+    Writes logs into the partitions of their months, keeping a connection
+    to each partition written.  con is the connection to stats.db, which
+    records the sealed months.
+    """
+
+    def __init__(self, con):  # type: (sqlite3.Connection) -> None
+        self.con = con
+        self.sealed = sealed_months(con)
+        self.partitions = {}  # type: Dict[str, sqlite3.Connection]
+
+    def partition(self, timestamp):
+        # type: (float) -> Optional[sqlite3.Connection]
+        """
+        returns the partition of the month of a unix time, or None if the
+        month is sealed
+        """
+        month = month_of(timestamp)
+        if month in self.sealed:
+            return None
+        if month not in self.partitions:
+            os.makedirs(PARTITION_DIR, exist_ok=True)
+            part = sqlite3.connect(partition_file(month))
+            create_tables(part)
+            self.partitions[month] = part
+        return self.partitions[month]
+
+    def commit(self):  # type: () -> None
+        for part in self.partitions.values():
+            part.commit()
+
+    def seal(self, now=None):  # type: (Optional[float]) -> List[str]
+        """
+        vacuums and seals the partitions of months that ended SEAL_DAYS
+        before now, and returns those months
+        """
+        if now is None:
+            now = time.time()
+        sealed = []  # type: List[str]
+        for month in partition_months():
+            if (month in self.sealed
+                    or month_end(month) + SEAL_DAYS * 24 * 60 * 60 > now):
+                continue
+            seal(self.con, month, self.partitions.pop(month, None))
+            self.sealed.add(month)
+            sealed.append(month)
+        self.con.commit()
+        return sealed
+
+    def close(self):  # type: () -> None
+        for part in self.partitions.values():
+            part.commit()
+            part.close()
+        self.partitions = {}
+
+
+def attach(con, month, sealed):
+    # type: (sqlite3.Connection, str, bool) -> None
+    uri = "file:{}?mode=ro".format(partition_file(month))
+    if sealed:
+        # sealed partitions never change, so sqlite can skip locking them
+        uri += "&immutable=1"
+    con.execute("attach database ? as {};".format(schema_name(month)), (uri, ))
+
+
+def attach_views(con, months, sealed):
+    # type: (sqlite3.Connection, List[str], Set[str]) -> None
+    """
+    attaches the partitions of at most MAX_ATTACHED months, and creates
+    the temporary views of the partitioned tables over them
+    """
+    if not months:
+        create_tables(con, temp=True)
+    for month in months:
+        attach(con, month, month in sealed)
+    for table in TABLES if months else []:
+        con.execute("create temp view {} as {};".format(
+            table, " union all ".join(
+                "select * from {}.{}".format(schema_name(m), table)
+                for m in months)))
+    con.execute(sql_commands.create_player_stats_view)
+    con.execute(sql_commands.create_matchup_totals_view)
+
+
+def detach_views(con, months):
+    # type: (sqlite3.Connection, List[str]) -> None
+    con.commit()
+    for table in TABLES:
+        con.execute("drop view temp.{};".format(table))
+    for month in months:
+        con.execute("detach database {};".format(schema_name(month)))
+
+
+def connect(start=None, end=None):
+    # type: (Optional[float], Optional[float]) -> sqlite3.Connection
+    """
+    opens stats.db with the partitioned tables as temporary views of the
+    partitions of the months overlapping the unix times [start, end), or of
+    all months.  Raises ValueError when there are more partitions than
+    sqlite can attach; those windows are read with connect_batches.
+    """
+    months = partition_months(start, end)
+    if len(months) > MAX_ATTACHED:
+        raise ValueError("{} partitions is more than {} can be attached, "
+                         "use connect_batches".format(
+                             len(months), MAX_ATTACHED))
+    con = sql_commands.connect()
+    sealed = sealed_months(con)
+    con.commit()
+    attach_views(con, months, sealed)
+    return con
+
+
+def connect_batches(start=None, end=None):
+    # type: (Optional[float], Optional[float]) -> Iterator[sqlite3.Connection]
+    """
+    opens stats.db like connect, for windows of any number of months.
+    Yields the connection once for each batch of at most MAX_ATTACHED
+    months, with the views over only that batch, and detaches the batch
+    before attaching the next.  Queries aggregate each batch and the caller
+    combines them, which is exact for sums and per log counts since each
+    log is in one partition.
+    """
+    con = sql_commands.connect()
+    sealed = sealed_months(con)
+    con.commit()
+    months = partition_months(start, end)
+    try:
+        for i in range(0, max(len(months), 1), MAX_ATTACHED):
+            batch = months[i:i + MAX_ATTACHED]
+            attach_views(con, batch, sealed)
+            yield con
+            if batch:
+                detach_views(con, batch)
+    finally:
+        con.close()
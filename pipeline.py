@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Runs the nightly scripts as a pipeline of stages.  Each stage declares the
+files it reads and writes, and a stage is skipped when its inputs are the
+same as the last time it ran successfully and its outputs exist.  Stages
+run as soon as the stages writing their inputs have finished, so the
+logs.tf download and the rgl crawl run at the same time.
+
+Files are fingerprinted by a sha1 of their contents, which is only
+recomputed when their size or modification time changes.  An input of the
+form "stats.db#Table" is a table of stats.db, fingerprinted by its rows.
+A directory is fingerprinted by the names, sizes and modification times of
+the files in it, leaving out the compressed copies made by
+compress_site.py.
+The fingerprints are kept in pipeline_state.json.
+
+The crawlers have no inputs, so nothing tells them when the sites
+changed.  They run unless --offline is given or they finished less than
+--crawl-interval hours ago, so running the pipeline again the same day
+doesn't crawl again.  The rgl crawl waits 5 seconds between pages and
+takes hours, so --offline is needed to only rebuild what changed locally.
+The crawlers both write stats.db, archive_logs.py the duplicate logs and
+get_rgl_matches.py the rgl tables, and wait for each other's locks (see
+sql_commands.connect).
+
+usage: pipeline.py [--offline] [--crawl-interval 20] [--force] [--dry-run]
+                   [--jobs N] [stage ...]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+import compress_site
+import load_rgl
+import log_archive
+import rating_history
+import sql_commands
+from leaderboard import leaderboard_file, OVERALL
+
+STATE_FILE = "pipeline_state.json"
+
+Stage = NamedTuple(
+    "Stage",
+    [
+        ("name", str),
+        ("command", List[str]),
+        ("inputs", List[str]),
+        ("outputs", List[str]),
+    ],
+)
+
+RGL_FILES = [
+    load_rgl.MATCHES_FILE,
+    load_rgl.PLAYER_TEAMS_FILE,
+    load_rgl.TEAMS_FILE,
+    load_rgl.SEASONS_FILE,
+    load_rgl.LEAGUES_FILE,
+    load_rgl.USERS_FILE,
+]
+LINKS = sql_commands.db_file + "#RglMatchLogs"
+DUPLICATES = sql_commands.db_file + "#DuplicateLogs"
+USERS = sql_commands.db_file + "#Users"
+OVERALL_BOARD = leaderboard_file(OVERALL)
+
+STAGES = [
+    Stage("archive_logs", ["archive_logs.py"], [],
+          [log_archive.ARCHIVE_FILE, DUPLICATES]),
+    Stage("get_rgl_matches", ["get_rgl_matches.py"], [], RGL_FILES),
+    Stage("timeline", ["timeline.py"], [log_archive.ARCHIVE_FILE],
+          ["timeline"]),
+    Stage("link_match_logs", ["link_match_logs.py"],
+          [log_archive.ARCHIVE_FILE, "region_format.csv"] + RGL_FILES,
+          [LINKS]),
+    Stage("mmr_calc", ["mmr_calc.py"], [log_archive.ARCHIVE_FILE, DUPLICATES],
+          [
+              "player_scores.csv", rating_history.HISTORY_FILE,
+              rating_history.INDEX_FILE, OVERALL_BOARD
+          ]),
+    Stage("make_db", ["make_db.py"],
+          [log_archive.ARCHIVE_FILE, DUPLICATES, "parse_logs.py"], [USERS]),
+    Stage("get_stats", ["get_stats.py"], [
+        log_archive.ARCHIVE_FILE, DUPLICATES, LINKS, OVERALL_BOARD,
+        load_rgl.MATCHES_FILE, load_rgl.SEASONS_FILE,
+        "templates/base.html", "templates/profile.html"
+    ], ["html/players", "html/usernames.json", "similarity"]),
+    Stage("leaderboard", ["leaderboard.py"], [
+        OVERALL_BOARD, USERS, "templates/base.html",
+        "templates/leaderboard.html"
+    ], ["html/leaderboard"]),
+    Stage("make_league_report", ["make_league_report.py"], [
+        OVERALL_BOARD, rating_history.HISTORY_FILE, rating_history.INDEX_FILE,
+        "templates/base.html", "templates/leagues.html",
+        "templates/league_season.html"
+    ] + RGL_FILES, ["html/leagues.html", "html/leagues"]),
+    Stage("make_index", ["make_index.py"],
+          ["templates/base.html", "templates/index.html"],
+          ["html/index.html"]),
+    Stage("compress_site", ["compress_site.py"], [
+        "html/players", "html/usernames.json", "html/leaderboard",
+        "html/leagues.html", "html/leagues", "html/index.html",
+        "html/style.css"
+    ], [compress_site.MANIFEST_FILE]),
+]
+
+
+def file_hash(path):  # type: (str) -> str
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def directory_hash(path):  # type: (str) -> str
+    digest = hashlib.sha1()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(compress_site.COMPRESSED_SUFFIXES):
+                continue
+            stat = os.stat(os.path.join(root, name))
+            digest.update("{} {} {}\n".format(
+                os.path.relpath(os.path.join(root, name), path),
+                stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def table_hash(db_file, table):  # type: (str, str) -> Optional[str]
+    if not os.path.isfile(db_file):
+        return None
+    con = sqlite3.connect(db_file, timeout=sql_commands.db_timeout)
+    try:
+        digest = hashlib.sha1()
+        for row in con.execute("select * from {};".format(table)):
+            digest.update(repr(row).encode("utf-8"))
+        return digest.hexdigest()
+    except sqlite3.DatabaseError:
+        # the table hasn't been made yet
+        return None
+    finally:
+        con.close()
+
+
+class Fingerprints:
+    """
+    Content hashes of files and tables.  File hashes are cached with the
+    size and modification time they were computed for.
+    """
+
+    def __init__(self, cache):  # type: (Dict[str, List]) -> None
+        self.cache = cache
+
+    def get(self, path):  # type: (str) -> Optional[str]
+        if "#" in path:
+            db_file, table = path.split("#")
+            return table_hash(db_file, table)
+        if os.path.isdir(path):
+            return directory_hash(path)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = file_hash(path)
+        self.cache[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def of(self, paths):  # type: (List[str]) -> Dict[str, Optional[str]]
+        return {p: self.get(p) for p in paths}
+
+
+def output_exists(path):  # type: (str) -> bool
+    if "#" in path:
+        return os.path.isfile(path.split("#")[0])
+    return os.path.exists(path)
+
+
+def dependencies(stages):  # type: (List[Stage]) -> Dict[str, Set[str]]
+    """
+    maps each stage to the earlier stages that write one of its inputs
+    """
+    writers = {}  # type: Dict[str, str]
+    deps = {}  # type: Dict[str, Set[str]]
+    for stage in stages:
+        deps[stage.name] = {
+            writers[i]
+            for i in stage.inputs if i in writers
+        }
+        for output in stage.outputs:
+            writers[output] = stage.name
+    return deps
+
+
+def save_state(state):  # type: (Dict[str, Dict]) -> None
+    with open(STATE_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+
+
+def run_stage(stage):  # type: (Stage) -> Tuple[int, str, float]
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + stage.command,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    return result.returncode, result.stdout, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stages",
+                        nargs="*",
+                        help="only run these stages (default: all)")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="don't run the crawlers")
+    parser.add_argument("--crawl-interval",
+                        type=float,
+                        default=20,
+                        help="hours after a crawl before the crawler runs "
+                        "again")
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="run stages even if they're up to date")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="print the stages that would run")
+    parser.add_argument("--jobs", type=int, default=4)
+    args = parser.parse_args()
+
+    state = {"files": {}, "stages": {}}  # type: Dict[str, Dict]
+    if os.path.isfile(STATE_FILE):
+        with open(STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+    fingerprints = Fingerprints(state["files"])
+
+    stages = [s for s in STAGES if not args.stages or s.name in args.stages]
+    deps = dependencies(stages)
+    by_name = {s.name: s for s in stages}
+    waiting = [s.name for s in stages]
+    # the futures of the running stages, with their names and inputs
+    running = {}  # type: Dict[Any, Tuple[str, Dict[str, Optional[str]]]]
+    done = set()  # type: Set[str]
+    failed = set()  # type: Set[str]
+    would_run = set()  # type: Set[str]
+
+    def start_ready(pool):
+        for name in list(waiting):
+            if not deps[name] <= done | failed:
+                continue
+            waiting.remove(name)
+            stage = by_name[name]
+            if deps[name] & failed:
+                print(name, "not run, an earlier stage failed")
+                failed.add(name)
+                continue
+
+            if not stage.inputs:
+                crawled = state.get("crawled", {}).get(name, 0)
+                up_to_date = (args.offline or time.time() - crawled <
+                              args.crawl_interval * 60 * 60)
+            else:
+                inputs = fingerprints.of(stage.inputs)
+                up_to_date = (state["stages"].get(name) == inputs and all(
+                    output_exists(o) for o in stage.outputs))
+            if args.dry_run and deps[name] & would_run:
+                up_to_date = False
+            if up_to_date and not args.force:
+                if stage.inputs:
+                    print(name, "up to date")
+                else:
+                    print(name, "skipped offline" if args.offline else
+                          "crawled recently")
+                done.add(name)
+            elif args.dry_run:
+                print(name, "would run")
+                would_run.add(name)
+                done.add(name)
+            else:
+                print(name, "running")
+                inputs = fingerprints.of(stage.inputs)
+                running[pool.submit(run_stage, stage)] = (name, inputs)
+
+    with ThreadPoolExecutor(args.jobs) as pool:
+        start_ready(pool)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, inputs = running.pop(future)
+                returncode, output, elapsed = future.result()
+                if output.strip():
+                    print("\n".join("  {}: {}".format(name, line)
+                                    for line in output.strip().split("\n")))
+                if returncode:
+                    print(name, "failed with exit code", returncode)
+                    failed.add(name)
+                else:
+                    print("{} finished in {:.1f}s".format(name, elapsed))
+                    state["stages"][name] = inputs
+                    if not by_name[name].inputs:
+                        state.setdefault("crawled", {})[name] = time.time()
+                    done.add(name)
+                    save_state(state)
+            start_ready(pool)
+
+    if not args.dry_run:
+        save_state(state)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
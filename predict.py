@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Predicts the result of rgl matches from the trueskill ratings of the teams'
+rosters.  Every match is scored in one batch of numpy array operations:
+each team is rated by the best rated players on its roster on the match
+date (see roster_index.py), as many as the format plays at once, using the
+ratings they had on that date.
+
+The win probability of the first team and the trueskill match quality are
+stored in the RglPredictions table of stats.db.  Matches that have been
+played are used to score the predictions by Brier score, log loss and
+accuracy, which are stored in RglPredictionScores.
+
+usage: predict.py [--season SEASON_ID]
+"""
+
+import argparse
+import math
+import time
+from typing import Any, Dict, List, Set, Tuple
+import numpy as np  # type: ignore
+import trueskill  # type: ignore
+import get_rgl_matches
+import link_match_logs
+import load_rgl
+from link_match_logs import Tf2Format
+from rating_history import RatingHistory
+from roster_index import RosterIndex
+
+create_predictions = """
+create table if not exists RglPredictions
+(
+rgl_id int primary key,
+team1_win_prob real,
+quality real
+);
+"""
+
+insert_prediction = """
+insert or replace into RglPredictions values (?, ?, ?);
+"""
+
+# the scores of the predictions of the played matches of a season, or of
+# every season as season 0, from the last run
+create_prediction_scores = """
+create table if not exists RglPredictionScores
+(
+season_id int primary key,
+matches int,
+brier real,
+log_loss real,
+accuracy real,
+scored real
+);
+"""
+
+insert_prediction_score = """
+insert or replace into RglPredictionScores values (?, ?, ?, ?, ?, ?);
+"""
+
+TEAM_SIZES = {
+    Tf2Format.fours: 4,
+    Tf2Format.sixes: 6,
+    Tf2Format.prolander: 7,
+    Tf2Format.highlander: 9,
+}
+
+
+def erf(x):  # type: (Any) -> Any
+    """
+    vectorized error function (Abramowitz and Stegun 7.1.26, accurate to
+    about 1e-7)
+    """
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t *
+                                    (1.421413741 + t *
+                                     (-1.453152027 + t * 1.061405429))))
+    return sign * (1 - poly * np.exp(-x * x))
+
+
+def win_probability(mu1, mu2, var, players, beta):
+    # type: (Any, Any, Any, Any, float) -> Any
+    """
+    the probability that the first team wins, given the summed mu of each
+    team, the summed sigma squared of every player, and the player count
+    """
+    spread = np.sqrt(players * beta**2 + var)
+    return 0.5 * (1 + erf((mu1 - mu2) / (spread * math.sqrt(2))))
+
+
+def match_quality(mu1, mu2, var, players, beta):
+    # type: (Any, Any, Any, Any, float) -> Any
+    """
+    trueskill.quality for two teams, computed for arrays of matches
+    """
+    denominator = players * beta**2 + var
+    return (np.sqrt(players * beta**2 / denominator) *
+            np.exp(-(mu1 - mu2)**2 / (2 * denominator)))
+
+
+def team_ratings(mu, sigma, team_size):
+    # type: (Any, Any, Any) -> Tuple[Any, Any, Any]
+    """
+    given (matches, roster size) arrays of mu and sigma, padded with nan,
+    returns the summed mu and sigma squared and the number of players of
+    each team's best rated lineup
+    """
+    order = np.argsort(-np.nan_to_num(mu, nan=-np.inf), axis=1)
+    ranked_mu = np.take_along_axis(mu, order, axis=1)
+    ranked_sigma = np.take_along_axis(sigma, order, axis=1)
+    positions = np.arange(mu.shape[1])[None, :]
+    lineup = (positions < team_size[:, None]) & ~np.isnan(ranked_mu)
+    return (np.where(lineup, ranked_mu, 0).sum(axis=1),
+            np.where(lineup, ranked_sigma**2, 0).sum(axis=1),
+            lineup.sum(axis=1))
+
+
+def score_predictions(prob, team1_won):
+    # type: (Any, Any) -> Tuple[float, float, float]
+    """
+    returns the Brier score, log loss and accuracy of win probabilities.
+    A match counts as called correctly when the team given more than even
+    odds won.
+    """
+    brier = float(np.mean((prob - team1_won)**2))
+    clipped = np.clip(prob, 1e-12, 1 - 1e-12)
+    log_loss = float(-np.mean(team1_won * np.log(clipped) +
+                              (1 - team1_won) * np.log(1 - clipped)))
+    accuracy = float(np.mean((prob > 0.5) == (team1_won == 1)))
+    return brier, log_loss, accuracy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--season", type=int)
+    args = parser.parse_args()
+
+    env = trueskill.TrueSkill()
+    region_format = link_match_logs.read_region_formats()
+    player_entries = get_rgl_matches.read_player_entries()
+    rosters = RosterIndex(player_entries)
+    team_players = {}  # type: Dict[int, Set[int]]
+    team_format = {}  # type: Dict[int, Tf2Format]
+    for p in player_entries:
+        team_players.setdefault(p.team_id, set()).add(p.id)
+        team_format[p.team_id] = region_format[p.region_id]
+
+    # each team is rated by the players on it on the match date, or by
+    # everyone who was ever on it for matches without a date
+    rgl_matches = []  # type: List[get_rgl_matches.RglMatch]
+    match_rosters = []  # type: List[Tuple[List[int], List[int]]]
+    for m in get_rgl_matches.read_matches(args.season):
+        if m.team1 not in team_players or m.team2 not in team_players:
+            continue
+        if m.date:
+            roster1 = rosters.roster_at(m.team1, m.date.timestamp())
+            roster2 = rosters.roster_at(m.team2, m.date.timestamp())
+        else:
+            roster1, roster2 = team_players[m.team1], team_players[m.team2]
+        if roster1 and roster2:
+            rgl_matches.append(m)
+            match_rosters.append((sorted(roster1), sorted(roster2)))
+    if not rgl_matches:
+        print("no matches with known rosters")
+        return
+
+    width = max(len(r) for rs in match_rosters for r in rs)
+    shape = (len(rgl_matches), width)
+    mu1, sigma1 = np.full(shape, np.nan), np.full(shape, np.nan)
+    mu2, sigma2 = np.full(shape, np.nan), np.full(shape, np.nan)
+    team_size = np.array(
+        [TEAM_SIZES[team_format[m.team1]] for m in rgl_matches])
+
+    # the ratings of each side's rostered players are looked up in one
+    # batch
+    with RatingHistory() as history:
+        for side, mu, sigma in ((0, mu1, sigma1), (1, mu2, sigma2)):
+            rows, columns = [], []  # type: List[int], List[int]
+            player_ids, times = [], []  # type: List[int], List[float]
+            for i, m in enumerate(rgl_matches):
+                roster = match_rosters[i][side]
+                rows.extend([i] * len(roster))
+                columns.extend(range(len(roster)))
+                player_ids.extend(roster)
+                times.extend([m.date.timestamp() if m.date else math.inf] *
+                             len(roster))
+            mu[rows, columns], sigma[rows, columns] = history.ratings_at(
+                player_ids, times)
+
+    # teams are filled out with unrated players when too few of their
+    # players have ratings
+    team1_mu, team1_var, team1_players = team_ratings(mu1, sigma1, team_size)
+    team2_mu, team2_var, team2_players = team_ratings(mu2, sigma2, team_size)
+    team1_mu += (team_size - team1_players) * env.mu
+    team2_mu += (team_size - team2_players) * env.mu
+    var = (team1_var + team2_var +
+           (2 * team_size - team1_players - team2_players) * env.sigma**2)
+    players = 2 * team_size
+
+    prob = win_probability(team1_mu, team2_mu, var, players, env.beta)
+    quality = match_quality(team1_mu, team2_mu, var, players, env.beta)
+
+    con = load_rgl.connect()
+    con.execute(create_predictions)
+    con.executemany(
+        insert_prediction,
+        zip([m.id for m in rgl_matches], prob.tolist(), quality.tolist()))
+    print(len(rgl_matches), "matches predicted")
+
+    team1_score = np.array([
+        np.nan if m.team1_score is None else m.team1_score
+        for m in rgl_matches
+    ])
+    team2_score = np.array([
+        np.nan if m.team2_score is None else m.team2_score
+        for m in rgl_matches
+    ])
+    played = ~np.isnan(team1_score) & ~np.isnan(team2_score) & (
+        team1_score != team2_score)
+    if played.any():
+        brier, log_loss, accuracy = score_predictions(
+            prob[played], (team1_score[played] > team2_score[played]) * 1.0)
+        print("{} played matches, brier score {:.4f}, log loss {:.4f}, "
+              "accuracy {:.4f}".format(int(played.sum()), brier, log_loss,
+                                       accuracy))
+        con.execute(create_prediction_scores)
+        con.execute(insert_prediction_score,
+                    (args.season or 0, int(played.sum()), brier, log_loss,
+                     accuracy, time.time()))
+    con.commit()
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
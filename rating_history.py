@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Stores every rating update made by mmr_calc.py in a compact binary file so
+that a player's rating on any date can be looked up without replaying the
+game logs.
+
+rating_history.bin is a flat array of fixed width records, one per rating
+update, written in the order the games were rated.  rating_history.idx maps
+each player to the record numbers of their updates, which are already in
+date order, so rating-at-date lookups are a binary search.
+
+usage: rating_history.py <steamid64> [date as YYYY-MM-DD]
+"""
+
+import mmap
+import struct
+import sys
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+HISTORY_FILE = "rating_history.bin"
+INDEX_FILE = "rating_history.idx"
+
+# steamid64, logs.tf id, log upload timestamp, mu, sigma
+RECORD = struct.Struct("<QIIff")
+# steamid64, position of the first posting, number of postings
+INDEX_ENTRY = struct.Struct("<QII")
+INDEX_HEADER = struct.Struct("<I")
+POSTING = struct.Struct("<I")
+
+RatingPoint = NamedTuple(
+    "RatingPoint",
+    [
+        ("log_id", int),
+        ("date", int),
+        ("mu", float),
+        ("sigma", float),
+    ],
+)
+
+
+class HistoryWriter:
+    """
+    Appends rating updates to the history file and writes the per-player
+    index when it is closed.
+    """
+
+    def __init__(self, history_file=HISTORY_FILE, index_file=INDEX_FILE):
+        # type: (str, str) -> None
+        self.index_file = index_file
+        self.history = open(history_file, "wb")
+        self.records = 0
+        self.postings = {}  # type: Dict[int, array]
+
+    def append(self, player_id, log_id, date, rating):
+        # type: (int, int, int, Any) -> None
+        """
+        records the rating a player had after the given game
+        """
+        self.history.write(
+            RECORD.pack(player_id, log_id, date, rating.mu, rating.sigma))
+        if player_id not in self.postings:
+            self.postings[player_id] = array("I")
+        self.postings[player_id].append(self.records)
+        self.records += 1
+
+    def close(self):  # type: () -> None
+        self.history.close()
+        with open(self.index_file, "wb") as f:
+            f.write(INDEX_HEADER.pack(len(self.postings)))
+            start = 0
+            player_ids = sorted(self.postings)
+            for pid in player_ids:
+                f.write(INDEX_ENTRY.pack(pid, start, len(self.postings[pid])))
+                start += len(self.postings[pid])
+            for pid in player_ids:
+                f.write(self.postings[pid].tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _map_file(filename):  # type: (str) -> Optional[mmap.mmap]
+    with open(filename, "rb") as f:
+        # zero length files can't be memory mapped
+        f.seek(0, 2)
+        if not f.tell():
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RatingHistory:
+    """
+    Read only view of the rating history.  Both files are memory mapped, so
+    opening the history is cheap no matter how many updates it holds.
+    """
+
+    def __init__(self, history_file=HISTORY_FILE, index_file=INDEX_FILE):
+        # type: (str, str) -> None
+        self.history = _map_file(history_file)
+        self.index = _map_file(index_file)
+        self.players = 0
+        if self.index:
+            (self.players, ) = INDEX_HEADER.unpack_from(self.index, 0)
+        self.postings_start = (INDEX_HEADER.size +
+                               self.players * INDEX_ENTRY.size)
+
+    def _entry(self, i):  # type: (int) -> Tuple[int, int, int]
+        return INDEX_ENTRY.unpack_from(
+            self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+    def _postings(self, player_id):  # type: (int) -> Tuple[int, int]
+        """
+        binary searches the index for a player, returning the position of
+        their first posting and the number of postings.
+        """
+        low, high = 0, self.players
+        while low < high:
+            mid = (low + high) // 2
+            pid, start, count = self._entry(mid)
+            if pid == player_id:
+                return start, count
+            if pid < player_id:
+                low = mid + 1
+            else:
+                high = mid
+        return 0, 0
+
+    def _record(self, posting):  # type: (int) -> RatingPoint
+        (record_number, ) = POSTING.unpack_from(
+            self.index, self.postings_start + posting * POSTING.size)
+        _, log_id, date, mu, sigma = RECORD.unpack_from(
+            self.history, record_number * RECORD.size)
+        return RatingPoint(log_id, date, mu, sigma)
+
+    def series(self, player_id):  # type: (int) -> List[RatingPoint]
+        """
+        returns every rating update of a player in date order
+        """
+        start, count = self._postings(player_id)
+        return [self._record(p) for p in range(start, start + count)]
+
+    def rating_at(self, player_id, timestamp):
+        # type: (int, float) -> Optional[RatingPoint]
+        """
+        returns the rating a player had at the given time, or None if they
+        hadn't played a rated game yet.
+        """
+        start, count = self._postings(player_id)
+        low, high = start, start + count
+        while low < high:
+            mid = (low + high) // 2
+            if self._record(mid).date <= timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return self._record(low - 1) if low > start else None
+
+    def ratings_at(self, player_ids, timestamps):
+        # type: (Any, Any) -> Tuple[Any, Any]
+        """
+        rating_at for numpy arrays of players and times, returning arrays
+        of mu and sigma that are nan where the player hadn't played a rated
+        game yet.  An infinite time gives the latest rating.
+        """
+        import numpy as np  # type: ignore
+        player_ids = np.asarray(player_ids, dtype=np.uint64)
+        mu = np.full(len(player_ids), np.nan)
+        sigma = np.full(len(player_ids), np.nan)
+        if not self.players or not len(player_ids):
+            return mu, sigma
+        entries = np.frombuffer(self.index, dtype=[("id", "<u8"),
+                                                   ("start", "<u4"),
+                                                   ("count", "<u4")],
+                                count=self.players, offset=INDEX_HEADER.size)
+        postings = np.frombuffer(self.index, dtype="<u4",
+                                 offset=self.postings_start)
+        records = np.frombuffer(self.history, dtype=[("id", "<u8"),
+                                                     ("log_id", "<u4"),
+                                                     ("date", "<u4"),
+                                                     ("mu", "<f4"),
+                                                     ("sigma", "<f4")])
+
+        players, lookup_player = np.unique(player_ids, return_inverse=True)
+        entry = np.minimum(np.searchsorted(entries["id"], players),
+                           self.players - 1)
+        counts = np.where(entries["id"][entry] == players,
+                          entries["count"][entry], 0).astype(np.int64)
+        # the postings of just these players, with keys of the player's
+        # number and the date, which sort in posting order since each
+        # player's postings are in date order
+        firsts = np.cumsum(counts) - counts
+        player_of = np.repeat(np.arange(len(players)), counts)
+        selected = (entries["start"][entry].astype(np.int64)[player_of] +
+                    np.arange(len(player_of)) - firsts[player_of])
+        selected_records = postings[selected]
+        keys = (player_of << 32) + records["date"][selected_records]
+
+        dates = np.clip(np.floor(np.asarray(timestamps, dtype=float)), -1,
+                        2**32 - 1).astype(np.int64)
+        found = np.searchsorted(keys, (lookup_player << 32) + dates,
+                                side="right") - 1
+        rated = found >= firsts[lookup_player]
+        mu[rated] = records["mu"][selected_records[found[rated]]]
+        sigma[rated] = records["sigma"][selected_records[found[rated]]]
+        return mu, sigma
+
+    def latest(self, player_id):  # type: (int) -> Optional[RatingPoint]
+        start, count = self._postings(player_id)
+        return self._record(start + count - 1) if count else None
+
+    def close(self):  # type: () -> None
+        for m in (self.history, self.index):
+            if m:
+                m.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def main():
+    player_id = int(sys.argv[1])
+    with RatingHistory() as history:
+        if len(sys.argv) > 2:
+            when = datetime.strptime(sys.argv[2], "%Y-%m-%d").timestamp()
+            points = [history.rating_at(player_id, when)]
+        else:
+            points = history.series(player_id)
+
+        for p in points:
+            if p:
+                print("{},{},{:.3f},{:.3f}".format(
+                    datetime.fromtimestamp(p.date), p.log_id, p.mu, p.sigma))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Indexes rgl team membership by time, using the dates players joined and
+left their teams.  Each team's membership and each player's teams are
+stored as the sorted times where they change, with the members between
+each pair of times, so "who was on team T at time D" and "which teams was
+player P on at time D" are binary searches.
+"""
+
+import itertools
+from bisect import bisect_right
+from collections import Counter
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+from get_rgl_matches import RglPlayerEntry
+
+FOREVER = float("inf")
+# rgl lists the days players joined and left teams, so players count as
+# team members until the end of the day they left
+LEFT_DAY = 24 * 60 * 60
+
+Interval = Tuple[float, float, int]
+
+
+class IntervalIndex:
+    """
+    Maps keys to sets of values that change over time.  Every value is
+    added with the interval [start, end) it holds for.
+    """
+
+    def __init__(self, intervals):
+        # type: (Dict[int, List[Interval]]) -> None
+        self.times = {}  # type: Dict[int, List[float]]
+        self.members = {}  # type: Dict[int, List[FrozenSet[int]]]
+        for key, key_intervals in intervals.items():
+            changes = Counter()  # type: Counter
+            for start, end, value in key_intervals:
+                if start < end:
+                    changes[(start, value)] += 1
+                    changes[(end, value)] -= 1
+
+            times = []  # type: List[float]
+            members = []  # type: List[FrozenSet[int]]
+            active = Counter()  # type: Counter
+            for t, changed in itertools.groupby(sorted(changes.items()),
+                                                key=lambda c: c[0][0]):
+                for (_, value), change in changed:
+                    active[value] += change
+                times.append(t)
+                members.append(frozenset(v for v, n in active.items() if n))
+            self.times[key] = times
+            self.members[key] = members
+
+    def at(self, key, when):  # type: (int, float) -> FrozenSet[int]
+        times = self.times.get(key)
+        if not times:
+            return frozenset()
+        i = bisect_right(times, when) - 1
+        return self.members[key][i] if i >= 0 else frozenset()
+
+    def __contains__(self, key):  # type: (int) -> bool
+        return key in self.times
+
+
+class RosterIndex:
+    """
+    Team rosters and player teams at any time.  Times are unix timestamps.
+    """
+
+    def __init__(self, entries):  # type: (Iterable[RglPlayerEntry]) -> None
+        team_players = {}  # type: Dict[int, List[Interval]]
+        player_teams = {}  # type: Dict[int, List[Interval]]
+        for p in entries:
+            start = p.joined.timestamp() if p.joined else -FOREVER
+            end = p.left.timestamp() + LEFT_DAY if p.left else FOREVER
+            team_players.setdefault(p.team_id, []).append(
+                (start, end, p.id))
+            player_teams.setdefault(p.id, []).append(
+                (start, end, p.team_id))
+        self.teams = IntervalIndex(team_players)
+        self.players = IntervalIndex(player_teams)
+
+    def roster_at(self, team_id, when):  # type: (int, float) -> FrozenSet[int]
+        """
+        returns the players on a team at a time
+        """
+        return self.teams.at(team_id, when)
+
+    def teams_at(self, player_id, when):
+        # type: (int, float) -> FrozenSet[int]
+        """
+        returns the teams a player was on at a time
+        """
+        return self.players.at(player_id, when)
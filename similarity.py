@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Finds the players who play a class most like a given player.  Each player
+with at least MIN_MINUTES on a class gets a vector of their per minute
+stats on it, the rates shown on their profile, standardized so that every
+stat has a mean of 0 and a standard deviation of 1 over the class.
+Similar players are the nearest vectors, found with a k-d tree instead of
+comparing every pair of players.
+
+get_stats.py writes the raw vectors of each class to similarity/<class>.npz
+and shows the most similar players on each profile.  This script answers
+queries from those files.
+
+usage: similarity.py PLAYER [--class CLASS] [-k 10]
+"""
+
+import argparse
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np  # type: ignore
+from steam_ids import id3_to_id64
+
+SIMILARITY_DIR = "similarity"
+MIN_MINUTES = 60
+LEAF_SIZE = 64
+
+# the per minute stats of every class, and the ones only some classes have
+BASE_FEATURES = ["kpm", "depm", "kapd", "dpm", "dtpm"]
+CLASS_FEATURES = {
+    "medic": ["ubers", "drops", "heal"],
+    "sniper": ["headshots_hit"],
+    "spy": ["backstabs"],
+}
+
+# the steamid64, name and distance of a similar player
+Similar = Tuple[int, str, float]
+
+
+def feature_names(class_name):  # type: (str) -> List[str]
+    return BASE_FEATURES + [
+        s + "_pm" for s in CLASS_FEATURES.get(class_name, [])
+    ]
+
+
+def class_features(class_name, stats):
+    # type: (str, Dict[str, float]) -> Optional[List[float]]
+    """
+    returns the features of a player's stats on a class, as given by
+    get_stats.get_player_stats, or None if they played it too little
+    """
+    minutes = stats["total_time"] / 60
+    if minutes < MIN_MINUTES:
+        return None
+    features = [
+        stats["kills"] / minutes,
+        stats["deaths"] / minutes,
+        (stats["kills"] + stats["assists"]) / max(stats["deaths"], 1),
+        stats["dmg"] / minutes,
+        stats["dt"] / minutes,
+    ]
+    features.extend(stats[s] / minutes
+                    for s in CLASS_FEATURES.get(class_name, []))
+    return features
+
+
+class KDTree:
+    """
+    k-d tree over the rows of a matrix.  Nodes split their rows at the
+    median of the dimension with the widest range, down to leaves of at
+    most leaf_size rows, which queries check in one vectorized step.
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        # type: (np.ndarray, int) -> None
+        self.points = points
+        self.leaf_size = leaf_size
+        # the rows of each node are order[start:end]
+        self.order = np.arange(len(points))
+        self.split_dim = []  # type: List[int]
+        self.split_value = []  # type: List[float]
+        self.children = []  # type: List[Tuple[int, int]]
+        self.ranges = []  # type: List[Tuple[int, int]]
+        self._build(0, len(points))
+
+    def _build(self, start, end):  # type: (int, int) -> int
+        node = len(self.split_dim)
+        self.split_dim.append(-1)
+        self.split_value.append(0.0)
+        self.children.append((-1, -1))
+        self.ranges.append((start, end))
+        if end - start <= self.leaf_size:
+            return node
+
+        rows = self.order[start:end]
+        points = self.points[rows]
+        dim = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        mid = (end - start) // 2
+        rows = rows[np.argpartition(points[:, dim], mid)]
+        self.order[start:end] = rows
+        self.split_dim[node] = dim
+        self.split_value[node] = float(self.points[rows[mid], dim])
+        left = self._build(start, start + mid)
+        right = self._build(start + mid, end)
+        self.children[node] = (left, right)
+        return node
+
+    def query(self, point, k):
+        # type: (np.ndarray, int) -> Tuple[np.ndarray, np.ndarray]
+        """
+        returns the rows nearest to a point and their euclidean distances,
+        nearest first, at most k of them
+        """
+        best_rows = np.full(k, -1)
+        best = np.full(k, np.inf)
+        # nodes to visit, with a lower bound of the squared distance to
+        # their rows, the sum of the squares of the point's offsets from
+        # the node's box in each dimension
+        stack = [(0, 0.0, np.zeros(len(point)))]
+        while stack:
+            node, bound, offsets = stack.pop()
+            if bound >= best[-1]:
+                continue
+            dim = self.split_dim[node]
+            if dim < 0:
+                start, end = self.ranges[node]
+                rows = self.order[start:end]
+                distances = np.sum((self.points[rows] - point)**2, axis=1)
+                candidates = np.concatenate((best, distances))
+                nearest = np.argsort(candidates, kind="stable")[:k]
+                best = candidates[nearest]
+                best_rows = np.concatenate((best_rows, rows))[nearest]
+                continue
+
+            diff = point[dim] - self.split_value[node]
+            left, right = self.children[node]
+            near, far = (left, right) if diff < 0 else (right, left)
+            far_offsets = offsets.copy()
+            far_offsets[dim] = diff
+            stack.append(
+                (far, bound - offsets[dim]**2 + diff * diff, far_offsets))
+            stack.append((near, bound, offsets))
+        found = best_rows >= 0
+        return best_rows[found], np.sqrt(best[found])
+
+
+class ClassIndex:
+    """
+    The standardized features of the players of a class, indexed by a k-d
+    tree.  Players are given by steamid64.
+    """
+
+    def __init__(self, class_name, ids, names, features):
+        # type: (str, Sequence[int], Sequence[str], Sequence) -> None
+        self.class_name = class_name
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = list(names)
+        self.features = np.asarray(features, dtype=np.float64).reshape(
+            len(self.ids), len(feature_names(class_name)))
+        self.rows = {int(pid): row for row, pid in enumerate(self.ids)}
+
+        vectors = self.features
+        if len(vectors):
+            std = vectors.std(axis=0)
+            # a stat that's the same for every player, give or take
+            # rounding errors, would only add noise once standardized
+            std[std < 1e-9] = np.inf
+            vectors = (vectors - vectors.mean(axis=0)) / std
+        self.vectors = vectors
+        self.tree = KDTree(vectors)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def similar(self, player_id, k=10):  # type: (int, int) -> List[Similar]
+        """
+        returns the steamid64, name and distance of the k players nearest
+        to a player, or nothing if the player isn't indexed
+        """
+        row = self.rows.get(player_id)
+        if row is None:
+            return []
+        rows, distances = self.tree.query(self.vectors[row], k + 1)
+        return [(int(self.ids[r]), self.names[r], float(d))
+                for r, d in zip(rows, distances) if r != row][:k]
+
+    def save(self):  # type: () -> None
+        os.makedirs(SIMILARITY_DIR, exist_ok=True)
+        np.savez(index_file(self.class_name),
+                 ids=self.ids,
+                 names=np.array(self.names, dtype=str),
+                 features=self.features)
+
+    @classmethod
+    def load(cls, class_name):  # type: (str) -> ClassIndex
+        with np.load(index_file(class_name)) as index:
+            return cls(class_name, index["ids"], index["names"].tolist(),
+                       index["features"])
+
+
+def index_file(class_name):  # type: (str) -> str
+    return os.path.join(SIMILARITY_DIR, class_name + ".npz")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("player", help="a steamid64 or steamid3")
+    parser.add_argument("--class",
+                        dest="class_name",
+                        help="only search this class (default: every class "
+                        "the player has played enough)")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.player.startswith("[U:"):
+        player_id = id3_to_id64(args.player)
+    else:
+        player_id = int(args.player)
+    if args.class_name:
+        classes = [args.class_name]
+    else:
+        classes = sorted(
+            os.path.splitext(f)[0] for f in os.listdir(SIMILARITY_DIR)
+            if f.endswith(".npz"))
+
+    for class_name in classes:
+        start = time.perf_counter()
+        index = ClassIndex.load(class_name)
+        loaded = time.perf_counter() - start
+        start = time.perf_counter()
+        similar = index.similar(player_id, args.k)
+        if not similar:
+            continue
+        searched = time.perf_counter() - start
+        print("{} ({} players, loaded in {:.2f}s, searched in {:.1f}ms)"
+              .format(class_name, len(index), loaded, 1000 * searched))
+        for pid, name, distance in similar:
+            print("  {:<20} {:<32} {:.2f}".format(pid, name, distance))
+
+
+if __name__ == "__main__":
+    main()
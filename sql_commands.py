@@ -1,6 +1,23 @@
 #!/usr/bin/env python3
 
+import sqlite3
+
 db_file = "stats.db"
+# how many seconds the scripts that write stats.db at the same time, like
+# the stages of pipeline.py, wait for each other's locks
+db_timeout = 60.0
+
+
+def connect():  # type: () -> sqlite3.Connection
+    """
+    opens stats.db, waiting up to db_timeout seconds for the locks of other
+    writers.  It's opened as a uri, so that databases can be attached by
+    uri.
+    """
+    con = sqlite3.connect("file:" + db_file, uri=True, timeout=db_timeout)
+    # readers don't block the writers, and the other way around
+    con.execute("pragma journal_mode=wal;")
+    return con
 
 class_ids = {
     "scout":1,
@@ -57,36 +74,77 @@ create table if not exists PlayerStats
     mids_survived int,
     backstabs int,
     headshots_hit int,
-    soldier_kills int,
-    sniper_kills int,
-    medic_kills int,
-    scout_kills int,
-    spy_kills int,
-    pyro_kills int,
-    engineer_kills int,
-    demoman_kills int,
-    heavyweapons_kills int,
-    soldier_assists int,
-    sniper_assists int,
-    medic_assists int,
-    scout_assists int,
-    spy_assists int,
-    pyro_assists int,
-    engineer_assists int,
-    demoman_assists int,
-    heavyweapons_assists int,
-    soldier_deaths int,
-    sniper_deaths int,
-    medic_deaths int,
-    scout_deaths int,
-    spy_deaths int,
-    pyro_deaths int,
-    engineer_deaths int,
-    demoman_deaths int,
-    heavyweapons_deaths int,
+    match_time int,
     primary key (log_id, player_id, tf2_class )
 );"""
 
+# match_time is copied from MatchLogs so that a player's stats in a time
+# window are a range of this index
+create_player_time_index = """
+create index if not exists PlayerStatsPlayerTime
+on PlayerStats (player_id, match_time, tf2_class, log_id);
+"""
+
+# the kills, assists and deaths of a player's class against each opposing
+# class.  Most of these are zero, so only the non-zero ones get a row.
+create_class_matchups = """
+create table if not exists ClassMatchups
+(
+    log_id int,
+    player_id int,
+    tf2_class text,
+    opponent_class int,
+    kills int,
+    assists int,
+    deaths int,
+    primary key (log_id, player_id, tf2_class, opponent_class)
+) without rowid;
+"""
+
+# the opposing classes, in the order of the old PlayerStats matchup columns
+matchup_classes = [
+    "soldier", "sniper", "medic", "scout", "spy", "pyro", "engineer",
+    "demoman", "heavyweapons"
+]
+
+matchup_columns = [
+    cn + "_" + stat for stat in ("kills", "assists", "deaths")
+    for cn in matchup_classes
+]
+
+
+def _pivot_matchups(source):  # type: (str) -> str
+    return ",\n".join(
+        "coalesce(sum(case when {0}.opponent_class = {1} then {0}.{2} end), 0)"
+        " as {3}_{2}".format(source, class_ids[cn], stat, cn)
+        for stat in ("kills", "assists", "deaths")
+        for cn in matchup_classes)
+
+
+# PlayerStats with the matchup columns it used to have.  The views are
+# temporary because PlayerStats and ClassMatchups are temporary views of
+# the monthly partitions (see partitions.py).
+create_player_stats_view = """
+create temp view if not exists PlayerStatsWide as
+select p.*,
+{}
+from PlayerStats p
+left join ClassMatchups m
+on m.log_id = p.log_id and m.player_id = p.player_id
+and m.tf2_class = p.tf2_class
+group by p.log_id, p.player_id, p.tf2_class;
+""".format(_pivot_matchups("m"))
+
+create_matchup_totals_view = """
+create temp view if not exists ClassMatchupTotals as
+select player_id, tf2_class, opponent_class,
+sum(kills) as kills,
+sum(assists) as assists,
+sum(deaths) as deaths
+from ClassMatchups
+group by player_id, tf2_class, opponent_class;
+"""
+
 create_users = """
 create table if not exists Users
 (
@@ -109,13 +167,50 @@ create table if not exists MatchLogs
 (
 log_id int primary key,
 map text,
-match_time text,
+match_time int,
 format text,
 red_score int,
 blue_score int
 );
 """
 
+# match_time is the unix time the log was uploaded
+create_match_time_index = """
+create index if not exists MatchLogsTime on MatchLogs (match_time, log_id);
+"""
+
+# the version of each derived stat (see parse_logs.derived_stats) a log's
+# PlayerStats rows were computed with
+create_derived_versions = """
+create table if not exists DerivedVersions
+(
+log_id int,
+stat text,
+version int,
+primary key (log_id, stat)
+) without rowid;
+"""
+
+insert_derived_version = """
+insert or replace into DerivedVersions values (?, ?, ?);
+"""
+
+# the logs whose stat was made by another version than the given one
+get_stale_logs = """
+select m.log_id from MatchLogs m
+left join DerivedVersions v on v.log_id = m.log_id and v.stat = ?
+where coalesce(v.version, 1) != ?;
+"""
+
+# the sealed monthly partitions of the per log tables, and their log counts
+create_partitions = """
+create table if not exists Partitions
+(
+month text primary key,
+logs int
+);
+"""
+
 create_weapon_stats = """
 create table if not exists WeaponStats
 (
@@ -159,97 +254,107 @@ insert or ignore into PlayerStats values
 :uber_length,
 :mid_deaths,
 :mids_survived,
-:headshots_hit,
 :backstabs,
-:soldier_kills,
-:sniper_kills,
-:medic_kills,
-:scout_kills,
-:spy_kills,
-:pyro_kills,
-:engineer_kills,
-:demoman_kills,
-:heavyweapons_kills,
-:soldier_assists,
-:sniper_assists,
-:medic_assists,
-:scout_assists,
-:spy_assists,
-:pyro_assists,
-:engineer_assists,
-:demoman_assists,
-:heavyweapons_assists,
-:soldier_deaths,
-:sniper_deaths,
-:medic_deaths,
-:scout_deaths,
-:spy_deaths,
-:pyro_deaths,
-:engineer_deaths,
-:demoman_deaths,
-:heavyweapons_deaths
+:headshots_hit,
+:match_time
 );
 """
 
+insert_class_matchup = """
+insert or ignore into ClassMatchups values
+(
+:log_id,
+:player_id,
+:tf2_class,
+:opponent_class,
+:kills,
+:assists,
+:deaths
+);
+"""
+
+
+def class_matchup_rows(entry):  # type: (dict) -> list
+    """
+    returns the ClassMatchups rows of a PlayerStats entry, one for each
+    opposing class with non-zero kills, assists or deaths
+    """
+    rows = []
+    for cn in matchup_classes:
+        kills = entry[cn + "_kills"]
+        assists = entry[cn + "_assists"]
+        deaths = entry[cn + "_deaths"]
+        if kills or assists or deaths:
+            rows.append({
+                "log_id": entry["log_id"],
+                "player_id": entry["player_id"],
+                "tf2_class": entry["tf2_class"],
+                "opponent_class": class_ids[cn],
+                "kills": kills,
+                "assists": assists,
+                "deaths": deaths
+            })
+    return rows
+
+
 get_player_stats = """
 select
-player_id,
-tf2_class,
-sum(kills),
-sum(deaths),
-sum(assists),
-sum(team),
-sum(dmg),
-sum(dt),
-sum(total_time),
-sum(med_drops),
-sum(heals_received),
-sum(heal),
-sum(drops),
-sum(ubers),
-sum(deaths_with_95_99_uber),
-sum(deaths_within_20s_after_uber),
-sum(advantages_lost),
-sum(biggest_advantage_lost),
-sum(avg_time_before_healing),
-sum(avg_time_to_build),
-sum(avg_time_before_using),
-sum(uber_length),
-sum(mid_deaths),
-sum(mids_survived),
-sum(headshots_hit),
-sum(backstabs),
-sum(soldier_kills),
-sum(sniper_kills),
-sum(medic_kills),
-sum(scout_kills),
-sum(spy_kills),
-sum(pyro_kills),
-sum(engineer_kills),
-sum(demoman_kills),
-sum(heavyweapons_kills),
-sum(soldier_assists),
-sum(sniper_assists),
-sum(medic_assists),
-sum(scout_assists),
-sum(spy_assists),
-sum(pyro_assists),
-sum(engineer_assists),
-sum(demoman_assists),
-sum(heavyweapons_assists),
-sum(soldier_deaths),
-sum(sniper_deaths),
-sum(medic_deaths),
-sum(scout_deaths),
-sum(spy_deaths),
-sum(pyro_deaths),
-sum(engineer_deaths),
-sum(demoman_deaths),
-sum(heavyweapons_death),
-sum(deaths)
+p.player_id,
+p.tf2_class,
+sum(p.kills),
+sum(p.deaths),
+sum(p.assists),
+sum(p.team),
+sum(p.dmg),
+sum(p.dt),
+sum(p.total_time),
+sum(p.med_drops),
+sum(p.heals_received),
+sum(p.heal),
+sum(p.drops),
+sum(p.ubers),
+sum(p.deaths_with_95_99_uber),
+sum(p.deaths_within_20s_after_uber),
+sum(p.advantages_lost),
+sum(p.biggest_advantage_lost),
+sum(p.avg_time_before_healing),
+sum(p.avg_time_to_build),
+sum(p.avg_time_before_using),
+sum(p.uber_length),
+sum(p.mid_deaths),
+sum(p.mids_survived),
+sum(p.headshots_hit),
+sum(p.backstabs),
+{matchups},
+sum(p.deaths)
+from PlayerStats p
+left join
+(
+    select player_id, tf2_class,
+    {pivot}
+    from ClassMatchups t
+    group by player_id, tf2_class
+) m on m.player_id = p.player_id and m.tf2_class = p.tf2_class
+group by p.player_id, p.tf2_class;
+""".format(matchups=",\n".join("coalesce(m.{0}, 0)".format(c)
+                               for c in matchup_columns),
+           pivot=_pivot_matchups("t"))
+
+# the columns of get_window_stats after the class
+window_stats_columns = [
+    "logs", "kills", "deaths", "assists", "dmg", "dt", "total_time", "heal",
+    "drops", "ubers", "mid_deaths", "mids_survived", "headshots_hit",
+    "backstabs"
+]
+
+# a player's stats of each class in logs uploaded in [start, end), a range
+# of PlayerStatsPlayerTime
+get_window_stats = """
+select tf2_class, count(distinct log_id), {}
 from PlayerStats
-group by player_id, tf2_class;
-"""
+where player_id = ? and match_time >= ? and match_time < ?
+group by tf2_class;
+""".format(", ".join("sum({})".format(c) for c in window_stats_columns[1:]))
 
 get_game_rosters = ("select log_id, team, group_concat(player_id) as roster" +
                     " from PlayerStats group by log_id, team;")
@@ -268,3 +373,126 @@ values
 :blue_score
 );
 """
+
+create_rgl_match_logs = """
+create table if not exists RglMatchLogs
+(
+rgl_id int,
+log_id int,
+primary key (rgl_id, log_id)
+);
+"""
+
+insert_rgl_match_log = """
+insert or ignore into RglMatchLogs
+values
+(
+:rgl_id,
+:log_id
+);
+"""
+
+create_linked_logs = """
+create table if not exists LinkedLogs
+(
+log_id int primary key
+);
+"""
+
+create_linked_rgl_matches = """
+create table if not exists LinkedRglMatches
+(
+rgl_id int primary key
+);
+"""
+
+create_rgl_tables = """
+create table if not exists RglSeasons
+(
+season_id int primary key,
+name text
+);
+
+create table if not exists RglLeagues
+(
+league_id int primary key,
+name text
+);
+
+create table if not exists RglTeams
+(
+team_id int primary key,
+name text
+);
+
+create table if not exists RglUsers
+(
+player_id int primary key,
+name text
+);
+
+create table if not exists RglPlayerTeams
+(
+player_id int,
+team_id int,
+joined real,
+left real,
+region_id int,
+season_id int,
+league_id int,
+primary key (player_id, team_id, joined)
+);
+
+create index if not exists RglPlayerTeamsTeam on RglPlayerTeams (team_id);
+create index if not exists RglPlayerTeamsSeason
+on RglPlayerTeams (season_id, league_id, team_id);
+
+create table if not exists RglMatches
+(
+rgl_id int primary key,
+team1 int,
+team1_score real,
+team2 int,
+team2_score real,
+match_time real,
+maps text,
+season_id int
+);
+
+create index if not exists RglMatchesSeason on RglMatches (season_id);
+create index if not exists RglMatchesTime on RglMatches (match_time);
+"""
+
+insert_rgl_season = "insert or replace into RglSeasons values (?, ?);"
+insert_rgl_league = "insert or replace into RglLeagues values (?, ?);"
+insert_rgl_team = "insert or replace into RglTeams values (?, ?);"
+insert_rgl_user = "insert or replace into RglUsers values (?, ?);"
+
+insert_rgl_player_team = """
+insert or replace into RglPlayerTeams
+values
+(
+:player_id,
+:team_id,
+:joined,
+:left,
+:region_id,
+:season_id,
+:league_id
+);
+"""
+
+insert_rgl_match = """
+insert or replace into RglMatches
+values
+(
+:rgl_id,
+:team1,
+:team1_score,
+:team2,
+:team2_score,
+:match_time,
+:maps,
+:season_id
+);
+"""
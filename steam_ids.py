@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Conversions between the steam id formats used by logs.tf and rgl.gg, done
+with arithmetic instead of importing the steam package.
+
+logs.tf keys players by steam3 ids like "[U:1:101435715]", and older logs
+use steam2 ids like "STEAM_0:1:50717857".  rgl.gg and the stats database
+use steamid64s like 76561198061701443.
+"""
+
+# the steamid64 of the individual account with account number 0
+ID64_BASE = 76561197960265728
+
+
+def id3_to_id64(id3):  # type: (str) -> int
+    """
+    converts a steam3 or steam2 id of an individual account to a steamid64
+    """
+    if id3.startswith("STEAM_"):
+        _, low_bit, half = id3[len("STEAM_"):].split(":")
+        return ID64_BASE + int(half) * 2 + int(low_bit)
+    return ID64_BASE + int(id3.strip("[]").split(":")[2])
+
+
+def id64_to_id3(id64):  # type: (int) -> str
+    return "[U:1:{}]".format(id64 - ID64_BASE)
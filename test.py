@@ -2,12 +2,51 @@
 
 import unittest
 import json
+import math
+import os
+import statistics
+import shutil
 import sqlite3
+import tempfile
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from collections import namedtuple
 from pprint import pprint
-from steam.steamid import SteamID
-from parse_logs import get_meds_dropped, get_user_class_stats
+from steam_ids import id3_to_id64, id64_to_id3
+from parse_logs import (get_meds_dropped, get_midfight_survival,
+                        get_user_class_stats)
 import sql_commands
 import link_match_logs
+import rating_history
+import log_archive
+import accumulators
+import leaderboard
+import predict
+import dedupe
+import archive_logs
+import make_db
+import roster_index
+import pipeline
+import partitions
+import parse_logs
+from datetime import datetime
+from get_rgl_matches import (RglPlayerEntry, fetch_page, read_matches,
+                             read_player_entries)
+import fixture_server
+import watch
+import timeline
+import window_stats
+import compress_site
+import make_league_report
+import load_rgl
+import get_stats
+import similarity
+import calibration
+import backtest
+import gzip
+import numpy as np
+import trueskill
 
 with open("test/2596216.json", encoding="utf-8") as f:
     json_doc = json.loads(f.read())
@@ -20,6 +59,7 @@ game_format = link_match_logs.get_format(json_doc)
 for player in stats:
     for c in stats[player]:
         stats[player][c]["log_id"] = 2596216
+        stats[player][c]["match_time"] = json_doc["info"]["date"]
         stats[player][c]["format"] = game_format.name
 
 
@@ -72,13 +112,15 @@ class MakeDbTest(unittest.TestCase):
 
         cur = con.cursor()
         cur.execute(sql_commands.create_player_stats)
+        cur.execute(sql_commands.create_class_matchups)
+        cur.execute(sql_commands.create_player_stats_view)
         for id3 in stats:
             for cn in stats[id3]:
-                cur.execute(sql_commands.insert_player_stats, stats[id3][cn])
+                make_db.insert_class_stats(cur, stats[id3][cn])
 
-        for row in cur.execute("select * from PlayerStats;"):
+        for row in cur.execute("select * from PlayerStatsWide;"):
             keynames = [d[0] for d in cur.description]
-            id3 = SteamID(row["player_id"]).as_steam3
+            id3 = id64_to_id3(row["player_id"])
             class_name = row["tf2_class"]
             for k in keynames:
                 self.assertEqual(row[k], stats[id3][class_name][k])
@@ -86,5 +128,1332 @@ class MakeDbTest(unittest.TestCase):
         con.close()
 
 
+    def testmigration(self):
+        con = sqlite3.connect(":memory:")
+        old_columns = ",\n".join("    {} int".format(c)
+                                 for c in sql_commands.matchup_columns)
+        con.execute(
+            sql_commands.create_player_stats.replace(
+                "headshots_hit int,", "headshots_hit int,\n" + old_columns +
+                ","))
+        entry = dict(stats[blue_demo]["demoman"], tf2_class="demoman")
+        values = [entry[c] for c in [
+            r[1] for r in con.execute("pragma table_info(PlayerStats);")
+        ]]
+        # the old insert statement swapped backstabs and headshots_hit
+        values[26], values[27] = values[27], values[26]
+        con.execute(
+            "insert into PlayerStats values ({});".format(",".join(
+                "?" * len(values))), values)
+
+        self.assertTrue(make_db.migrate_player_stats(con))
+        self.assertFalse(make_db.migrate_player_stats(con))
+        con.execute(sql_commands.create_player_stats_view)
+        con.row_factory = sqlite3.Row
+        row = con.execute("select * from PlayerStatsWide;").fetchone()
+        for k in row.keys():
+            self.assertEqual(row[k], entry[k])
+        self.assertEqual(
+            con.execute("select count(*) from ClassMatchups;").fetchone()[0],
+            len(sql_commands.class_matchup_rows(entry)))
+
+
+class SteamIdTest(unittest.TestCase):
+    def testconversions(self):
+        self.assertEqual(id3_to_id64(red_med), 76561198061701443)
+        self.assertEqual(id3_to_id64("STEAM_0:1:50717857"), 76561198061701443)
+        self.assertEqual(id64_to_id3(76561198061701443), red_med)
+
+
+class RatingHistoryTest(unittest.TestCase):
+    def testlookup(self):
+        rating = namedtuple("rating", "mu sigma")
+        with tempfile.TemporaryDirectory() as d:
+            hist = os.path.join(d, "h.bin")
+            idx = os.path.join(d, "h.idx")
+            with rating_history.HistoryWriter(hist, idx) as w:
+                for day in range(10):
+                    w.append(2, 100 + day, 1000 * day, rating(20 + day, 8))
+                    w.append(1, 200 + day, 1000 * day + 500, rating(day, 5))
+
+            with rating_history.RatingHistory(hist, idx) as h:
+                self.assertEqual(len(h.series(2)), 10)
+                self.assertEqual(h.series(3), [])
+                self.assertIsNone(h.rating_at(1, 499))
+                self.assertEqual(h.rating_at(1, 500).log_id, 200)
+                self.assertEqual(h.rating_at(2, 4999).log_id, 104)
+                self.assertEqual(h.rating_at(2, 5000).mu, 25)
+                self.assertEqual(h.latest(1).log_id, 209)
+
+                players = [1, 2, 3, 1, 2, 1, 2]
+                times = [499, 4999, 5000, 500, 0, 9500, float("inf")]
+                mu, sigma = h.ratings_at(players, times)
+                for i, (pid, when) in enumerate(zip(players, times)):
+                    rating = h.rating_at(pid, when)
+                    if rating is None:
+                        self.assertTrue(np.isnan(mu[i]))
+                    else:
+                        self.assertEqual((mu[i], sigma[i]),
+                                         (rating.mu, rating.sigma))
+
+
+class LogArchiveTest(unittest.TestCase):
+    def testprojection(self):
+        projected = log_archive.project(json_doc)
+        self.assertNotIn("chat", projected)
+        self.assertNotIn("notifications", projected["info"])
+        self.assertEqual(get_user_class_stats(projected),
+                         get_user_class_stats(json_doc))
+
+    def testframes(self):
+        with tempfile.TemporaryDirectory() as d:
+            archive_name = os.path.join(d, "logs.dat")
+            offsets = []
+            with open(archive_name, "ab") as archive:
+                for log_id in range(3):
+                    offsets.append(
+                        log_archive.append_log(archive, {"id": log_id}))
+
+            logs = log_archive.iter_logs(archive_name)
+            self.assertEqual([g["id"] for g in logs], [0, 1, 2])
+            with open(archive_name, "rb") as archive:
+                self.assertEqual(
+                    log_archive.read_log(archive, offsets[1])["id"], 1)
+
+    def testheaders(self):
+        game_log = dict(json_doc, id=2596216)
+        with tempfile.TemporaryDirectory() as d:
+            archive_name = os.path.join(d, "logs.dat")
+            with open(archive_name, "ab") as archive:
+                log_archive.append_log(archive, log_archive.project(game_log))
+                log_archive.append_log(archive, game_log)
+                no_length = dict(game_log)
+                del no_length["length"]
+                log_archive.append_log(archive,
+                                       log_archive.project(no_length))
+
+            headers = list(log_archive.iter_headers(archive_name))
+            for header in headers:
+                self.assertEqual(header.id, 2596216)
+                self.assertEqual(header.map, json_doc["info"]["map"])
+                self.assertEqual(header.date, json_doc["info"]["date"])
+            self.assertEqual([h.length for h in headers],
+                             [json_doc["length"], json_doc["length"], 0])
+
+
+class AccumulatorTest(unittest.TestCase):
+    def testwelford(self):
+        values = [3.5, 10, 7.25, 1, 8]
+        table = accumulators.StatTable(
+            accumulators.welford_columns("x") + ["total"], 2)
+        row = table.intern("[U:1:1]") * 2 + 1
+        for v in values:
+            table.add_sample(row, "x", v)
+            table.add(row, "total", v)
+
+        stats_row = table.row(row)
+        self.assertAlmostEqual(stats_row["x_mean"], statistics.mean(values))
+        self.assertAlmostEqual(accumulators.sample_stdev(stats_row, "x"),
+                               statistics.stdev(values))
+        self.assertEqual(stats_row["total"], sum(values))
+        self.assertEqual(table.row(row - 1)["total"], 0)
+
+    def testhistogram(self):
+        hist = accumulators.LogHistogram(1, 1000)
+        for v in range(1, 1001):
+            hist.add(v)
+        self.assertEqual(hist.total(), 1000)
+        self.assertAlmostEqual(hist.quantile(0.5), 500, delta=500 * 0.06)
+
+    def testmerge(self):
+        values = [3.5, 10, 7.25, 1, 8, 2, 6.5]
+        columns = accumulators.welford_columns("x") + ["total"]
+        whole = accumulators.StatTable(columns, 2)
+        hist = accumulators.LogHistogram(1, 1000)
+        shards = [(accumulators.StatTable(columns, 2),
+                   accumulators.LogHistogram(1, 1000)) for _ in range(3)]
+        for i, v in enumerate(values):
+            for table, h in ((whole, hist), shards[i % 3]):
+                row = table.intern(str(i % 2)) * 2 + 1
+                table.add_sample(row, "x", v)
+                table.add(row, "total", v)
+                h.add(v)
+
+        merged = accumulators.StatTable(columns, 2)
+        merged_hist = accumulators.LogHistogram(1, 1000)
+        for table, h in reversed(shards):
+            state = json.loads(json.dumps(table.dump()))
+            merged.merge(accumulators.StatTable.load(state))
+            merged_hist.merge(accumulators.LogHistogram.load(
+                json.loads(json.dumps(h.dump()))))
+        for key in ("0", "1"):
+            for c in columns:
+                self.assertAlmostEqual(
+                    merged.get(merged.keys[key] * 2 + 1, c),
+                    whole.get(whole.keys[key] * 2 + 1, c))
+        self.assertEqual(merged_hist.counts, hist.counts)
+
+        names = accumulators.LastValues()
+        names.add("[U:1:1]", "new", (20, 2))
+        old = accumulators.LastValues()
+        old.add("[U:1:1]", "old", (10, 1))
+        names.merge(accumulators.LastValues.load(
+            json.loads(json.dumps(old.dump()))))
+        self.assertEqual(names["[U:1:1]"], "new")
+
+
+class LeaderboardTest(unittest.TestCase):
+    def testrank(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                leaderboard.write_leaderboard("test", {
+                    1: 20.0,
+                    2: 30.0,
+                    3: 25.0,
+                    4: 25.0
+                })
+                board = leaderboard.Leaderboard("test")
+                self.assertEqual(board.rank(2), (1, 75.0))
+                self.assertEqual(board.rank(4), (2, 25.0))
+                self.assertEqual(board.rank(1), (4, 0.0))
+                self.assertIsNone(board.rank(5))
+                self.assertEqual([e[1] for e in board.page(0)], [2, 4, 3, 1])
+                board.close()
+            finally:
+                os.chdir(cwd)
+
+
+class PredictTest(unittest.TestCase):
+    def testquality(self):
+        env = trueskill.TrueSkill()
+        red = [trueskill.Rating(27, 3), trueskill.Rating(22, 5)]
+        blu = [trueskill.Rating(25, 4), trueskill.Rating(20, 1)]
+        mu = np.array([[27, 22, np.nan], [25, 20, 30]])
+        sigma = np.array([[3, 5, np.nan], [4, 1, 9]])
+        team_mu, team_var, players = predict.team_ratings(
+            mu, sigma, np.array([2, 2]))
+        self.assertEqual(players.tolist(), [2, 2])
+        self.assertEqual(team_mu.tolist(), [49, 55])
+
+        quality = predict.match_quality(team_mu[0], 45, team_var[0] + 17, 4,
+                                        env.beta)
+        self.assertAlmostEqual(quality, trueskill.quality([red, blu]))
+
+    def testwinprobability(self):
+        env = trueskill.TrueSkill()
+        red = [trueskill.Rating(27, 3), trueskill.Rating(22, 5)]
+        blu = [trueskill.Rating(25, 4), trueskill.Rating(20, 1)]
+        # trueskill's documented win probability of the first team
+        ratings = red + blu
+        spread = math.sqrt(
+            len(ratings) * env.beta**2 + sum(r.sigma**2 for r in ratings))
+        expected = env.cdf((sum(r.mu for r in red) -
+                            sum(r.mu for r in blu)) / spread)
+        prob = predict.win_probability(
+            np.array([49.0, 45.0]), np.array([45.0, 49.0]),
+            np.array([51.0, 51.0]), 4, env.beta)
+        self.assertAlmostEqual(prob[0], expected, places=6)
+        self.assertAlmostEqual(prob[0] + prob[1], 1, places=6)
+
+    def testscores(self):
+        prob = np.array([0.9, 0.2, 0.6, 0.5])
+        won = np.array([1.0, 0.0, 0.0, 1.0])
+        brier, log_loss, accuracy = predict.score_predictions(prob, won)
+        self.assertAlmostEqual(brier, (0.01 + 0.04 + 0.36 + 0.25) / 4)
+        self.assertAlmostEqual(
+            log_loss,
+            -(math.log(0.9) + math.log(0.8) + math.log(0.4) + math.log(0.5))
+            / 4)
+        # an even prediction calls neither team
+        self.assertEqual(accuracy, 0.5)
+
+
+class DedupeTest(unittest.TestCase):
+    def testduplicates(self):
+        log = log_archive.project(dict(json_doc, id=2596216))
+        index = dedupe.DuplicateIndex()
+        self.assertEqual(index.check(dedupe.fingerprint(log)), [])
+
+        # a reupload of the same match
+        copy = dict(log, id=1)
+        self.assertEqual(index.check(dedupe.fingerprint(copy)),
+                         [(1, 2596216)])
+
+        # the first half of the match, uploaded on its own
+        half = dict(log, id=2, length=log["length"] // 2)
+        half["info"] = dict(log["info"],
+                            date=log["info"]["date"] - log["length"] // 2)
+        half["players"] = dict(list(log["players"].items())[1:])
+        self.assertEqual(index.check(dedupe.fingerprint(half)),
+                         [(2, 1), (2, 2596216)])
+
+        # the same teams playing again the next day
+        rematch = dict(log, id=3)
+        rematch["info"] = dict(log["info"], date=log["info"]["date"] + 86400)
+        self.assertEqual(index.check(dedupe.fingerprint(rematch)), [])
+
+    def testrosterdigest(self):
+        # the digests are stored, so they must never change
+        self.assertEqual(
+            dedupe.roster_digest({76561197960265730, 76561197960265729}),
+            8327946674194719842)
+
+        log = log_archive.project(dict(json_doc, id=2596216))
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive, log)
+                # the fingerprints from before roster digests
+                con = sqlite3.connect(sql_commands.db_file)
+                con.execute(
+                    dedupe.create_fingerprints.replace(
+                        "roster_digest", "roster_hash"))
+                con.execute(dedupe.create_duplicates)
+                con.execute("insert into LogFingerprints values " +
+                            "(2596216, '', 0, 0, 1, 0, 0, x'');")
+                con.execute("insert into DuplicateLogs values (1, 2596216);")
+                con.commit()
+                con.close()
+
+                con = dedupe.connect()
+                self.assertFalse(dedupe.migrate_roster_hashes(con))
+                (fp, ) = dedupe.load_index(con).logs.values()
+                self.assertEqual(fp, dedupe.fingerprint(log))
+                con.close()
+                self.assertEqual(dedupe.read_duplicates(), {1})
+            finally:
+                os.chdir(cwd)
+
+
+class FixtureServerTest(unittest.TestCase):
+    def testserver(self):
+        server = fixture_server.FixtureServer(("127.0.0.1", 0), synthetic=3)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            logs = json.load(urlopen(server.url() + "/api/v1/log?limit=9"))
+            self.assertEqual([l["id"] for l in logs["logs"]], [1, 2, 3])
+            game_log = json.load(urlopen(server.url() + "/json/2"))
+            self.assertIn("players", game_log)
+            with self.assertRaises(HTTPError):
+                urlopen(server.url() + "/json/4")
+
+            server.error_rate = 1.0
+            with self.assertRaises(HTTPError) as error:
+                urlopen(server.url() + "/json/2")
+            self.assertIn(error.exception.code,
+                          fixture_server.ERROR_STATUSES)
+            self.assertEqual(server.counts["errors"], 1)
+            self.assertEqual(server.counts["missing"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testrglretries(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open("%2FPublic%2FRegions.aspx", "w",
+                          encoding="utf-8") as f:
+                    f.write("<p>regions</p>")
+                # the sample logs are found from any directory
+                server = fixture_server.FixtureServer(("127.0.0.1", 0),
+                                                      fixtures=d,
+                                                      synthetic=1,
+                                                      hang=1.0)
+            finally:
+                os.chdir(cwd)
+            self.assertTrue(server.samples)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                url = server.url() + "/Public/Regions.aspx"
+                self.assertEqual(fetch_page(url, 1.0, 2, 0.0),
+                                 "<p>regions</p>")
+                server.error_rate = 1.0
+                self.assertIsNone(fetch_page(url, 1.0, 2, 0.0))
+                self.assertEqual(server.counts["errors"], 3)
+                server.error_rate = 0.0
+                server.timeout_rate = 1.0
+                self.assertIsNone(fetch_page(url, 0.1, 0, 0.0))
+                self.assertEqual(server.counts["timeouts"], 1)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+class RosterIndexTest(unittest.TestCase):
+    def testmembership(self):
+        def entry(pid, joined, left, team):
+            return RglPlayerEntry(pid, joined and datetime(2020, 1, joined),
+                                  left and datetime(2020, 1, left), team, 1,
+                                  1, 1)
+
+        rosters = roster_index.RosterIndex([
+            entry(1, None, None, 10),
+            entry(2, 5, 10, 10),
+            entry(3, 10, None, 10),
+            entry(2, 12, None, 20),
+        ])
+        day = lambda d: datetime(2020, 1, d, 20).timestamp()
+        self.assertEqual(rosters.roster_at(10, day(1)), {1})
+        self.assertEqual(rosters.roster_at(10, day(7)), {1, 2})
+        self.assertEqual(rosters.roster_at(10, day(10)), {1, 2, 3})
+        self.assertEqual(rosters.roster_at(10, day(11)), {1, 3})
+        self.assertEqual(rosters.roster_at(20, day(11)), set())
+        self.assertEqual(rosters.roster_at(30, day(11)), set())
+        self.assertEqual(rosters.teams_at(2, day(8)), {10})
+        self.assertEqual(rosters.teams_at(2, day(11)), set())
+        self.assertEqual(rosters.teams_at(2, day(20)), {20})
+
+
+class PipelineTest(unittest.TestCase):
+    def testdependencies(self):
+        deps = pipeline.dependencies(pipeline.STAGES)
+        self.assertEqual(deps["archive_logs"], set())
+        self.assertEqual(deps["get_rgl_matches"], set())
+        self.assertEqual(deps["link_match_logs"],
+                         {"archive_logs", "get_rgl_matches"})
+        self.assertEqual(deps["get_stats"],
+                         {"archive_logs", "link_match_logs", "mmr_calc",
+                          "get_rgl_matches"})
+        self.assertEqual(deps["leaderboard"], {"mmr_calc", "make_db"})
+        get_stats_stage = [s for s in pipeline.STAGES
+                           if s.name == "get_stats"][0]
+        self.assertIn(pipeline.DUPLICATES, get_stats_stage.inputs)
+        # pipeline.py names the directory without importing numpy
+        self.assertIn(similarity.SIMILARITY_DIR, get_stats_stage.outputs)
+
+    def testfingerprints(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input.csv")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("1,2\n")
+            cache = {}  # type: dict
+            first = pipeline.Fingerprints(cache).get(path)
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(pipeline.Fingerprints(cache).get(path), first)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("3,4\n")
+            self.assertNotEqual(pipeline.Fingerprints(cache).get(path), first)
+            self.assertIsNone(
+                pipeline.Fingerprints(cache).get(path + "#Table"))
+
+
+class PartitionsTest(unittest.TestCase):
+    def testwindows(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                con = sqlite3.connect(sql_commands.db_file)
+                make_db.create_tables(con)
+                writer = partitions.PartitionWriter(con)
+                march = datetime(2021, 3, 15).timestamp()
+                april = datetime(2021, 4, 15).timestamp()
+                for log_id, date in [(1, march), (2, april), (3, april)]:
+                    game = dict(json_doc, id=log_id)
+                    game["info"] = dict(json_doc["info"], date=date)
+                    make_db.insert_game(writer.partition(date).cursor(), game)
+                writer.close()
+                self.assertEqual(writer.seal(datetime(2021, 5, 2).timestamp()),
+                                 ["2021-03"])
+                self.assertIsNone(writer.partition(march))
+                con.close()
+
+                def log_ids(con):
+                    return [
+                        r[0] for r in con.execute(
+                            "select log_id from MatchLogs order by log_id;")
+                    ]
+
+                con = partitions.connect()
+                self.assertEqual(log_ids(con), [1, 2, 3])
+                (players, ) = con.execute(
+                    "select count(distinct player_id) from PlayerStatsWide;"
+                ).fetchone()
+                self.assertEqual(players, len(stats))
+                con.close()
+
+                con = partitions.connect(april, april + 1)
+                self.assertEqual(log_ids(con), [2, 3])
+                attached = [r[1] for r in con.execute("pragma database_list;")]
+                self.assertNotIn("p_2021_03", attached)
+                con.close()
+
+                demo = id3_to_id64(blue_demo)
+                stats_by_window = window_stats.window_stats([demo], april,
+                                                            april + 1)
+                self.assertEqual(stats_by_window[demo]["demoman"]["logs"], 2)
+                self.assertEqual(
+                    stats_by_window[demo]["demoman"]["kills"],
+                    2 * stats[blue_demo]["demoman"]["kills"])
+                recent = window_stats.recent_stats([demo], 1, march + 1)
+                self.assertEqual(recent[demo]["demoman"]["logs"], 1)
+
+                con = partitions.connect()
+                plan = con.execute(
+                    "explain query plan " + sql_commands.get_window_stats,
+                    (demo, april, april + 1)).fetchall()
+                self.assertIn("PlayerStatsPlayerTime", str(plan))
+                con.close()
+
+                partitions.MAX_ATTACHED = 1
+                try:
+                    with self.assertRaises(ValueError):
+                        partitions.connect()
+                    batches = [
+                        log_ids(con) for con in partitions.connect_batches()
+                    ]
+                    self.assertEqual(batches, [[1], [2, 3]])
+                    whole = window_stats.window_stats([demo], march,
+                                                      april + 1)
+                    self.assertEqual(whole[demo]["demoman"]["logs"], 3)
+                    self.assertEqual(
+                        whole[demo]["demoman"]["kills"],
+                        3 * stats[blue_demo]["demoman"]["kills"])
+                finally:
+                    partitions.MAX_ATTACHED = 10
+            finally:
+                os.chdir(cwd)
+
+    def testmigration(self):
+        game = dict(json_doc, id=2596216)
+        new = sqlite3.connect(":memory:")
+        partitions.create_tables(new)
+        make_db.insert_game(new.cursor(), game)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive,
+                                           log_archive.project(game))
+                # the tables before partitions and unix match times
+                con = sqlite3.connect(sql_commands.db_file)
+                con.execute(
+                    sql_commands.create_match_table.replace(
+                        "match_time int", "match_time text"))
+                con.execute(
+                    sql_commands.create_player_stats.replace(
+                        "    match_time int,\n", ""))
+                con.execute(sql_commands.create_class_matchups)
+                for table in partitions.TABLES:
+                    columns = ", ".join(r[1] for r in con.execute(
+                        "pragma table_info({});".format(table)))
+                    rows = new.execute("select {} from {};".format(
+                        columns, table)).fetchall()
+                    con.executemany(
+                        "insert into {} values ({});".format(
+                            table, ", ".join("?" * len(rows[0]))), rows)
+                match_date = datetime.fromtimestamp(json_doc["info"]["date"])
+                con.execute("update MatchLogs set match_time = ?;",
+                            (match_date.strftime("%Y:%m:%d %H:%m:%S"), ))
+                con.commit()
+
+                self.assertTrue(make_db.migrate_partitions(con))
+                self.assertFalse(make_db.migrate_partitions(con))
+                con.close()
+                self.assertEqual(make_db.migrate_match_times(), 1)
+                self.assertEqual(make_db.migrate_match_times(), 0)
+
+                month = partitions.month_of(json_doc["info"]["date"])
+                self.assertEqual(partitions.partition_months(), [month])
+                con = partitions.connect()
+                self.assertEqual(
+                    con.execute("select * from MatchLogs;").fetchall(),
+                    new.execute("select * from MatchLogs;").fetchall())
+                self.assertEqual(
+                    sorted(con.execute("select * from PlayerStats;")),
+                    sorted(new.execute("select * from PlayerStats;")))
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+    def testrecompute(self):
+        game = dict(json_doc, id=2596216)
+        midfights = parse_logs.derived_stats["midfights"]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive,
+                                           log_archive.project(game))
+                con = sqlite3.connect(sql_commands.db_file)
+                writer = partitions.PartitionWriter(con)
+                part = writer.partition(game["info"]["date"])
+                make_db.insert_game(part.cursor(), game)
+                writer.close()
+                con.close()
+                self.assertEqual(make_db.stale_logs(), {})
+
+                parse_logs.derived_stats["midfights"] = midfights._replace(
+                    version=2, compute=lambda id3, g: (7, 8))
+                month = partitions.month_of(game["info"]["date"])
+                self.assertEqual(make_db.stale_logs(),
+                                 {2596216: (month, ["midfights"])})
+                con = sqlite3.connect(sql_commands.db_file)
+                self.assertEqual(make_db.recompute(con, 1), 1)
+                self.assertEqual(make_db.stale_logs(), {})
+
+                # sealed partitions are unsealed, updated and sealed again
+                writer = partitions.PartitionWriter(con)
+                self.assertEqual(writer.seal(), [month])
+                parse_logs.derived_stats["midfights"] = midfights._replace(
+                    version=3, compute=lambda id3, g: (7, 8))
+                self.assertEqual(make_db.recompute(con, 1), 1)
+                self.assertEqual(make_db.stale_logs(), {})
+                self.assertEqual(
+                    con.execute("select * from Partitions;").fetchall(),
+                    [(month, 1)])
+                con.close()
+
+                con = partitions.connect()
+                self.assertEqual(
+                    set(con.execute("select mids_survived, mid_deaths, " +
+                                    "count(*) > 0 from PlayerStats " +
+                                    "group by 1, 2;")), {(7, 8, 1)})
+                (drops, ) = con.execute(
+                    "select sum(med_drops) from PlayerStats " +
+                    "where player_id = ?;",
+                    (id3_to_id64(blue_demo), )).fetchone()
+                self.assertEqual(drops, 2 * len(stats[blue_demo]))
+                con.close()
+            finally:
+                parse_logs.derived_stats["midfights"] = midfights
+                os.chdir(cwd)
+
+
+    def testlateduplicate(self):
+        # the first half of a match, and the whole match uploaded after it
+        half = dict(json_doc, id=2, length=json_doc["length"] // 2)
+        half["info"] = dict(json_doc["info"],
+                            date=json_doc["info"]["date"] -
+                            json_doc["length"] // 2)
+        whole = dict(json_doc, id=2596216)
+        month = partitions.month_of(half["info"]["date"])
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                dedupe_con = dedupe.connect()
+                index = dedupe.load_index(dedupe_con)
+                archive_logs.archived_ids()
+                con = sqlite3.connect(sql_commands.db_file)
+                make_db.create_tables(con)
+
+                archive_logs.store_log(half, dedupe_con, index)
+                writer = partitions.PartitionWriter(con)
+                make_db.insert_archive(con, writer)
+                self.assertEqual(writer.seal(), [month])
+
+                _, duplicates = archive_logs.store_log(whole, dedupe_con,
+                                                       index)
+                self.assertEqual(duplicates, [(2, 2596216)])
+                writer = partitions.PartitionWriter(con)
+                make_db.insert_archive(con, writer)
+                self.assertEqual(writer.seal(), [month])
+                dedupe_con.close()
+                con.close()
+
+                con = partitions.connect()
+                for table in partitions.TABLES:
+                    self.assertEqual(
+                        con.execute("select distinct log_id from " +
+                                    table).fetchall(), [(2596216, )])
+                self.assertEqual(
+                    con.execute("select * from Partitions;").fetchall(),
+                    [(month, 1)])
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+
+class TimelineTest(unittest.TestCase):
+    def testmetrics(self):
+        samples = []
+        for i, filename in enumerate(sorted(os.listdir("test"))):
+            with open(os.path.join("test", filename), encoding="utf-8") as f:
+                samples.append(log_archive.project(dict(json.load(f), id=i)))
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive, samples[0])
+                self.assertEqual(timeline.update(), 1)
+                with open(log_archive.ARCHIVE_FILE, "ab") as archive:
+                    for game in samples[1:]:
+                        log_archive.append_log(archive, game)
+                self.assertEqual(timeline.update(), len(samples) - 1)
+                self.assertEqual(timeline.update(), 0)
+                t = timeline.Timeline()
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(len(t.events["type"]),
+                         sum(len(r["events"]) for g in samples
+                             for r in g["rounds"]))
+        self.assertEqual(t.logs["id"].tolist(), list(range(len(samples))))
+        kills = timeline.med_drop_kills(t)
+        logs, medics, died = timeline.midfights(t)
+        for i, game in enumerate(samples):
+            for id3 in game["players"]:
+                p = t.code("players", id3)
+                self.assertEqual(
+                    np.sum(kills & (t.events["log"] == i)
+                           & (t.events["killer"] == p)),
+                    get_meds_dropped(id3, game))
+                mine = (logs == i) & (medics == p)
+                self.assertEqual(
+                    (np.sum(mine & ~died), np.sum(mine & died)),
+                    get_midfight_survival(id3, game))
+
+
+class WatchTest(unittest.TestCase):
+    def testpoll(self):
+        server = fixture_server.FixtureServer(("127.0.0.1", 0), synthetic=5)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copytree("templates", os.path.join(d, "templates"))
+            os.makedirs(os.path.join(d, "html", "players"))
+            os.chdir(d)
+            try:
+                get_stats.clear_stats()
+                watcher = watch.Watcher(server.url(), 3, 0, 5)
+                watcher.load()
+                self.assertEqual(watcher.poll(), 2)
+                self.assertEqual(watcher.poll(), 0)
+                self.assertEqual(watcher.poll(), 0)
+                self.assertEqual(watcher.archived, {1, 2, 3, 4, 5})
+
+                con = partitions.connect()
+                (matches, ) = con.execute(
+                    "select count(*) from MatchLogs;").fetchone()
+                con.close()
+                self.assertEqual(matches, 5 - len(dedupe.read_duplicates()))
+                self.assertEqual(get_stats.games_played, matches)
+
+                # a reupload of an archived log isn't counted again
+                copy = dict(server.synthetic_log(1), id=99)
+                self.assertEqual(watcher.add_games([copy]),
+                                 set(copy["players"]))
+                self.assertIn(99, dedupe.read_duplicates())
+                self.assertEqual(get_stats.games_played, matches)
+
+                # a batch that can't be inserted is archived once and
+                # finished by the next poll
+                def locked(game):
+                    raise sqlite3.OperationalError("database is locked")
+                insert = watcher.insert
+                watcher.insert = locked
+                server.synthetic = 6
+                with self.assertRaises(sqlite3.OperationalError):
+                    watcher.poll()
+                watcher.insert = insert
+                self.assertEqual(watcher.poll(), 0)
+                self.assertEqual(
+                    [h.id for h in log_archive.iter_headers()].count(6), 1)
+                self.assertEqual(get_stats.games_played, matches + 1)
+                con = partitions.connect()
+                self.assertEqual(
+                    con.execute("select count(*) from MatchLogs;")
+                    .fetchone()[0], matches + 1)
+                con.close()
+
+                # a longer copy of an inserted log replaces it in stats.db
+                longer = server.synthetic_log(6)
+                longer = dict(longer, id=98, length=longer["length"] + 60)
+                watcher.add_games([longer])
+                self.assertIn(6, dedupe.read_duplicates())
+                con = partitions.connect()
+                self.assertEqual(
+                    con.execute("select log_id, count(distinct player_id) " +
+                                "from PlayerStats " +
+                                "where log_id in (6, 98) group by 1;")
+                    .fetchall(), [(98, len(longer["players"]))])
+                con.close()
+                for game in log_archive.iter_logs():
+                    for id3 in game["players"]:
+                        self.assertTrue(
+                            os.path.isfile("html/players/{}.html".format(
+                                id3_to_id64(id3))))
+                with open("html/players/{}.html".format(
+                        id3_to_id64(next(iter(longer["players"])))),
+                          encoding="utf-8") as f:
+                    self.assertIn("&plusmn;", f.read())
+                watcher.close()
+            finally:
+                os.chdir(cwd)
+                server.shutdown()
+                server.server_close()
+
+class CompressSiteTest(unittest.TestCase):
+    def testupdate(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, "html", "players"))
+            os.chdir(d)
+            try:
+                pages = {"html/index.html": b"<p>index</p>",
+                         "html/players/1.html": b"<p>one</p>",
+                         "html/players/2.html": b"<p>two</p>"}
+                for path, data in pages.items():
+                    with open(path, "wb") as f:
+                        f.write(data)
+                with open("html/logo.png", "wb") as f:
+                    f.write(b"png")
+                self.assertEqual(compress_site.update(jobs=2), 3)
+                for path, data in pages.items():
+                    with gzip.open(path + ".gz") as f:
+                        self.assertEqual(f.read(), data)
+                self.assertFalse(os.path.exists("html/logo.png.gz"))
+
+                # rewriting a page with the same contents isn't a change
+                with open("html/players/1.html", "wb") as f:
+                    f.write(b"<p>one</p>")
+                with open("html/players/2.html", "wb") as f:
+                    f.write(b"<p>two!</p>")
+                self.assertEqual(compress_site.update(jobs=1), 1)
+                with gzip.open("html/players/2.html.gz") as f:
+                    self.assertEqual(f.read(), b"<p>two!</p>")
+
+                os.remove("html/players/1.html")
+                self.assertEqual(compress_site.update(jobs=1), 0)
+                self.assertFalse(os.path.exists("html/players/1.html.gz"))
+                self.assertEqual(
+                    sorted(compress_site.read_manifest()),
+                    ["index.html", "players/2.html"])
+                self.assertEqual(
+                    compress_site.update(["html/index.html"], jobs=1,
+                                         rebuild=True), 1)
+                self.assertEqual(len(compress_site.read_manifest()), 2)
+            finally:
+                os.chdir(cwd)
+
+
+class LeagueReportTest(unittest.TestCase):
+    def testwritepages(self):
+        def season(sid, top6):
+            return {"id": sid, "name": "Season {}".format(sid), "leagues": [{
+                "id": 1, "name": "Advanced", "median": 1600.0,
+                "teams": [{"id": 10 * sid, "name": "froyotech", "top6": top6,
+                           "players": [(76561197960265729, "b4nny", 1700.5)]}]
+            }]}
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copytree("templates", os.path.join(d, "templates"))
+            os.makedirs(os.path.join(d, "html"))
+            os.chdir(d)
+            try:
+                seasons = [season(2, 9000.0), season(1, 8000.0)]
+                self.assertEqual(make_league_report.write_pages(seasons), 2)
+                self.assertEqual(make_league_report.write_pages(seasons), 0)
+                with open("html/leagues/1/1.json", encoding="utf-8") as f:
+                    self.assertEqual(json.load(f)["teams"][0]["players"],
+                                     [["76561197960265729", "b4nny", 1700.5]])
+                with open("html/leagues.html", encoding="utf-8") as f:
+                    self.assertIn("/leagues/2.html", f.read())
+
+                seasons[0]["leagues"][0]["teams"][0]["top6"] = 9100.0
+                self.assertEqual(
+                    make_league_report.write_pages(seasons[:1]), 1)
+                with open("html/leagues/2.html", encoding="utf-8") as f:
+                    self.assertIn("9100.0", f.read())
+                self.assertFalse(os.path.exists("html/leagues/1.html"))
+                self.assertFalse(os.path.exists("html/leagues/1"))
+            finally:
+                os.chdir(cwd)
+
+
+class LoadRglTest(unittest.TestCase):
+    def testplayerteams(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                # a team name written before the files were quoted
+                with open(load_rgl.TEAMS_FILE, "w", encoding="utf-8") as f:
+                    f.write("10,Team, With Comma\n")
+                # a player who left a team and joined it again
+                with open(load_rgl.PLAYER_TEAMS_FILE, "w",
+                          encoding="utf-8") as f:
+                    f.write("1,100.0,200.0,10,40,2,1\n")
+                    f.write("1,300.0,0,10,40,3,1\n")
+                    f.write("2,100.0,0,10,40,2,1\n")
+
+                # an RglPlayerTeams table keyed on the player and team
+                con = sqlite3.connect(sql_commands.db_file)
+                con.execute(
+                    "create table RglPlayerTeams (player_id int, " +
+                    "team_id int, joined real, left real, region_id int, " +
+                    "season_id int, league_id int, " +
+                    "primary key (player_id, team_id));")
+                con.execute("insert into RglPlayerTeams " +
+                            "values (1, 10, 100.0, 200.0, 40, 2, 1);")
+                load_rgl.load_all(con)
+                self.assertFalse(load_rgl.migrate_player_teams(con))
+                # loading again replaces the rows
+                load_rgl.load_all(con)
+                self.assertEqual(
+                    con.execute("select * from RglTeams;").fetchall(),
+                    [(10, "Team, With Comma")])
+                self.assertEqual(
+                    con.execute("select player_id, joined, season_id " +
+                                "from RglPlayerTeams order by 1, 2;")
+                    .fetchall(), [(1, 100.0, 2), (1, 300.0, 3), (2, 100.0, 2)])
+                con.close()
+            finally:
+                os.chdir(cwd)
+
+
+    def testleaguereport(self):
+        t = 1600000000.0
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                for filename, text in [
+                    (load_rgl.SEASONS_FILE, "1,Season 1\n"),
+                    (load_rgl.LEAGUES_FILE, "1,Advanced\n"),
+                    (load_rgl.TEAMS_FILE, "10,Ten\n11,Eleven\n"),
+                    (load_rgl.USERS_FILE, "1,one\n"),
+                    # players 1 to 7 on team 10, 8 and 9 on team 11, and 10
+                    # who left team 11 before its match, and 13 who has no
+                    # rating on team 12, which has no matches
+                    (load_rgl.PLAYER_TEAMS_FILE, "".join(
+                        "{},{},{},{},40,1,1\n".format(pid, t - 1000, left,
+                                                       tid)
+                        for pid, left, tid in
+                        [(pid, 0, 10) for pid in range(1, 8)] +
+                        [(8, 0, 11), (9, 0, 11), (10, t - 900 - 86400, 11),
+                         (13, 0, 12)])),
+                    (load_rgl.MATCHES_FILE,
+                     "500,10,3.0,11,None,{},koth_product_rcx,1\n".format(t)),
+                ]:
+                    with open(filename, "w", encoding="utf-8") as f:
+                        f.write(text)
+                con = load_rgl.connect()
+                load_rgl.load_all(con)
+                # a rename and a score that changed replace the old rows
+                with open(load_rgl.TEAMS_FILE, "w", encoding="utf-8") as f:
+                    f.write("10,Team Ten\n11,Eleven\n")
+                with open(load_rgl.MATCHES_FILE, "w", encoding="utf-8") as f:
+                    f.write("500,10,3.0,11,2.0,{},koth_product_rcx cp_granary"
+                            ",1\n".format(t))
+                load_rgl.load_all(con)
+                self.assertEqual(
+                    con.execute("select * from RglTeams order by 1;")
+                    .fetchall(), [(10, "Team Ten"), (11, "Eleven")])
+
+                self.assertEqual(read_matches(2), [])
+                (match, ) = read_matches(1)
+                self.assertEqual(
+                    match, (500, datetime.fromtimestamp(t),
+                            {"koth_product_rcx", "cp_granary"}, 10, 3.0, 11,
+                            2.0, 1))
+                entries = {p.id: p for p in read_player_entries()}
+                self.assertEqual(len(entries), 11)
+                self.assertEqual(entries[10].joined,
+                                 datetime.fromtimestamp(t - 1000))
+                self.assertEqual(entries[10].left,
+                                 datetime.fromtimestamp(t - 900 - 86400))
+                self.assertIsNone(entries[1].left)
+
+                scores = [(pid, 1000.0 + 100 * pid) for pid in range(1, 8)]
+                scores += [(8, 1500.0), (9, 1000.0), (10, 5000.0)]
+                (season, ) = make_league_report.get_season_profiles(
+                    con, scores)
+
+                # once the season is over, players are ranked by their
+                # rating at its end, not by ratings from later games
+                rating = namedtuple("rating", "mu sigma")
+                with rating_history.HistoryWriter() as w:
+                    w.append(8, 1, int(t) - 10, rating(3000.0, 5))
+                    w.append(8, 2, int(t) + 2 * 86400, rating(100.0, 5))
+                with rating_history.RatingHistory() as history:
+                    (ended, ) = make_league_report.get_season_profiles(
+                        con, scores, history, t + 3 * 86400)
+                    (current, ) = make_league_report.get_season_profiles(
+                        con, scores, history, t)
+                self.assertEqual(ended["leagues"][0]["teams"][0]["id"], 11)
+                self.assertEqual(ended["leagues"][0]["teams"][0]["players"],
+                                 [(8, "8", 3000.0), (9, "9", None)])
+                self.assertEqual(current, season)
+                (unrated, ) = make_league_report.get_season_profiles(con, [])
+                self.assertTrue(math.isnan(unrated["leagues"][0]["median"]))
+                con.close()
+                self.assertEqual((season["id"], season["name"]),
+                                 (1, "Season 1"))
+                (league, ) = season["leagues"]
+                # the median of 1700, 1600, 1500, 1500, 1400, 1300, 1200,
+                # 1100 and 1000
+                self.assertEqual(league["median"], 1400.0)
+                self.assertEqual(
+                    [(t["id"], t["name"], t["top6"]) for t in league["teams"]],
+                    [(10, "Team Ten", 8700.0), (11, "Eleven", 2500.0),
+                     (12, "UNKNOWN", 0)])
+                self.assertEqual(league["teams"][0]["players"][-1],
+                                 (1, "one", 1100.0))
+                self.assertEqual(league["teams"][2]["players"],
+                                 [(13, "13", None)])
+            finally:
+                os.chdir(cwd)
+
+
+class LinkMatchLogsTest(unittest.TestCase):
+    def testformat(self):
+        self.assertEqual(link_match_logs.get_format(json_doc),
+                         link_match_logs.Tf2Format.sixes)
+        empty = dict(json_doc, length=0)
+        self.assertEqual(link_match_logs.get_format(empty),
+                         link_match_logs.Tf2Format.other)
+        self.assertNotIn(link_match_logs.Tf2Format.other,
+                         link_match_logs.RATED_FORMATS)
+        self.assertEqual(
+            {e["format"] for c in get_user_class_stats(empty).values()
+             for e in c.values()}, {"other"})
+
+    def testlink(self):
+        game = dict(json_doc, id=2596216)
+        log_time = game["info"]["date"]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive,
+                                           log_archive.project(game))
+                with open("region_format.csv", "w", encoding="utf-8") as f:
+                    f.write("40,2,sixes\n")
+                # a team for each side of the log, and a match between them
+                # on the day and map of the log
+                with open(load_rgl.PLAYER_TEAMS_FILE, "w",
+                          encoding="utf-8") as f:
+                    for id3, player in game["players"].items():
+                        f.write("{},{},0,{},40,1,1\n".format(
+                            id3_to_id64(id3), log_time - 30 * 86400,
+                            1 if player["team"] == "Red" else 2))
+                with open(load_rgl.MATCHES_FILE, "w", encoding="utf-8") as f:
+                    f.write("500,1,3.0,2,1.0,{},{},1\n".format(
+                        log_time, game["info"]["map"]))
+                con = load_rgl.connect()
+                load_rgl.load_all(con)
+                con.close()
+
+                # committing after every log
+                link_match_logs.COMMIT_LOGS = 1
+                self.assertEqual(link_match_logs.link(), (1, 1, 1))
+                self.assertEqual(link_match_logs.read_rgl_match_logs(),
+                                 [(500, 2596216)])
+                self.assertEqual(link_match_logs.link(), (0, 0, 0))
+
+                # a log linked again doesn't count or store the link twice
+                con = sqlite3.connect(sql_commands.db_file)
+                con.execute("delete from LinkedLogs;")
+                con.commit()
+                con.close()
+                self.assertEqual(link_match_logs.link(), (1, 0, 0))
+                self.assertEqual(link_match_logs.read_rgl_match_logs(),
+                                 [(500, 2596216)])
+            finally:
+                link_match_logs.COMMIT_LOGS = 1000
+                os.chdir(cwd)
+
+
+class DuplicateStatsTest(unittest.TestCase):
+    def testskipduplicates(self):
+        log = log_archive.project(dict(json_doc, id=2596216))
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    log_archive.append_log(archive, log)
+                    log_archive.append_log(archive, dict(log, id=1))
+                dedupe.main()
+                get_stats.clear_stats()
+                get_stats.add_archive()
+                single = json.loads(json.dumps(get_stats.partial_state()))
+                sharded = json.loads(get_stats.shard_state(
+                    [h.offset for h in log_archive.iter_headers()]))
+            finally:
+                get_stats.clear_stats()
+                os.chdir(cwd)
+
+        for state in (single, sharded):
+            self.assertEqual(state["games_played"], 1)
+            self.assertEqual(sum(state["player_stats"]["columns"]["drops"]),
+                             sum(p["drops"] for p in log["players"].values()))
+            self.assertEqual(sum(state["class_stats"]["columns"]["kills"]),
+                             sum(c["kills"] for p in log["players"].values()
+                                 for c in p["class_stats"]))
+            teammates = state["teammate_counts"]
+            self.assertEqual(max(max(c.values(), default=0)
+                                 for c in teammates.values()), 1)
+
+
+class ShardTest(unittest.TestCase):
+    def testmerge(self):
+        samples = []
+        for i, filename in enumerate(sorted(os.listdir("test"))):
+            with open(os.path.join("test", filename), encoding="utf-8") as f:
+                samples.append(log_archive.project(dict(json.load(f), id=i)))
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    for game in samples:
+                        log_archive.append_log(archive, game)
+                whole = json.loads(get_stats.shard_state(
+                    [h.offset for h in log_archive.iter_headers()]))
+                states = [
+                    get_stats.shard_state(offsets)
+                    for offsets in get_stats.shard_offsets(3)
+                ]
+            finally:
+                os.chdir(cwd)
+
+        def merged(shard_states):
+            get_stats.clear_stats()
+            for state in shard_states:
+                get_stats.merge_state(state)
+            profiles = {id3: get_stats.get_player_stats(id3)
+                        for id3 in get_stats.player_stats_table.keys}
+            state = get_stats.partial_state()
+            get_stats.clear_stats()
+            return profiles, state
+
+        single, single_state = merged([whole])
+        sharded, sharded_state = merged(
+            json.loads(state) for state in reversed(states))
+        self.assertTrue(single_state["teammate_counts"])
+        for key in ("games_played", "newest_log", "oldest_log",
+                    "player_names", "teammate_counts", "class_game_dpm"):
+            self.assertEqual(sharded_state[key], single_state[key])
+        self.assertEqual(sharded.keys(), single.keys())
+        for id3, player in single.items():
+            for c, class_stats in player.items():
+                for stat, value in class_stats.items():
+                    self.assertAlmostEqual(sharded[id3][c][stat], value)
+
+class SimilarityTest(unittest.TestCase):
+    def testkdtree(self):
+        rng = np.random.default_rng(0)
+        points = rng.standard_normal((2000, 6))
+        # repeated points and a constant dimension
+        points[1000:1100] = points[0]
+        points[:, 3] = 1
+        tree = similarity.KDTree(points, leaf_size=8)
+        for row in (0, 5, 1500, 1999):
+            rows, distances = tree.query(points[row], 10)
+            brute = np.sqrt(np.sum((points - points[row])**2, axis=1))
+            self.assertTrue(np.allclose(distances, np.sort(brute)[:10]))
+            self.assertTrue(np.allclose(brute[rows], distances))
+        self.assertEqual(len(tree.query(points[0], 5000)[0]), 2000)
+
+    def testindex(self):
+        medic = {"kills": 60, "assists": 200, "deaths": 80, "dmg": 9000,
+                 "dt": 15000, "total_time": 3600, "heal": 90000,
+                 "drops": 4, "ubers": 40}
+        self.assertIsNone(similarity.class_features(
+            "medic", dict(medic, total_time=600)))
+        players = {}
+        for i in range(50):
+            stats = {k: v * (1 + i / 50) for k, v in medic.items()}
+            stats["total_time"] = 3600
+            players[76561197960265728 + i] = similarity.class_features(
+                "medic", stats)
+        index = similarity.ClassIndex("medic", list(players),
+                                      [str(p) for p in players],
+                                      list(players.values()))
+        similar = index.similar(76561197960265728 + 10, 4)
+        self.assertEqual(sorted(p for p, _, _ in similar),
+                         [76561197960265728 + i for i in (8, 9, 11, 12)])
+        self.assertEqual(index.similar(1), [])
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                index.save()
+                loaded = similarity.ClassIndex.load("medic")
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(loaded.similar(76561197960265728 + 10, 4), similar)
+
+
+class CalibrationTest(unittest.TestCase):
+    def testcalibrate(self):
+        rng = np.random.default_rng(0)
+        # no intermediate or invite players
+        divisions = {0: 60, 1: 150, 3: 80, 4: 25}
+        scores = []
+        leagues = []
+        for code, count in divisions.items():
+            for _ in range(count):
+                pid = 76561197960265728 + len(scores)
+                scores.append((pid, round(rng.normal(20 + 4 * code, 5), 1)))
+                leagues.append((pid, 1, calibration.LEAGUE_NAMES[code]))
+        # a player without a rating, one in an unknown division, and one
+        # who moved from newcomer to open
+        leagues.append((1, 1, "open"))
+        leagues.append((scores[0][0], 1, "highlander"))
+        leagues.append((scores[1][0], 2, "open"))
+
+        groups = {code: [] for code in divisions}
+        last = {pid: league for pid, _, league in leagues}
+        for pid, mmr in scores:
+            if last[pid] in calibration.LEAGUE_NAMES:
+                groups[calibration.LEAGUE_NAMES.index(last[pid])].append(mmr)
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            try:
+                def write(filename, rows):
+                    with open(filename, "w", encoding="utf-8") as f:
+                        for row in rows:
+                            f.write(",".join(map(str, row)) + "\n")
+
+                write(calibration.SCORES_FILE, scores)
+                write(calibration.LEAGUES_FILE, leagues)
+                result = calibration.get_calibration()
+                self.assertEqual(calibration.get_calibration(), result)
+
+                self.assertEqual([d["name"] for d in result["divisions"]],
+                                 ["newcomer", "open", "main", "advanced"])
+                for division in result["divisions"]:
+                    group = np.sort(groups[calibration.LEAGUE_NAMES.index(
+                        division["name"])])
+                    self.assertEqual(division["count"], len(group))
+                    self.assertAlmostEqual(division["mean"], group.mean())
+                    self.assertEqual(division["min"], group[0])
+                    self.assertEqual(division["max"], group[-1])
+                    for name, q in zip(calibration.QUANTILE_NAMES,
+                                       calibration.QUANTILES):
+                        self.assertAlmostEqual(division[name],
+                                               np.quantile(group, q))
+
+                self.assertEqual(
+                    [(c["lower"], c["upper"]) for c in result["cuts"]],
+                    [("newcomer", "open"), ("open", "main"),
+                     ("main", "advanced")])
+                for cut in result["cuts"]:
+                    lower = groups[calibration.LEAGUE_NAMES.index(
+                        cut["lower"])]
+                    upper = groups[calibration.LEAGUE_NAMES.index(
+                        cut["upper"])]
+
+                    def wrong(c):
+                        return (sum(m >= c for m in lower) +
+                                sum(m < c for m in upper))
+
+                    fewest = min(wrong(c) for c in lower + upper)
+                    self.assertEqual(wrong(cut["cut"]), fewest)
+                    self.assertAlmostEqual(cut["overlap"],
+                                           fewest / (len(lower) + len(upper)))
+
+                # the cache is only used while the inputs are the same
+                with open(calibration.CACHE_FILE, encoding="utf-8") as f:
+                    cached = json.load(f)
+                cached["calibration"]["cuts"] = []
+                with open(calibration.CACHE_FILE, "w", encoding="utf-8") as f:
+                    json.dump(cached, f)
+                self.assertEqual(calibration.get_calibration()["cuts"], [])
+                write(calibration.SCORES_FILE, scores[:-1])
+                self.assertEqual(len(calibration.get_calibration()["cuts"]),
+                                 3)
+            finally:
+                os.chdir(cwd)
+
+
+class BacktestTest(unittest.TestCase):
+    def testtrial(self):
+        a, b, c, d = ("[U:1:{}]".format(i) for i in range(1, 5))
+        # (red, blue, red score, blue score), in date order
+        played = [([a, b], [c, d], 3, 1), ([a, c], [b, d], 2, 2),
+                  ([a, b], [], 1, 0), ([a, b], [c, d], 5, 0),
+                  ([c, d], [a, b], 1, 1), ([c, d], [a, b], 0, 3)]
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                with open(log_archive.ARCHIVE_FILE, "wb") as archive:
+                    # archived out of order
+                    for i in (3, 0, 5, 1, 4, 2):
+                        red, blue, red_score, blue_score = played[i]
+                        players = dict([(p, {"team": "Red"}) for p in red] +
+                                       [(p, {"team": "Blue"}) for p in blue])
+                        log_archive.append_log(archive, log_archive.project({
+                            "id": i + 1,
+                            "length": 1800,
+                            "info": {"date": 1600000000 + 3600 * i,
+                                     "map": "koth_product_rcx"},
+                            "teams": {"Red": {"score": red_score},
+                                      "Blue": {"score": blue_score}},
+                            "players": players,
+                        }))
+                encoded = backtest.encode_games()
+            finally:
+                os.chdir(cwd)
+
+        # the game without a blue team is left out
+        self.assertEqual(encoded["players"].tolist(),
+                         [0, 1, 2, 3, 0, 2, 1, 3, 0, 1, 2, 3, 2, 3, 0, 1,
+                          2, 3, 0, 1])
+        self.assertEqual(encoded["starts"].tolist(), [0, 4, 8, 12, 16])
+        self.assertEqual(encoded["red_sizes"].tolist(), [2] * 5)
+        self.assertEqual(encoded["blue_sizes"].tolist(), [2] * 5)
+        self.assertEqual(encoded["results"].tolist(), [1, 0.5, 1, 0.5, 0])
+        self.assertEqual(int(encoded["player_count"]), 4)
+
+        # the last 3 games are held out, and the draw among them isn't
+        # predicted
+        trial = backtest.Trial(25.0, 25 / 3, 25 / 6, 25 / 300, 0.1)
+        env = trueskill.TrueSkill(*trial)
+        ratings = {p: env.create_rating() for p in (a, b, c, d)}
+        log_loss = 0.0
+        for i, (red, blue, red_score, blue_score) in enumerate(played):
+            if not blue:
+                continue
+            red_ratings = [ratings[p] for p in red]
+            blue_ratings = [ratings[p] for p in blue]
+            if i >= 3 and red_score != blue_score:
+                spread = math.sqrt(
+                    4 * trial.beta**2 +
+                    sum(r.sigma**2 for r in red_ratings + blue_ratings))
+                red_win = 1 - statistics.NormalDist(
+                    sum(r.mu for r in red_ratings) -
+                    sum(r.mu for r in blue_ratings), spread).cdf(0)
+                log_loss -= math.log(red_win if red_score > blue_score else
+                                     1 - red_win)
+            ranks = ([0, 0] if red_score == blue_score else
+                     [0, 1] if red_score > blue_score else [1, 0])
+            new_red, new_blue = env.rate([red_ratings, blue_ratings],
+                                         ranks=ranks)
+            ratings.update(zip(red, new_red))
+            ratings.update(zip(blue, new_blue))
+
+        try:
+            backtest.init_worker(encoded)
+            result = backtest.run_trial((trial, 0.6))
+            self.assertEqual(backtest.run_trial((trial, 0.6)), result)
+            self.assertEqual(backtest.run_trial((trial, 0.0)).games, 0)
+        finally:
+            backtest.games.clear()
+        self.assertEqual(result.games, 2)
+        self.assertEqual(result.accuracy, 1.0)
+        self.assertAlmostEqual(result.log_loss, log_loss / 2)
+
+
 if __name__ == "__main__":
     unittest.main()
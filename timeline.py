@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Flattens the round events of every archived log into columns of numpy
+arrays, so event based stats can be computed for the whole archive with a
+few vectorized passes instead of walking each log's rounds.
+
+The timeline is kept in timeline/ as one raw binary file per column, and
+only the logs archived since the last update are appended to it.  There
+are three tables:
+
+events       every round event, in archive order: the log (an index into
+             logs), the round within the log, the time, and the type,
+             team, steamid, killer and medigun codes
+logs         the id, archive offset, upload date and map code of each log
+log_players  the team code of each player of each log
+
+Players, maps, event types and mediguns are interned as codes, listed in
+timeline/meta.json with the row count of each table.  Teams are 0 for Red,
+1 for Blue and -1 for neither, and a missing value is -1.  meta.json is
+written after the columns, so an interrupted update is rolled back to the
+row counts it lists.
+
+med_drop_kills and midfights are corpus wide versions of
+parse_logs.get_meds_dropped and parse_logs.get_midfight_survival.
+
+usage: timeline.py [--rebuild] [--top N]
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np  # type: ignore
+import log_archive
+
+TIMELINE_DIR = "timeline"
+META_FILE = "meta.json"
+
+TABLES = {
+    "events": [
+        ("log", np.int32),
+        ("round", np.int16),
+        ("time", np.int32),
+        ("type", np.int8),
+        ("team", np.int8),
+        ("steamid", np.int32),
+        ("killer", np.int32),
+        ("medigun", np.int8),
+    ],
+    "logs": [
+        ("id", np.int64),
+        ("offset", np.int64),
+        ("date", np.int64),
+        ("map", np.int32),
+    ],
+    "log_players": [
+        ("log", np.int32),
+        ("player", np.int32),
+        ("team", np.int8),
+    ],
+}  # type: Dict[str, List[Tuple[str, Any]]]
+
+TEAMS = {"Red": 0, "Blue": 1}
+RED = TEAMS["Red"]
+BLUE = TEAMS["Blue"]
+# the first names of each interned kind, so their codes never change
+KNOWN_NAMES = {
+    "players": [],
+    "maps": [],
+    "types": ["charge", "drop", "medic_death", "pointcap", "round_win"],
+    "mediguns": ["medigun", "kritzkrieg", "quickfix", "vaccinator"],
+}  # type: Dict[str, List[str]]
+
+
+def column_file(directory, table, column):  # type: (str, str, str) -> str
+    return os.path.join(directory, "{}.{}.bin".format(table, column))
+
+
+def read_meta(directory):  # type: (str) -> Dict[str, Any]
+    meta_file = os.path.join(directory, META_FILE)
+    if not os.path.isfile(meta_file):
+        return {
+            "counts": {table: 0 for table in TABLES},
+            "names": {k: list(v) for k, v in KNOWN_NAMES.items()},
+            "last_offset": -1,
+        }
+    with open(meta_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class Timeline:
+    """
+    The columns of the timeline tables, as dictionaries of numpy arrays,
+    and the interned names.
+    """
+
+    def __init__(self, directory=TIMELINE_DIR):  # type: (str) -> None
+        meta = read_meta(directory)
+        self.names = meta["names"]  # type: Dict[str, List[str]]
+        self.tables = {}  # type: Dict[str, Dict[str, Any]]
+        for table, columns in TABLES.items():
+            count = meta["counts"][table]
+            self.tables[table] = {}
+            for column, dtype in columns:
+                path = column_file(directory, table, column)
+                self.tables[table][column] = (np.fromfile(
+                    path, dtype=dtype, count=count) if count else np.zeros(
+                        0, dtype=dtype))
+        self.events = self.tables["events"]
+        self.logs = self.tables["logs"]
+        self.log_players = self.tables["log_players"]
+
+    def code(self, kind, name):  # type: (str, str) -> int
+        names = self.names[kind]
+        return names.index(name) if name in names else -1
+
+    def round_ids(self):  # type: () -> Any
+        """
+        returns a number for each event that is the same for the events of
+        a round and different for different rounds
+        """
+        log = self.events["log"]
+        rounds = self.events["round"]
+        if not len(log):
+            return np.zeros(0, dtype=np.int64)
+        new_round = (log[1:] != log[:-1]) | (rounds[1:] != rounds[:-1])
+        return np.concatenate([[0], np.cumsum(new_round, dtype=np.int64)])
+
+
+def update(directory=TIMELINE_DIR):  # type: (str) -> int
+    """
+    appends the logs archived since the last update to the timeline, and
+    returns the number of logs appended
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta = read_meta(directory)
+    names = meta["names"]
+    codes = {kind: {n: i
+                    for i, n in enumerate(v)}
+             for kind, v in names.items()}
+
+    def intern(kind, name):  # type: (str, str) -> int
+        if name not in codes[kind]:
+            codes[kind][name] = len(names[kind])
+            names[kind].append(name)
+        return codes[kind][name]
+
+    def optional(kind, name):  # type: (str, Optional[str]) -> int
+        return -1 if name is None else intern(kind, name)
+
+    rows = {
+        table: {column: []
+                for column, _ in columns}
+        for table, columns in TABLES.items()
+    }  # type: Dict[str, Dict[str, List]]
+    events = rows["events"]
+    log_index = meta["counts"]["logs"]
+    appended = 0
+    last_offset = meta["last_offset"]
+    with open(log_archive.ARCHIVE_FILE, "rb") as archive:
+        for header in log_archive.iter_headers():
+            if header.offset <= last_offset:
+                continue
+            game = log_archive.read_log(archive, header.offset)
+            rows["logs"]["id"].append(header.id)
+            rows["logs"]["offset"].append(header.offset)
+            rows["logs"]["date"].append(header.date)
+            rows["logs"]["map"].append(intern("maps", header.map))
+            for id3, player in game["players"].items():
+                rows["log_players"]["log"].append(log_index)
+                rows["log_players"]["player"].append(intern("players", id3))
+                rows["log_players"]["team"].append(
+                    TEAMS.get(player["team"], -1))
+
+            for round_number, r in enumerate(game["rounds"]):
+                for e in r["events"]:
+                    events["log"].append(log_index)
+                    events["round"].append(round_number)
+                    events["time"].append(e["time"])
+                    events["type"].append(intern("types", e["type"]))
+                    events["team"].append(TEAMS.get(e.get("team"), -1))
+                    events["steamid"].append(
+                        optional("players", e.get("steamid")))
+                    events["killer"].append(
+                        optional("players", e.get("killer")))
+                    events["medigun"].append(
+                        optional("mediguns", e.get("medigun")))
+            log_index += 1
+            appended += 1
+            last_offset = header.offset
+
+    for table, columns in TABLES.items():
+        count = meta["counts"][table]
+        for column, dtype in columns:
+            path = column_file(directory, table, column)
+            with open(path, "ab") as f:
+                # drops the rows of an interrupted update
+                f.truncate(count * np.dtype(dtype).itemsize)
+                np.array(rows[table][column], dtype=dtype).tofile(f)
+        meta["counts"][table] = count + len(rows[table][columns[0][0]])
+    meta["last_offset"] = last_offset
+
+    meta_file = os.path.join(directory, META_FILE)
+    with open(meta_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(meta_file + ".tmp", meta_file)
+    return appended
+
+
+def player_teams(t, logs, players):  # type: (Timeline, Any, Any) -> Any
+    """
+    returns the team codes of players in logs, or -1 for players who
+    weren't in the log
+    """
+    player_count = max(len(t.names["players"]), 1)
+    keys = (t.log_players["log"].astype(np.int64) * player_count +
+            t.log_players["player"])
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    wanted = logs.astype(np.int64) * player_count + players
+    found = np.searchsorted(sorted_keys, wanted)
+    found = np.minimum(found, max(len(sorted_keys) - 1, 0))
+    if not len(sorted_keys):
+        return np.full(len(wanted), -1, dtype=np.int8)
+    hit = (sorted_keys[found] == wanted) & (players >= 0)
+    return np.where(hit, t.log_players["team"][order][found], -1)
+
+
+def med_drop_kills(t):  # type: (Timeline) -> Any
+    """
+    returns a mask of the medic deaths that were drops, as counted by
+    parse_logs.get_meds_dropped: the killer's enemy team logged a drop at
+    the same time earlier in the round, and the dropped medic's last
+    charge in the log (if any) was with the stock medigun
+    """
+    e = t.events
+    count = len(e["type"])
+    if not count:
+        return np.zeros(0, dtype=bool)
+    positions = np.arange(count, dtype=np.int64)
+    round_ids = t.round_ids()
+    drop = e["type"] == t.code("types", "drop")
+    death = e["type"] == t.code("types", "medic_death")
+
+    # the position of the latest drop of each team at every event
+    latest = {}
+    for team in (RED, BLUE):
+        marks = np.where(drop & (e["team"] == team), positions, -1)
+        latest[team] = np.maximum.accumulate(marks)
+
+    killer_team = player_teams(t, e["log"], e["killer"])
+    enemy = np.where(killer_team == BLUE, RED, BLUE)
+    last_drop = np.where(enemy == RED, latest[RED], latest[BLUE])
+    safe_drop = np.maximum(last_drop, 0)
+    matched = (death & (killer_team >= 0) & (last_drop >= 0)
+               & (round_ids[safe_drop] == round_ids)
+               & (e["time"][safe_drop] == e["time"]))
+
+    # the medigun of the dropped medic's last charge before the death
+    medigun = np.full(count, t.code("mediguns", "medigun"), dtype=np.int8)
+    charges = np.flatnonzero(e["type"] == t.code("types", "charge"))
+    if len(charges):
+        charge_keys = e["steamid"][charges].astype(np.int64) * count + charges
+        order = np.argsort(charge_keys)
+        charges, charge_keys = charges[order], charge_keys[order]
+        dropped = e["steamid"][safe_drop].astype(np.int64)
+        found = np.searchsorted(charge_keys, dropped * count + positions,
+                                side="right") - 1
+        charge = charges[np.maximum(found, 0)]
+        charged = ((found >= 0) & (charge_keys[np.maximum(found, 0)] //
+                                   count == dropped)
+                   & (e["log"][charge] == e["log"]))
+        medigun = np.where(charged, e["medigun"][charge], medigun)
+    return matched & (medigun == t.code("mediguns", "medigun"))
+
+
+def midfights(t):  # type: (Timeline) -> Tuple[Any, Any, Any]
+    """
+    returns the log, medic and whether the medic died of every midfight,
+    as counted by parse_logs.get_midfight_survival: a round of a koth or
+    control point map where the medic charged or died, which the medic
+    survived if the round had a point capture before their first death
+    """
+    e = t.events
+    empty = np.zeros(0, dtype=np.int64)
+    if not len(e["type"]):
+        return empty, empty, np.zeros(0, dtype=bool)
+    positions = np.arange(len(e["type"]), dtype=np.int64)
+    round_ids = t.round_ids()
+    round_count = int(round_ids[-1]) + 1
+    player_count = len(t.names["players"])
+
+    midfight_maps = np.array([
+        m.startswith("koth_") or m.startswith("cp_") for m in t.names["maps"]
+    ])
+    has_midfights = midfight_maps[t.logs["map"]][e["log"]]
+
+    no_event = len(positions)
+    first_cap = np.full(round_count, no_event, dtype=np.int64)
+    caps = e["type"] == t.code("types", "pointcap")
+    np.minimum.at(first_cap, round_ids[caps], positions[caps])
+
+    death = e["type"] == t.code("types", "medic_death")
+    medic_event = (death | (e["type"] == t.code("types", "charge"))) & (
+        e["steamid"] >= 0) & has_midfights
+    keys = round_ids * player_count + e["steamid"]
+    pairs, first = np.unique(keys[medic_event], return_index=True)
+    first_death = np.full(len(pairs), no_event, dtype=np.int64)
+    deaths = death & medic_event
+    np.minimum.at(first_death, np.searchsorted(pairs, keys[deaths]),
+                  positions[deaths])
+
+    rounds = pairs // max(player_count, 1)
+    medics = pairs % max(player_count, 1)
+    logs = e["log"][positions[medic_event][first]]
+    return logs, medics, first_death < first_cap[rounds]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild",
+                        action="store_true",
+                        help="rebuild the timeline from the whole archive")
+    parser.add_argument("--top",
+                        type=int,
+                        default=0,
+                        help="list the players with the most drops and "
+                        "midfight survivals")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        meta_file = os.path.join(TIMELINE_DIR, META_FILE)
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+    start = time.perf_counter()
+    appended = update()
+    print("appended {} logs in {:.1f}s".format(appended,
+                                               time.perf_counter() - start))
+    if not args.top:
+        return
+
+    start = time.perf_counter()
+    t = Timeline()
+    players = len(t.names["players"])
+    kills = med_drop_kills(t)
+    drops = np.bincount(t.events["killer"][kills], minlength=players)
+    _, medics, died = midfights(t)
+    escapes = np.bincount(medics[~died], minlength=players)
+    mid_deaths = np.bincount(medics[died], minlength=players)
+    print("{} events, computed in {:.2f}s".format(len(t.events["type"]),
+                                                  time.perf_counter() - start))
+
+    print("most medics dropped")
+    for p in np.argsort(-drops, kind="stable")[:args.top]:
+        print("  {:<20} {}".format(t.names["players"][p], drops[p]))
+    print("best midfight survival")
+    for p in np.argsort(-escapes, kind="stable")[:args.top]:
+        print("  {:<20} {} of {}".format(t.names["players"][p], escapes[p],
+                                         escapes[p] + mid_deaths[p]))
+
+
+if __name__ == "__main__":
+    main()
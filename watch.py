@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Keeps player profiles up to date as logs are uploaded, instead of waiting
+for the nightly pipeline.  The logs.tf listing is polled every --interval
+seconds, and each new competitive log is downloaded, checked by parsing
+it, added to the log archive and the duplicate index, inserted into
+stats.db and rated.  The leaderboards are then rewritten and the profiles
+of the players in the new logs are rendered and compressed again (see
+compress_site.py).
+
+New logs are handled in batches of at most --batch logs, with one
+transaction per batch in stats.db and in each partition written.  When a
+poll finds more new logs than that, the next poll starts straight away.
+Network errors, and errors writing stats.db or the site, back off up to
+--max-error-delay seconds, and logs that can't be parsed are never
+retried.  The logs a failed batch already archived are inserted and rated
+by the next poll instead of being downloaded again.
+
+The ratings, stats, profiles and similar players are rebuilt from the
+archive at startup.  The rating history, the rgl links, the other pages
+and later changes to the similar players are left to the pipeline, which
+should be run with --offline while this script is running so that only
+one process writes the archive.  Until the pipeline runs, logs are rated
+in the order they arrive, the profiles of players without new logs keep
+their old ranks, and a new log that replaces an archived copy of the same
+match removes the copy from stats.db but not its ratings and profile
+stats.
+
+usage: watch.py [--interval 30] [--batch 20] [--base-url URL] [--delay 1]
+                [--timeout 10] [--max-error-delay 600] [--once]
+"""
+
+import argparse
+import socket
+import sqlite3
+import time
+from urllib.error import HTTPError, URLError
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import archive_logs
+import compress_site
+import dedupe
+import get_stats
+import log_archive
+import make_db
+import mmr_calc
+import parse_logs
+import partitions
+import sql_commands
+from leaderboard import Leaderboard
+
+INTERVAL = 30
+BATCH_SIZE = 20
+DELAY = 1
+MAX_ERROR_DELAY = 10 * 60
+
+
+class Watcher:
+    """
+    The state kept between polls: the archived log ids, the duplicate
+    index, stats.db and the profile template.  The ratings and profile
+    stats are kept in the mmr_calc and get_stats modules.
+    """
+
+    def __init__(self, base_url, batch_size, delay, timeout):
+        # type: (str, int, float, float) -> None
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.delay = delay
+        self.timeout = timeout
+        self.archived = archive_logs.archived_ids()
+        self.failed = set()  # type: Set[int]
+        self.dedupe_con = dedupe.connect()
+        self.duplicate_index = dedupe.load_index(self.dedupe_con)
+        self.con = sql_commands.connect()
+        make_db.create_tables(self.con)
+        self.writer = partitions.PartitionWriter(self.con)
+        self.template = get_stats.profile_template()
+        self.leaderboards = {}  # type: Dict[str, Leaderboard]
+        # archived logs that a failed batch left to be inserted and rated,
+        # and whether each isn't a duplicate, and the players whose
+        # profiles are out of date
+        self.stored = []  # type: List[Tuple[Dict, bool]]
+        self.stale = set()  # type: Set[str]
+        # inserted logs that a new log flagged as duplicates
+        self.replaced = []  # type: List[int]
+
+    def load(self):  # type: () -> None
+        """
+        rates the archived logs, adds them to the profile stats, and
+        inserts the logs of unsealed months into stats.db
+        """
+        for game in mmr_calc.get_sorted_games():
+            mmr_calc.rate_game(game)
+
+        get_stats.load_rgl_info()
+        duplicates = dedupe.read_duplicates()
+        for game in log_archive.iter_logs():
+            if game["id"] not in duplicates:
+                get_stats.add_game(game)
+                self.insert(game)
+        self.commit()
+        get_stats.find_similar_players()
+        self.update_profiles(get_stats.player_stats_table.keys)
+
+    def insert(self, game):  # type: (Dict) -> None
+        part = self.writer.partition(game["info"]["date"])
+        if part is not None:
+            make_db.insert_game(part.cursor(), game)
+        make_db.insert_names(self.con.cursor(), game)
+
+    def commit(self):  # type: () -> None
+        self.writer.commit()
+        self.con.commit()
+
+    def download(self, game_ids):  # type: (List[int]) -> List[Dict]
+        """
+        downloads and parses logs, stopping at the first network error
+        """
+        games = []  # type: List[Dict]
+        for gid in game_ids:
+            try:
+                game = archive_logs.download_log(self.base_url, gid,
+                                                 self.timeout)
+                parse_logs.get_user_class_stats(log_archive.project(game))
+            except HTTPError as e:
+                print("error downloading log", gid, e)
+                if e.code == 429 or e.code >= 500:
+                    break
+                self.failed.add(gid)
+                continue
+            except (URLError, socket.timeout) as e:
+                print("error downloading log", gid, e)
+                break
+            except (ValueError, KeyError, TypeError, ZeroDivisionError) as e:
+                print(gid, "couldn't be parsed:", repr(e))
+                self.failed.add(gid)
+                continue
+            games.append(game)
+            time.sleep(self.delay)
+        return games
+
+    def add_games(self, games):  # type: (List[Dict]) -> Set[str]
+        """
+        archives, inserts and rates a batch of downloaded logs, and returns
+        the players in them
+        """
+        for game in games:
+            projected, duplicates = archive_logs.store_log(
+                game, self.dedupe_con, self.duplicate_index)
+            # archived logs aren't downloaded again, even if the rest of
+            # the batch fails, since they would be archived twice
+            self.archived.add(projected["id"])
+            self.replaced.extend(d for d, _ in duplicates
+                                 if d != projected["id"])
+            self.stored.append(
+                (projected, projected["id"] not in {d
+                                                    for d, _ in duplicates}))
+        return self.add_stored()
+
+    def add_stored(self):  # type: () -> Set[str]
+        """
+        inserts and rates the archived logs of the current or a failed
+        batch, and returns the players in them.  If stats.db can't be
+        written, the logs are left for the next poll.
+        """
+        new_logs = [game for game, new in self.stored if new]
+        # inserting a log again does nothing, so this can be retried
+        for game in new_logs:
+            self.insert(game)
+        for log_id in self.replaced:
+            part = self.writer.partition(
+                self.duplicate_index.logs[log_id].end)
+            # make_db.py deletes the duplicates in sealed months
+            if part is not None:
+                partitions.delete_logs(part, [log_id])
+        self.commit()
+
+        stored, self.stored = self.stored, []
+        self.replaced = []
+        for game in new_logs:
+            get_stats.add_game(game)
+        for game in sorted(new_logs, key=lambda g: g["info"]["date"]):
+            mmr_calc.rate_game(game)
+
+        players = set()  # type: Set[str]
+        for game, _ in stored:
+            players.update(game["players"])
+        return players
+
+    def update_profiles(self, players):  # type: (Iterable[str]) -> None
+        # the leaderboards are memory mapped, so they have to be closed
+        # before they're rewritten
+        for board in self.leaderboards.values():
+            board.close()
+        mmr_calc.write_ratings()
+        self.leaderboards, board_sizes = get_stats.open_leaderboards()
+        get_stats.write_usernames()
+        files = ["html/usernames.json"]
+        for id3 in players:
+            files.append(
+                get_stats.render_profile(id3, self.template,
+                                         self.leaderboards, board_sizes))
+        # the server would keep sending the old compressed copies
+        compress_site.update(files, jobs=1)
+
+    def poll(self):  # type: () -> int
+        """
+        handles the next batch of new logs and returns the number of new
+        logs that were left for the next poll.  Raises OSError or
+        ValueError when the listing can't be read, and OSError or
+        sqlite3.Error when stats.db or the profiles can't be written.  The
+        logs and profiles of a batch that failed are finished by the next
+        poll.
+        """
+        if self.stored:
+            self.stale.update(self.add_stored())
+        if self.stale:
+            self.update_profiles(self.stale)
+            self.stale = set()
+
+        game_ids = [
+            gid
+            for gid in archive_logs.list_game_ids(self.base_url, self.timeout)
+            if gid not in self.archived and gid not in self.failed
+        ]
+        if not game_ids:
+            return 0
+
+        start = time.perf_counter()
+        games = self.download(game_ids[:self.batch_size])
+        if not games:
+            return 0
+        self.stale.update(self.add_games(games))
+        players = len(self.stale)
+        self.update_profiles(self.stale)
+        self.stale = set()
+        newest = max(g["info"]["date"] for g in games)
+        print("added {} logs and updated {} profiles in {:.1f}s, {:.0f}s "
+              "after the newest was uploaded".format(
+                  len(games), players,
+                  time.perf_counter() - start,
+                  time.time() - newest))
+        return max(len(game_ids) - self.batch_size, 0)
+
+    def close(self):  # type: () -> None
+        for board in self.leaderboards.values():
+            board.close()
+        self.writer.close()
+        self.dedupe_con.close()
+        self.con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=INTERVAL)
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--base-url", default=archive_logs.LOGS_TF_URL)
+    parser.add_argument("--delay", type=float, default=DELAY)
+    parser.add_argument("--timeout", type=float, default=archive_logs.TIMEOUT)
+    parser.add_argument("--max-error-delay",
+                        type=float,
+                        default=MAX_ERROR_DELAY)
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="poll once and exit")
+    args = parser.parse_args()
+
+    watcher = Watcher(args.base_url, args.batch, args.delay, args.timeout)
+    start = time.perf_counter()
+    watcher.load()
+    print("loaded {} logs in {:.1f}s".format(len(watcher.archived),
+                                             time.perf_counter() - start))
+
+    error_delay = None  # type: Optional[float]
+    while True:
+        try:
+            remaining = watcher.poll()
+            error_delay = None
+        except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+            # network errors, a locked stats.db while the pipeline runs, or
+            # a log that can't be added
+            error_delay = min(2 * (error_delay or args.interval / 2),
+                              args.max_error_delay)
+            print("error polling:", repr(e))
+            print("retrying in", error_delay, "seconds")
+            remaining = 0
+        if args.once:
+            break
+        if not remaining:
+            time.sleep(error_delay or args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Player stats over windows of time, like the last 30 days or an rgl
+season, for profiles and league pages.  Only the partitions of stats.db
+overlapping the window are opened (see partitions.py), in batches of
+months that are summed, and each player's stats are read from a range of
+the PlayerStatsPlayerTime index.
+
+usage: window_stats.py steamid64 [--days 30 | --season SEASON_ID]
+"""
+
+import argparse
+import time
+from typing import Dict, Iterable, Optional, Tuple
+import get_rgl_matches
+import partitions
+import sql_commands
+
+DAY = 24 * 60 * 60
+
+# the summed stats of each class a player played
+ClassStats = Dict[str, Dict[str, float]]
+
+
+def window_stats(player_ids, start, end):
+    # type: (Iterable[int], float, float) -> Dict[int, ClassStats]
+    """
+    returns the summed stats of each class played by the players, by
+    steamid64, in the logs uploaded in [start, end)
+    """
+    stats = {}  # type: Dict[int, ClassStats]
+    for player_id in player_ids:
+        stats[player_id] = {}
+    for con in partitions.connect_batches(start, end):
+        for player_id, player_stats in stats.items():
+            for row in con.execute(sql_commands.get_window_stats,
+                                   (player_id, int(start), int(end))):
+                class_stats = player_stats.setdefault(
+                    sql_commands.classnames[int(row[0])],
+                    dict.fromkeys(sql_commands.window_stats_columns, 0))
+                for column, value in zip(sql_commands.window_stats_columns,
+                                         row[1:]):
+                    class_stats[column] += value or 0
+    return stats
+
+
+def recent_stats(player_ids, days=30, now=None):
+    # type: (Iterable[int], float, Optional[float]) -> Dict[int, ClassStats]
+    """
+    returns the players' stats in the logs uploaded in the last days
+    """
+    if now is None:
+        now = time.time()
+    return window_stats(player_ids, now - days * DAY, now)
+
+
+def season_window(season_id):  # type: (int) -> Optional[Tuple[float, float]]
+    """
+    returns the time of the first match of an rgl season and the end of
+    the day of its last match, or None if none of its matches are dated
+    """
+    dates = [
+        m.date.timestamp() for m in get_rgl_matches.read_matches(season_id)
+        if m.date
+    ]
+    if not dates:
+        return None
+    return min(dates), max(dates) + DAY
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("steamid64", type=int)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--season", type=int)
+    args = parser.parse_args()
+
+    if args.season is None:
+        stats = recent_stats([args.steamid64], args.days)
+    else:
+        window = season_window(args.season)
+        if window is None:
+            print("no dated matches in season", args.season)
+            return
+        stats = window_stats([args.steamid64], *window)
+
+    columns = sql_commands.window_stats_columns
+    print("{:<14}".format("class") + "".join("{:>14}".format(c)
+                                            for c in columns))
+    for class_name, class_stats in sorted(stats[args.steamid64].items()):
+        print("{:<14}".format(class_name) + "".join(
+            "{:>14}".format(class_stats[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()